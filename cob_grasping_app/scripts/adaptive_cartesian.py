@@ -0,0 +1,131 @@
+#!/usr/bin/python
+import math
+
+import numpy as np
+
+import rospy
+from geometry_msgs.msg import Pose
+from tf.transformations import quaternion_slerp
+
+from parallel_planning import make_robot_state
+from trajectory_processing import concatenate_trajectories
+
+
+def pose_distance(pose_a, pose_b):
+    # Like compute_cartesian_path, the longer of translation and rotation angle decides the number of steps
+    translation = math.sqrt((pose_b.position.x - pose_a.position.x) ** 2 +
+                            (pose_b.position.y - pose_a.position.y) ** 2 +
+                            (pose_b.position.z - pose_a.position.z) ** 2)
+    dot = abs(pose_a.orientation.x * pose_b.orientation.x + pose_a.orientation.y * pose_b.orientation.y +
+              pose_a.orientation.z * pose_b.orientation.z + pose_a.orientation.w * pose_b.orientation.w)
+    return max(translation, 2.0 * math.acos(min(1.0, dot)))
+
+
+def interpolate_pose(pose_a, pose_b, t):
+    pose = Pose()
+    pose.position.x = pose_a.position.x + t * (pose_b.position.x - pose_a.position.x)
+    pose.position.y = pose_a.position.y + t * (pose_b.position.y - pose_a.position.y)
+    pose.position.z = pose_a.position.z + t * (pose_b.position.z - pose_a.position.z)
+    q = quaternion_slerp([pose_a.orientation.x, pose_a.orientation.y, pose_a.orientation.z, pose_a.orientation.w],
+                         [pose_b.orientation.x, pose_b.orientation.y, pose_b.orientation.z, pose_b.orientation.w], t)
+    pose.orientation.x, pose.orientation.y, pose.orientation.z, pose.orientation.w = q
+    return pose
+
+
+class CartesianPath(object):
+    # Polyline through the start pose and the waypoints, addressed by the fraction of its length
+    def __init__(self, start_pose, waypoints):
+        self.poses = [start_pose] + list(waypoints)
+        lengths = [pose_distance(pose_a, pose_b) for (pose_a, pose_b) in zip(self.poses[:-1], self.poses[1:])]
+        self.cumulative = np.concatenate([[0.0], np.cumsum(lengths)])
+        self.length = self.cumulative[-1]
+
+    def pose_at(self, fraction):
+        distance = fraction * self.length
+        i = min(int(np.searchsorted(self.cumulative, distance, side='right')), len(self.poses) - 1)
+        leg = self.cumulative[i] - self.cumulative[i - 1]
+        if leg <= 0.0:
+            return self.poses[i]
+        return interpolate_pose(self.poses[i - 1], self.poses[i], (distance - self.cumulative[i - 1]) / leg)
+
+    def waypoints(self, start, end, tolerance=1e-6):
+        # Waypoints between the two fractions, ending with the pose at end
+        (start, end) = (start * self.length, end * self.length)
+        inner = [self.poses[i] for i in xrange(1, len(self.poses))
+                 if start + tolerance < self.cumulative[i] < end - tolerance]
+        return inner + [self.pose_at(end / self.length)]
+
+
+class AdaptiveCartesianPlanner(object):
+    # compute_cartesian_path starting with a coarse eef_step. Where the path stops (IK jump or collision), the next
+    # refine_distance is planned from the achieved state with half the step, down to min_step. After the refined
+    # part the coarse step is used again. Achieved parts are kept and joined, nothing is planned twice.
+    def __init__(self, group_name, eef_link, max_step, min_step, jump_threshold, refine_distance=0.05):
+        self.group_name = group_name
+        self.eef_link = eef_link
+        self.max_step = max_step
+        self.min_step = min_step
+        self.jump_threshold = jump_threshold
+        self.refine_distance = refine_distance
+
+    def plan(self, client, start_state, waypoints, name=""):
+        # Returns the trajectory, the achieved fraction and the used steps as (from, to, eef_step)
+        start_pose = client.compute_fk(self.eef_link, start_state)
+        if start_pose is None:
+            rospy.logwarn("Plan " + name + " (adaptive): no start pose, using eef_step " + str(self.min_step))
+            (traj, fraction) = client.cartesian_path(self.group_name, self.eef_link, start_state, waypoints,
+                                                     self.min_step, self.jump_threshold)
+            return traj, fraction, [(0.0, fraction, self.min_step)]
+
+        path = CartesianPath(start_pose, waypoints)
+        if path.length <= 0.0:
+            (traj, fraction) = client.cartesian_path(self.group_name, self.eef_link, start_state, waypoints,
+                                                     self.max_step, self.jump_threshold)
+            return traj, fraction, [(0.0, fraction, self.max_step)]
+
+        pieces = []
+        steps = []
+        state = start_state
+        position = 0.0
+        step = self.max_step
+        refine_end = None
+
+        while True:
+            end = 1.0 if refine_end is None else refine_end
+            (traj, fraction) = client.cartesian_path(self.group_name, self.eef_link, state,
+                                                     path.waypoints(position, end), step, self.jump_threshold)
+            if traj is None:
+                fraction = 0.0
+
+            achieved = position + fraction * (end - position)
+            if traj is not None and len(traj.joint_trajectory.points) > 1 and achieved > position:
+                pieces.append(traj)
+                steps.append((round(position, 3), round(achieved, 3), step))
+                state = make_robot_state(traj.joint_trajectory.joint_names,
+                                         traj.joint_trajectory.points[-1].positions,
+                                         start_state.attached_collision_objects)
+                position = achieved
+
+            if fraction >= 1.0:
+                if end >= 1.0:
+                    position = 1.0
+                    break
+
+                # Refined part passed, back to the coarse step
+                (step, refine_end) = (self.max_step, None)
+                continue
+
+            if step * 0.5 < self.min_step:
+                break
+
+            (step, refine_end) = (step * 0.5, min(1.0, position + self.refine_distance / path.length))
+
+        rospy.loginfo("Plan " + name + " (adaptive): " + str(round(position * 100, 2)) + "% with eef_step " +
+                      ", ".join("%.3f (%d-%d%%)" % (eef_step, round(start * 100), round(stop * 100))
+                                for (start, stop, eef_step) in steps))
+
+        if len(pieces) == 0:
+            return None, 0.0, steps
+        if len(pieces) == 1:
+            return pieces[0], position, steps
+        return concatenate_trajectories(pieces, blend=False)[0], position, steps
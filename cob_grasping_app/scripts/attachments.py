@@ -0,0 +1,78 @@
+#!/usr/bin/python
+import threading
+
+import rospy
+from geometry_msgs.msg import Pose
+from moveit_msgs.msg import AttachedCollisionObject, CollisionObject
+from shape_msgs.msg import SolidPrimitive
+
+
+GRIPPER_TOUCH_LINKS = ["base_link", "camera_link", "finger_1_link", "finger_2_link", "grasp_link", "palm_link"]
+
+
+def make_attached_object(active_arm, object_data, object_id="object"):
+    object_shape = SolidPrimitive()
+    object_shape.type = object_data["shape"]
+    object_shape.dimensions.append(object_data["dimension"][2])  # Height
+    object_shape.dimensions.append(object_data["dimension"][0] * 0.5)  # Radius
+
+    object_pose = Pose()
+    object_pose.orientation.w = 1.0
+
+    object_collision = CollisionObject()
+    object_collision.header.frame_id = "gripper_" + active_arm + "_grasp_link"
+    object_collision.id = object_id
+    object_collision.primitives.append(object_shape)
+    object_collision.primitive_poses.append(object_pose)
+    object_collision.operation = CollisionObject.ADD
+
+    object_attached = AttachedCollisionObject()
+    object_attached.link_name = "gripper_" + active_arm + "_grasp_link"
+    object_attached.object = object_collision
+    object_attached.touch_links = ["gripper_" + active_arm + "_" + link for link in GRIPPER_TOUCH_LINKS]
+
+    return object_attached
+
+
+class AttachmentManager(object):
+    # Attached object messages of the grasped object, built once per arm and object definition and shared by all
+    # segments and retries. Callers must not modify them. attach() and detach() update the live planning scene.
+    def __init__(self, scene_client, object_id="object"):
+        self.scene_client = scene_client
+        self.object_id = object_id
+
+        self.lock = threading.Lock()
+        self.templates = {}  # (arm, shape, dimension) -> AttachedCollisionObject
+        self.attached = {}  # arm -> AttachedCollisionObject in the live planning scene
+
+    def attached_object(self, arm, object_data):
+        key = (arm, object_data["shape"], tuple(object_data["dimension"]))
+        with self.lock:
+            if key not in self.templates:
+                self.templates[key] = make_attached_object(arm, object_data, self.object_id)
+            return self.templates[key]
+
+    def attached_objects(self, arm, object_data):
+        # Ready to use as the attached objects of a segment
+        return [self.attached_object(arm, object_data)]
+
+    def is_attached(self, arm):
+        return arm in self.attached
+
+    def attach(self, arm, object_data):
+        attached_object = self.attached_object(arm, object_data)
+        if not self.scene_client.attach(attached_object):
+            rospy.logwarn("Attaching '" + self.object_id + "' to the " + arm + " gripper not confirmed")
+        self.attached[arm] = attached_object
+
+    def detach(self, arm, keep_in_world=True):
+        attached_object = self.attached.pop(arm, None)
+        if attached_object is None:
+            return
+
+        if not self.scene_client.detach(attached_object.link_name, self.object_id, keep_in_world):
+            rospy.logwarn("Detaching '" + self.object_id + "' from the " + arm + " gripper not confirmed")
+
+    def detach_all(self, keep_in_world=False):
+        for arm in self.attached.keys():
+            self.detach(arm, keep_in_world)
@@ -0,0 +1,160 @@
+#!/usr/bin/python
+import argparse
+import itertools
+import os
+import re
+import time
+
+import rospkg
+import rospy
+import yaml
+from moveit_commander import MoveGroupCommander
+from moveit_msgs.msg import PlanningScene
+
+from run_test_suite import read_results, start_process, summarize, wait_for_process, write_summary
+from scene_updates import PlanningSceneClient
+
+
+# Parameters of a test configuration in test_suite.yaml, combined in this order
+SUITE_PARAMETERS = ["scene_config", "test_config", "robot", "planer_id", "planning_method", "jump_threshold",
+                    "eef_step"]
+
+
+def load_yaml(filename):
+    with open(filename, 'r') as stream:
+        return yaml.safe_load(stream)
+
+
+def expand_test_suite(test_suite, repetitions):
+    # One run per combination of the suite parameters and repetition, named like ts1_t3_r0
+    runs = []
+    for suite_name in sorted(test_suite):
+        suite = test_suite[suite_name]
+        suite_index = re.sub(r"\D", "", suite_name) or suite_name
+        combinations = itertools.product(*[suite[parameter] for parameter in SUITE_PARAMETERS])
+        for (index, values) in enumerate(combinations):
+            for repetition in xrange(repetitions):
+                runs.append(("ts" + suite_index + "_t" + str(index + 1) + "_r" + str(repetition),
+                             dict(zip(SUITE_PARAMETERS, values))))
+    return runs
+
+
+class BenchDaemon(object):
+    # Runs many test configurations on one robot bringup and move_group. Between two runs only the planning scene
+    # is cleared, the suite parameters are switched and the arms are moved back to the start pose of the scene.
+    def __init__(self, args):
+        self.args = args
+        self.scene_data = load_yaml(args.scene_config)
+
+        self.env = dict(os.environ)
+        self.env["ROS_HOME"] = args.output
+        self.env["GRASPING_APP_BENCH_DAEMON"] = "1"
+
+        pub_planning_scene = rospy.Publisher("planning_scene", PlanningScene, queue_size=1)
+        self.scene_client = PlanningSceneClient(pub_planning_scene)
+        self.groups = dict((arm, MoveGroupCommander("arm_" + arm)) for arm in ["left", "right"])
+
+    def reset(self, name, config):
+        rospy.set_param("/test_name", name)
+        for parameter in SUITE_PARAMETERS:
+            if parameter != "robot":
+                rospy.set_param("/" + parameter, config[parameter])
+
+        if not self.scene_client.reset():
+            rospy.logwarn("Planning scene of '" + name + "' was not cleared")
+
+        start_pose = self.scene_data[config["scene_config"]]["poses"]["start"]
+        for (arm, group) in sorted(self.groups.items()):
+            group.set_planner_id("LBKPIECEkConfigDefault")
+            group.set_joint_value_target(rospy.get_param("/script_server/arm_" + arm + "/" + start_pose)[0])
+            if not group.go(wait=True):
+                rospy.logwarn("Unable to move " + arm + " arm to '" + start_pose + "'")
+            group.stop()
+
+    def run(self, name, config):
+        log_file = os.path.join(self.args.output, name + ".log")
+        result = {"test": name, "kind": "recording", "worker": 0, "log": log_file, "config": config}
+
+        reset_start = time.time()
+        self.reset(name, config)
+        result["reset_duration"] = round(time.time() - reset_start, 1)
+
+        with open(log_file, 'w') as log:
+            start = time.time()
+            test = start_process(["rostest", "--reuse-master", self.args.test_file,
+                                  "time_limit:=" + str(self.args.time_limit)], self.env, log)
+            status = wait_for_process(test, self.args.time_limit + self.args.grace)
+            result["duration"] = round(time.time() - start, 1)
+
+        if status is None:
+            result["status"] = "timeout"
+        else:
+            result.update(read_results(self.args.output, start))
+            if status != 0 and result["status"] == "passed":
+                result["status"] = "failed"
+        return result
+
+
+def main():
+    package_path = rospkg.RosPack().get_path("cob_grasping_app")
+
+    parser = argparse.ArgumentParser(description="Run the test suite on a persistent robot bringup and move_group")
+    parser.add_argument("--test-suite", default=os.path.join(package_path, "config", "test_suite.yaml"))
+    parser.add_argument("--generation-config",
+                        default=os.path.join(package_path, "config", "test_generation_config.yaml"))
+    parser.add_argument("--scene-config", default=os.path.join(package_path, "config", "scene_config.yaml"))
+    parser.add_argument("--test-file", default=os.path.join(package_path, "test", "bench_run.test"))
+    parser.add_argument("--robot", default=os.environ.get("ROBOT"), help="only run configurations of this robot")
+    parser.add_argument("--repetitions", type=int, default=None,
+                        help="runs per configuration, test_repetitions of the generation config by default")
+    parser.add_argument("--output", default="~/.ros/cob_grasping_app/bench")
+    parser.add_argument("--filter", default=None, help="only run tests whose name matches this regex")
+    parser.add_argument("--grace", type=float, default=30.0, help="startup time added to the time limit in s")
+    args = parser.parse_args(rospy.myargv()[1:])
+
+    rospy.init_node("bench_daemon")
+
+    args.output = os.path.abspath(os.path.expanduser(args.output))
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+
+    generation_config = load_yaml(args.generation_config)
+    args.time_limit = generation_config["time_limit_recording"]
+    if args.repetitions is None:
+        args.repetitions = generation_config.get("test_repetitions", 1)
+
+    runs = []
+    for (name, config) in expand_test_suite(load_yaml(args.test_suite), args.repetitions):
+        if args.filter is not None and not re.search(args.filter, name):
+            continue
+        if args.robot is not None and config["robot"] != args.robot:
+            rospy.logwarn("Skipping '" + name + "', it is configured for " + config["robot"])
+            continue
+        runs.append((name, config))
+
+    rospy.loginfo("Running " + str(len(runs)) + " configurations on one bringup")
+
+    start = time.time()
+    daemon = BenchDaemon(args)
+    results = []
+    for (name, config) in runs:
+        if rospy.is_shutdown():
+            break
+
+        result = daemon.run(name, config)
+        results.append(result)
+        rospy.loginfo("[%3d/%d] %-10s %-20s %7.1fs (reset %.1fs)" % (len(results), len(runs), result["status"], name,
+                                                                     result.get("duration", 0.0),
+                                                                     result["reset_duration"]))
+
+        # Written after every run, the results survive an aborted bench
+        write_summary(summarize(results, time.time() - start, 1), args.output)
+
+    summary = summarize(results, time.time() - start, 1)
+    rospy.loginfo("%d passed, %d failed, %d timeout, %d error in %.0fs, results in '%s'" %
+                  (summary["passed"], summary["failed"], summary["timeout"], summary["error"], summary["duration"],
+                   os.path.join(args.output, "results.yaml")))
+
+
+if __name__ == '__main__':
+    main()
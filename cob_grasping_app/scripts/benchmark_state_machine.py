@@ -0,0 +1,120 @@
+#!/usr/bin/python
+import argparse
+import logging
+import time
+
+import numpy as np
+import yaml
+
+from offline_harness import CallProfile, OfflineHarness
+
+
+def parse_parameter(text):
+    # name=value, the value is read as YAML
+    (name, value) = text.split("=", 1)
+    return name, yaml.safe_load(value)
+
+
+def parse_planner(text):
+    # planner_id[:latency[:failure_rate]]
+    values = text.split(":")
+    return values[0], [float(value) for value in values[1:3]]
+
+
+def percentiles(columns, kind):
+    # (name, count, p50, p90, p99, max) in ms for every name of a kind
+    mask = columns["kind"] == kind
+    rows = []
+    for name in sorted(set(columns["name"][mask])):
+        wall = columns["wall"][mask & (columns["name"] == name)] * 1000.0
+        rows.append((name, len(wall), np.percentile(wall, 50), np.percentile(wall, 90), np.percentile(wall, 99),
+                     np.max(wall)))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the grasping_app state machine against offline stand-ins "
+                                                 "of move_group, the script server, TF and the planning scene")
+    parser.add_argument("--repeats", type=int, default=20, help="manipulations per run")
+    parser.add_argument("--planning-method", default="cartesian",
+                        choices=["joint", "cartesian", "cartesian_linear", "cartesian_mixed"])
+    parser.add_argument("--scene", default="scene_3")
+    parser.add_argument("--plan-latency", type=float, default=0.0, help="s per plan() call")
+    parser.add_argument("--plan-failure-rate", type=float, default=0.0)
+    parser.add_argument("--portfolio", type=parse_planner, action="append", default=[],
+                        help="race this planner, e.g. --portfolio RRTConnectkConfigDefault:0.05:0.1, without "
+                             "latency and failure rate the ones of --plan-latency and --plan-failure-rate are used")
+    parser.add_argument("--portfolio-mode", default="first", choices=["first", "best"])
+    parser.add_argument("--selection", action="store_true",
+                        help="choose one of the --portfolio planners per segment instead of racing them")
+    parser.add_argument("--cartesian-latency", type=float, default=0.0, help="s per compute_cartesian_path() call")
+    parser.add_argument("--cartesian-failure-rate", type=float, default=0.0)
+    parser.add_argument("--execute-latency", type=float, default=0.0, help="s per execute() call")
+    parser.add_argument("--jitter", type=float, default=0.0, help="uniform jitter of all latencies in s")
+    parser.add_argument("--time-scale", type=float, default=0.0,
+                        help="execute() additionally waits this fraction of the trajectory duration")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--param", type=parse_parameter, action="append", default=[],
+                        help="additional parameter, e.g. --param ~trajectory_cache=true")
+    parser.add_argument("--output", default="state_machine_latency.csv", help="latency metrics file (.csv or .npz)")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    parameters = {"/planning_method": args.planning_method,
+                  "/scene_config": args.scene,
+                  "~manipulation_repeats": args.repeats,
+                  "~latency_metrics": True,
+                  "~latency_metrics_file": args.output}
+    if args.portfolio and args.selection:
+        parameters["~planner_selection"] = [planner_id for (planner_id, _) in args.portfolio]
+    elif args.portfolio:
+        parameters["~planner_portfolio"] = [planner_id for (planner_id, _) in args.portfolio]
+        parameters["~planner_portfolio_mode"] = args.portfolio_mode
+    parameters.update(dict(args.param))
+
+    profiles = {"plan": CallProfile(args.plan_latency, args.jitter, args.plan_failure_rate),
+                "cartesian_path": CallProfile(args.cartesian_latency, args.jitter, args.cartesian_failure_rate),
+                "execute": CallProfile(args.execute_latency, args.jitter)}
+    for (planner_id, values) in args.portfolio:
+        values = values + [args.plan_latency, args.plan_failure_rate][len(values):]
+        profiles["plan:" + planner_id] = CallProfile(values[0], args.jitter, values[1])
+
+    harness = OfflineHarness(parameters, profiles, seed=args.seed, time_scale=args.time_scale)
+    grasping_app = harness.install()
+
+    sm = grasping_app.SM()
+    start = time.time()
+    outcome = sm.execute()
+    duration = time.time() - start
+
+    columns = grasping_app.latency_metrics.columns()
+    print("Outcome: %s, %d manipulations in %.3fs, %.2f manipulations/s" %
+          (outcome, args.repeats, duration, args.repeats / duration))
+    # Concurrent calls (parallel planning, planner portfolio) sleep at the same time
+    print("Simulated latencies: %.3fs summed over all threads" % harness.slept)
+
+    for kind in ["state", "segment", "planner", "scene", "tf"]:
+        rows = percentiles(columns, kind)
+        if len(rows) == 0:
+            continue
+
+        print("")
+        print("%-32s | %6s | %9s | %9s | %9s | %9s" % (kind, "count", "p50 [ms]", "p90 [ms]", "p99 [ms]", "max [ms]"))
+        for row in rows:
+            print("%-32s | %6d | %9.3f | %9.3f | %9.3f | %9.3f" % row)
+
+    if grasping_app.planner_statistics is not None:
+        print("")
+        print("%-10s | %-6s | %-26s | %6s | %8s | %9s | %9s" % ("segment", "arm", "planner", "calls", "success",
+                                                                 "p50 [ms]", "p90 [ms]"))
+        for (scene_id, segment, arm, planner_id, calls, success_rate, p50, p90) in \
+                grasping_app.planner_statistics.summary():
+            print("%-10s | %-6s | %-26s | %6d | %7.1f%% | %9.3f | %9.3f" % (segment, arm, planner_id, calls,
+                                                                          success_rate * 100.0, p50 * 1000.0,
+                                                                          p90 * 1000.0))
+
+
+if __name__ == '__main__':
+    main()
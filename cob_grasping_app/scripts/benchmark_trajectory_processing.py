@@ -0,0 +1,179 @@
+#!/usr/bin/python
+import argparse
+import sys
+import timeit
+from StringIO import StringIO
+
+import numpy as np
+
+import rospy
+from moveit_msgs.msg import RobotTrajectory
+from trajectory_msgs.msg import JointTrajectoryPoint
+
+from trajectory_processing import SMOOTHING_OFFSET, TrajectoryArrays, process_trajectory
+
+
+# ---- REFERENCE IMPLEMENTATION (per-point loops as used by grasping_app.py before vectorization) ----
+def loop_smooth_cartesian_path(traj):
+    time_offset = 200000000  # 0.2s
+
+    for i in xrange(len(traj.joint_trajectory.points)):
+        traj.joint_trajectory.points[i].time_from_start += rospy.Duration(0, time_offset)
+
+    traj.joint_trajectory.points[-1].time_from_start += rospy.Duration(0, time_offset)
+
+    return traj
+
+
+def loop_fix_velocities(traj):
+    traj.joint_trajectory.points[-1].velocities = [0] * 7
+
+    speed_factor = 1.0
+    for i in xrange(len(traj.joint_trajectory.points)):
+        traj.joint_trajectory.points[i].time_from_start *= speed_factor
+
+    return traj
+
+
+def loop_scale_joint_trajectory_speed(traj, scale):
+    new_traj = RobotTrajectory()
+    new_traj.joint_trajectory = traj.joint_trajectory
+    n_joints = len(traj.joint_trajectory.joint_names)
+    n_points = len(traj.joint_trajectory.points)
+    points = list(traj.joint_trajectory.points)
+
+    for i in xrange(n_points):
+        point = JointTrajectoryPoint()
+        point.time_from_start = traj.joint_trajectory.points[i].time_from_start / scale
+        point.velocities = list(traj.joint_trajectory.points[i].velocities)
+        point.accelerations = list(traj.joint_trajectory.points[i].accelerations)
+        point.positions = traj.joint_trajectory.points[i].positions
+
+        for j in xrange(n_joints):
+            point.velocities[j] = point.velocities[j] * scale
+            point.accelerations[j] = point.accelerations[j] * scale * scale
+
+        points[i] = point
+
+    new_traj.joint_trajectory.points = points
+    return new_traj
+
+
+# ---- SYNTHETIC TRAJECTORIES ----
+def make_trajectory(n_points, n_joints=7, dt=0.01):
+    traj = RobotTrajectory()
+    traj.joint_trajectory.joint_names = ["arm_" + str(j + 1) + "_joint" for j in xrange(n_joints)]
+
+    t = np.arange(n_points) * dt
+    phase = np.arange(n_joints) * 0.3
+    positions = np.sin(t[:, None] + phase[None, :])
+    velocities = np.cos(t[:, None] + phase[None, :])
+    accelerations = -positions
+
+    for i in xrange(n_points):
+        traj.joint_trajectory.points.append(JointTrajectoryPoint(positions=positions[i].tolist(),
+                                                                 velocities=velocities[i].tolist(),
+                                                                 accelerations=accelerations[i].tolist(),
+                                                                 time_from_start=rospy.Duration.from_sec(t[i])))
+    return traj
+
+
+def with_repeated_points(positions, count=3):
+    # The first, a middle and the last point repeated, like a start == goal plan or a planner repeating its start
+    middle = len(positions) // 2
+    return np.concatenate([[positions[0]] * (count - 1), positions[:middle], [positions[middle]] * (count - 1),
+                           positions[middle:], [positions[-1]] * (count - 1)])
+
+
+def retime_arrays(positions, n_joints=7):
+    return TrajectoryArrays(["arm_" + str(j + 1) + "_joint" for j in xrange(n_joints)], np.zeros(len(positions)),
+                            positions).retime([1.0] * n_joints, [2.0] * n_joints)
+
+
+def is_finite(arrays):
+    return all(np.all(np.isfinite(values)) for values in [arrays.time_from_start, arrays.velocities,
+                                                          arrays.accelerations])
+
+
+def loop_pipeline(traj, speed):
+    # Per plan: smooth + scale, then for execution: smooth + fix
+    traj = loop_smooth_cartesian_path(traj)
+    traj = loop_scale_joint_trajectory_speed(traj, speed)
+    traj = loop_smooth_cartesian_path(traj)
+    return loop_fix_velocities(traj)
+
+
+def vectorized_pipeline(traj, speed):
+    traj = process_trajectory(traj, time_offset=SMOOTHING_OFFSET, end_offset=SMOOTHING_OFFSET, speed=speed)
+    return process_trajectory(traj, time_offset=SMOOTHING_OFFSET, end_offset=SMOOTHING_OFFSET, stop_at_end=True)
+
+
+def max_difference(traj_a, traj_b):
+    a = TrajectoryArrays.from_msg(traj_a)
+    b = TrajectoryArrays.from_msg(traj_b)
+    return max(np.max(np.abs(a.time_from_start - b.time_from_start)),
+               np.max(np.abs(a.positions - b.positions)),
+               np.max(np.abs(a.velocities - b.velocities)),
+               np.max(np.abs(a.accelerations - b.accelerations)))
+
+
+def copy_trajectory(traj):
+    buff = StringIO()
+    traj.serialize(buff)
+    traj_copy = RobotTrajectory()
+    traj_copy.deserialize(buff.getvalue())
+    return traj_copy
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare per-point and vectorized trajectory post-processing")
+    parser.add_argument("--points", type=int, nargs="+", default=[100, 1000, 5000])
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--speed", type=float, default=0.3)
+    args = parser.parse_args()
+
+    print("%8s | %12s | %12s | %8s | %10s" % ("points", "loop [ms]", "numpy [ms]", "speedup", "max diff"))
+    for n_points in args.points:
+        reference = make_trajectory(n_points)
+
+        # Both pipelines modify their input, so every run gets a fresh deep copy
+        loop_time = min(timeit.repeat(lambda: loop_pipeline(copy_trajectory(reference), args.speed),
+                                      repeat=3, number=args.repeats)) / args.repeats
+        copy_time = min(timeit.repeat(lambda: copy_trajectory(reference), repeat=3, number=args.repeats)) / \
+            args.repeats
+        numpy_time = min(timeit.repeat(lambda: vectorized_pipeline(copy_trajectory(reference), args.speed),
+                                       repeat=3, number=args.repeats)) / args.repeats
+
+        diff = max_difference(loop_pipeline(copy_trajectory(reference), args.speed),
+                              vectorized_pipeline(copy_trajectory(reference), args.speed))
+
+        loop_time -= copy_time
+        numpy_time -= copy_time
+        print("%8d | %12.3f | %12.3f | %7.1fx | %10.2e" % (n_points, loop_time * 1000.0, numpy_time * 1000.0,
+                                                           loop_time / max(numpy_time, 1e-9), diff))
+
+    # Retiming must stay finite with repeated points, NaN times would be sent to the controller
+    print("")
+    print("%8s | %12s | %10s | %10s" % ("points", "retime [ms]", "finite", "repeated"))
+    failed = False
+    for n_points in args.points:
+        positions = TrajectoryArrays.from_msg(make_trajectory(n_points)).positions
+        retime_time = min(timeit.repeat(lambda: retime_arrays(positions), repeat=3, number=args.repeats)) / \
+            args.repeats
+        (finite, repeated) = (is_finite(retime_arrays(positions)),
+                              is_finite(retime_arrays(with_repeated_points(positions))))
+        failed = failed or not (finite and repeated)
+        print("%8d | %12.3f | %10s | %10s" % (n_points, retime_time * 1000.0, finite, repeated))
+
+    if is_finite(retime_arrays(with_repeated_points(positions[:1]))):
+        print("start == goal: finite")
+    else:
+        print("start == goal: not finite")
+        failed = True
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
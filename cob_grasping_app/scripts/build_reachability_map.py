@@ -0,0 +1,104 @@
+#!/usr/bin/python
+import argparse
+import math
+import os
+
+import numpy as np
+
+import rospy
+from geometry_msgs.msg import Pose
+from moveit_commander import MoveGroupCommander
+
+from grasp_search import sample_orientations
+from parallel_planning import make_robot_state
+from planning_services import PlanningClientPool
+from reachability_map import ReachabilityMap, orientation_quaternions
+
+
+def check_voxel(client, group_name, eef_link, joint_names, seed_positions, center, quaternions, avoid_collisions):
+    # One IK request per orientation, every solution seeds the next one
+    reachable = []
+    seed = seed_positions
+    for q in quaternions:
+        pose = Pose()
+        pose.position.x, pose.position.y, pose.position.z = center
+        pose.orientation.x, pose.orientation.y, pose.orientation.z, pose.orientation.w = q
+
+        solution = client.compute_ik(group_name, eef_link, make_robot_state(joint_names, seed), pose, joint_names,
+                                     avoid_collisions=avoid_collisions, timeout=0.05, attempts=1)
+        reachable.append(solution is not None)
+        if solution is not None:
+            seed = solution
+
+    return reachable
+
+
+def build_map(pool, arm, args):
+    group_name = "arm_" + arm
+    move_group = MoveGroupCommander(group_name)
+    eef_link = move_group.get_end_effector_link()
+    joint_names = move_group.get_active_joints()
+    seed_positions = move_group.get_current_joint_values()
+
+    # Same orientations as the grasp search: roll depends on the arm, yaw around the object
+    roll = math.pi if arm == "left" else 0.0
+    orientations = sample_orientations(roll, 0.0, yaw_step=math.radians(args.yaw_step), tilt=args.tilt)
+    quaternions = orientation_quaternions(orientations).tolist()
+
+    origin = np.array(args.min, dtype=np.float64)
+    shape = np.ceil((np.array(args.max) - origin) / args.resolution).astype(int)
+    reachability_map = ReachabilityMap(origin, args.resolution, shape, orientations)
+
+    centers = reachability_map.voxel_centers()
+    indices = np.indices(reachability_map.shape).reshape(3, -1).T
+
+    rospy.loginfo(group_name + ": " + str(len(centers)) + " voxels x " + str(len(orientations)) + " orientations")
+
+    chunk = 1000
+    for start in xrange(0, len(centers), chunk):
+        if rospy.is_shutdown():
+            return
+
+        results = pool.map(check_voxel, [(group_name, eef_link, joint_names, seed_positions, center.tolist(),
+                                          quaternions, args.avoid_collisions)
+                                         for center in centers[start:start + chunk]])
+        for (index, reachable) in zip(indices[start:start + chunk], results):
+            reachability_map.set_voxel(index, reachable)
+
+        rospy.loginfo(group_name + ": " + str(min(start + chunk, len(centers))) + " / " + str(len(centers)))
+
+    filename = os.path.join(os.path.expanduser(args.output_dir), group_name + ".rmap")
+    reachability_map.save(filename)
+
+    reachable = reachability_map.reachable(centers)
+    rospy.loginfo(group_name + ": " + str(int(reachable.sum())) + " reachable voxels, saved to '" + filename + "'")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the IK reachability maps of the arms")
+    parser.add_argument("--arms", nargs="+", default=["left", "right"])
+    parser.add_argument("--output-dir", default="~/.ros/cob_grasping_app/reachability")
+    parser.add_argument("--resolution", type=float, default=0.05)
+    parser.add_argument("--min", type=float, nargs=3, default=[-0.2, -1.0, 0.2])
+    parser.add_argument("--max", type=float, nargs=3, default=[1.2, 1.0, 1.8])
+    parser.add_argument("--yaw-step", type=float, default=15.0, help="degrees")
+    parser.add_argument("--tilt", type=float, default=0.0, help="roll and pitch variation in rad")
+    parser.add_argument("--avoid-collisions", action="store_true",
+                        help="also reject solutions in collision with the current planning scene")
+    parser.add_argument("--planning-services", nargs="+", default=[""])
+    parser.add_argument("--clients", type=int, default=4, help="planning clients per namespace")
+    args = parser.parse_args(rospy.myargv()[1:])
+
+    rospy.init_node("build_reachability_map")
+
+    pool = PlanningClientPool(args.planning_services, args.clients)
+    pool.wait_for_services()
+
+    for arm in args.arms:
+        build_map(pool, arm, args)
+
+    pool.close()
+
+
+if __name__ == '__main__':
+    main()
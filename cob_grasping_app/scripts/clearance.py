@@ -0,0 +1,240 @@
+#!/usr/bin/python
+import numpy as np
+
+from shape_msgs.msg import SolidPrimitive
+from tf.transformations import quaternion_matrix
+
+from scene_updates import make_pose
+from shared_scene import MESH
+
+
+LEAF_SIZE = 8
+
+
+def pose_matrix(pose):
+    # geometry_msgs/Pose as 4x4 matrix
+    matrix = quaternion_matrix([pose.orientation.x, pose.orientation.y, pose.orientation.z, pose.orientation.w])
+    matrix[:3, 3] = [pose.position.x, pose.position.y, pose.position.z]
+    return matrix
+
+
+def dot(a, b):
+    return np.einsum("ij,ij->i", a, b)
+
+
+def point_triangle_distance(points, a, b, c):
+    # Distance of every point to its triangle (closest point by feature regions, Ericson 5.1.5), all (n x 3)
+    ab = b - a
+    ac = c - a
+    ap = points - a
+    bp = points - b
+    cp = points - c
+
+    d1 = dot(ab, ap)
+    d2 = dot(ac, ap)
+    d3 = dot(ab, bp)
+    d4 = dot(ac, bp)
+    d5 = dot(ab, cp)
+    d6 = dot(ac, cp)
+    va = d3 * d6 - d5 * d4
+    vb = d5 * d2 - d1 * d6
+    vc = d1 * d4 - d3 * d2
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Later regions take precedence, the face is the default
+        denominator = va + vb + vc
+        closest = a + ab * (vb / denominator)[:, np.newaxis] + ac * (vc / denominator)[:, np.newaxis]
+
+        mask = (va <= 0.0) & (d4 - d3 >= 0.0) & (d5 - d6 >= 0.0)
+        w = (d4 - d3) / ((d4 - d3) + (d5 - d6))
+        closest[mask] = (b + (c - b) * w[:, np.newaxis])[mask]
+
+        mask = (vb <= 0.0) & (d2 >= 0.0) & (d6 <= 0.0)
+        closest[mask] = (a + ac * (d2 / (d2 - d6))[:, np.newaxis])[mask]
+
+        mask = (d6 >= 0.0) & (d5 <= d6)
+        closest[mask] = c[mask]
+
+        mask = (vc <= 0.0) & (d1 >= 0.0) & (d3 <= 0.0)
+        closest[mask] = (a + ab * (d1 / (d1 - d3))[:, np.newaxis])[mask]
+
+        mask = (d3 >= 0.0) & (d4 <= d3)
+        closest[mask] = b[mask]
+
+        mask = (d1 <= 0.0) & (d2 <= 0.0)
+        closest[mask] = a[mask]
+
+    distance = np.sqrt(np.sum((points - closest) ** 2, axis=1))
+
+    # Degenerate triangles, only their corners are used
+    invalid = ~np.isfinite(distance)
+    if np.any(invalid):
+        distance[invalid] = np.sqrt(np.min([np.sum((points[invalid] - corner[invalid]) ** 2, axis=1)
+                                            for corner in [a, b, c]], axis=0))
+    return distance
+
+
+def aabb_distance(points, lower, upper):
+    # 0 inside the box
+    return np.sqrt(np.sum(np.maximum(np.maximum(lower - points, points - upper), 0.0) ** 2, axis=1))
+
+
+class TriangleBVH(object):
+    # Bounding volume hierarchy of axis aligned boxes over a triangle soup, split at the median of the longest
+    # axis. Nodes are stored in flat arrays, the triangles of a leaf are a range of the sorted triangle array.
+    def __init__(self, triangles, leaf_size=LEAF_SIZE):
+        triangles = np.asarray(triangles, dtype=np.float64).reshape(-1, 3, 3)
+        order = np.arange(len(triangles))
+        centers = triangles.mean(axis=1)
+        lower = triangles.min(axis=1)
+        upper = triangles.max(axis=1)
+
+        nodes = []  # [lower, upper, left, right, start, count]
+        stack = [(0, len(triangles), -1, 0)] if len(triangles) else []  # start, end, parent, side
+        while stack:
+            (start, end, parent, side) = stack.pop()
+            indices = order[start:end]
+            node = len(nodes)
+            nodes.append([lower[indices].min(axis=0), upper[indices].max(axis=0), -1, -1, start, end - start])
+            if parent >= 0:
+                nodes[parent][2 + side] = node
+
+            if end - start <= leaf_size:
+                continue
+
+            axis = int(np.argmax(nodes[node][1] - nodes[node][0]))
+            middle = (end - start) // 2
+            order[start:end] = indices[np.argpartition(centers[indices, axis], middle)]
+            stack.append((start + middle, end, node, 1))
+            stack.append((start, start + middle, node, 0))
+
+        self.triangles = triangles[order]
+        self.lower = np.array([entry[0] for entry in nodes]).reshape(-1, 3)
+        self.upper = np.array([entry[1] for entry in nodes]).reshape(-1, 3)
+        self.left = np.array([entry[2] for entry in nodes], dtype=np.int64)
+        self.right = np.array([entry[3] for entry in nodes], dtype=np.int64)
+        self.start = np.array([entry[4] for entry in nodes], dtype=np.int64)
+        self.count = np.array([entry[5] for entry in nodes], dtype=np.int64)
+
+    def distance(self, points, max_distance=np.inf, best=None):
+        # Distance of every point to the closest triangle, at most max_distance. All points traverse the tree
+        # together, a (point, node) pair is dropped as soon as the node is farther than the best distance so far.
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        if best is None:
+            best = np.full(len(points), max_distance, dtype=np.float64)
+        if len(self.triangles) == 0 or len(points) == 0:
+            return best
+
+        point_ids = np.arange(len(points))
+        node_ids = np.zeros(len(points), dtype=np.int64)
+        while len(point_ids):
+            keep = aabb_distance(points[point_ids], self.lower[node_ids], self.upper[node_ids]) < best[point_ids]
+            (point_ids, node_ids) = (point_ids[keep], node_ids[keep])
+
+            leaf = self.left[node_ids] < 0
+            if np.any(leaf):
+                counts = self.count[node_ids[leaf]]
+                pair_points = np.repeat(point_ids[leaf], counts)
+                offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+                triangles = self.triangles[np.repeat(self.start[node_ids[leaf]], counts) + offsets]
+                np.minimum.at(best, pair_points, point_triangle_distance(points[pair_points], triangles[:, 0],
+                                                                         triangles[:, 1], triangles[:, 2]))
+
+            (point_ids, node_ids) = (np.concatenate([point_ids[~leaf]] * 2),
+                                     np.concatenate([self.left[node_ids[~leaf]], self.right[node_ids[~leaf]]]))
+        return best
+
+
+class ClearanceMap(object):
+    # Clearance of points and straight segments in the collision world of a scene: the environment mesh (unsigned
+    # distance, it need not be closed) and the box obstacles (signed distance, negative inside). Built once per
+    # spawned scene, answers batches of points in NumPy without move_group.
+    def __init__(self, triangles, boxes=(), max_distance=1.0):
+        self.bvh = TriangleBVH(triangles)
+        self.max_distance = max_distance
+
+        # Box frames as inverse transforms and half extents
+        self.box_inverse = np.array([np.linalg.inv(matrix) for (matrix, size) in boxes]).reshape(-1, 4, 4)
+        self.box_half = np.array([np.asarray(size, dtype=np.float64) * 0.5 for (matrix, size) in boxes]).reshape(-1, 3)
+
+    @classmethod
+    def from_scene(cls, scene, mesh_arrays, spawn_obstacles, max_distance=1.0):
+        # mesh_arrays: scaled (vertices, triangles) of the environment mesh, e.g. from MeshCache.load
+        triangles = np.zeros((0, 3, 3))
+        if mesh_arrays is not None:
+            (vertices, indices) = mesh_arrays
+            matrix = pose_matrix(make_pose(scene.environment_pose))
+            vertices = np.dot(np.asarray(vertices, dtype=np.float64), matrix[:3, :3].T) + matrix[:3, 3]
+            triangles = vertices[np.asarray(indices, dtype=np.int64)]
+
+        boxes = []
+        for co_object in scene.obstacle_objects(spawn_obstacles):
+            for (primitive, pose) in zip(co_object.primitives, co_object.primitive_poses):
+                if primitive.type == SolidPrimitive.BOX:
+                    boxes.append((pose_matrix(pose), primitive.dimensions[:3]))
+
+        return cls(triangles, boxes, max_distance)
+
+    @classmethod
+    def from_shared_scene(cls, reader, exclude=(), max_distance=1.0):
+        # World objects of a SharedSceneReader except the excluded ids (e.g. the object to grasp), version is the
+        # scene version the map was built from
+        while True:
+            (version, shapes) = reader.snapshot()
+            shapes = shapes[~np.in1d(shapes["id"], list(exclude))]
+            triangles = [np.zeros((0, 3, 3))]
+            for shape in shapes[(shapes["type"] == MESH) & (shapes["link"] == "")]:
+                (vertices, indices) = reader.mesh(shape)
+                matrix = pose_matrix(make_pose(shape["pose"]))
+                vertices = np.dot(vertices, matrix[:3, :3].T) + matrix[:3, 3]
+                triangles.append(vertices[indices.astype(np.int64)])
+
+            (poses, dimensions) = reader.boxes(shapes)
+            boxes = [(pose_matrix(make_pose(pose)), size) for (pose, size) in zip(poses, dimensions)]
+
+            # The mesh buffers are read after the snapshot, they may have changed in between
+            if not reader.changed(version):
+                break
+
+        clearance_map = cls(np.concatenate(triangles), boxes, max_distance)
+        clearance_map.version = version
+        return clearance_map
+
+    def box_distance(self, points, max_distance):
+        # Signed distance to the closest box, at most max_distance
+        best = np.full(len(points), max_distance, dtype=np.float64)
+        for (inverse, half) in zip(self.box_inverse, self.box_half):
+            q = np.abs(np.dot(points, inverse[:3, :3].T) + inverse[:3, 3]) - half
+            outside = np.sqrt(np.sum(np.maximum(q, 0.0) ** 2, axis=1))
+            best = np.minimum(best, outside + np.minimum(np.max(q, axis=1), 0.0))
+        return best
+
+    def point_clearance(self, points, max_distance=None):
+        # Distance to the closest obstacle, negative inside a box, at most max_distance. The smaller max_distance,
+        # the fewer nodes are visited.
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        best = self.box_distance(points, self.max_distance if max_distance is None else max_distance)
+        return self.bvh.distance(points, best=np.maximum(best, 0.0)) + np.minimum(best, 0.0)
+
+    def segment_clearance(self, starts, ends, step=0.01, max_distance=None):
+        # Lower bound of the clearance along every segment, sampled every step m
+        starts = np.asarray(starts, dtype=np.float64).reshape(-1, 3)
+        ends = np.asarray(ends, dtype=np.float64).reshape(-1, 3)
+        lengths = np.sqrt(np.sum((ends - starts) ** 2, axis=1))
+        samples = np.maximum(np.ceil(lengths / step).astype(np.int64), 1) + 1
+
+        segment_ids = np.repeat(np.arange(len(starts)), samples)
+        fractions = (np.arange(samples.sum()) - np.repeat(np.cumsum(samples) - samples, samples)) / \
+            np.repeat(samples - 1, samples).astype(np.float64)
+        points = starts[segment_ids] + (ends - starts)[segment_ids] * fractions[:, np.newaxis]
+
+        clearance = np.full(len(starts), np.inf)
+        np.minimum.at(clearance, segment_ids, self.point_clearance(points, max_distance))
+        # A point between two samples is at most half a sample distance away from one of them
+        return clearance - 0.5 * lengths / (samples - 1)
+
+    def points_clear(self, points, margin=0.0):
+        return self.point_clearance(points, margin) >= margin
+
+    def segments_clear(self, starts, ends, margin=0.0, step=0.01):
+        return self.segment_clearance(starts, ends, step, margin + step) >= margin
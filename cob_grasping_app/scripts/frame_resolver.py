@@ -0,0 +1,61 @@
+#!/usr/bin/python
+import numpy as np
+
+import rospy
+from geometry_msgs.msg import Pose
+from tf.transformations import euler_matrix, quaternion_from_matrix, quaternion_matrix
+
+
+def frame_matrix(position, rpy):
+    # 4x4 homogeneous transform of a frame at position (geometry_msgs/Point) with roll, pitch, yaw
+    matrix = euler_matrix(rpy[0], rpy[1], rpy[2])
+    matrix[:3, 3] = [position.x, position.y, position.z]
+    return matrix
+
+
+def transform_offsets(matrix, offsets):
+    # Transforms all (x, y, z) offsets at once, the poses keep the orientation of the frame
+    offsets = np.asarray(offsets, dtype=np.float64).reshape(-1, 3)
+    positions = offsets.dot(matrix[:3, :3].T) + matrix[:3, 3]
+    q = quaternion_from_matrix(matrix)
+
+    poses = []
+    for (x, y, z) in positions.tolist():
+        pose = Pose()
+        pose.position.x = x
+        pose.position.y = y
+        pose.position.z = z
+        pose.orientation.x = q[0]
+        pose.orientation.y = q[1]
+        pose.orientation.z = q[2]
+        pose.orientation.w = q[3]
+        poses.append(pose)
+
+    return poses
+
+
+class FrameResolver(object):
+    # Resolves poses relative to a frame in the base frame. Frames that are computed in this process are registered
+    # with a function that returns their matrix, only all other frames are looked up with TF.
+    def __init__(self, tf_listener=None, base_frame="base_link"):
+        self.tf_listener = tf_listener
+        self.base_frame = base_frame
+        self.frames = {}
+
+    def register(self, frame_id, matrix_func):
+        self.frames[frame_id] = matrix_func
+
+    def matrix(self, frame_id, *args):
+        if frame_id in self.frames:
+            return self.frames[frame_id](*args)
+
+        if self.tf_listener is None:
+            raise ValueError("Unknown frame '" + frame_id + "'")
+
+        (translation, rotation) = self.tf_listener.lookupTransform(self.base_frame, frame_id, rospy.Time(0))
+        matrix = quaternion_matrix(rotation)
+        matrix[:3, 3] = translation
+        return matrix
+
+    def poses(self, frame_id, offsets, *args):
+        return transform_offsets(self.matrix(frame_id, *args), offsets)
@@ -0,0 +1,60 @@
+#!/usr/bin/python
+import math
+
+import numpy as np
+
+import rospy
+from parallel_planning import make_robot_state
+
+
+def sample_orientations(roll, pitch, yaw_limit=0.5 * math.pi, yaw_step=(5.0 / 180.0) * math.pi, tilt=0.0):
+    # All (roll, pitch, yaw) candidates in the range the incremental retry covers. With tilt, roll and pitch are
+    # varied by -tilt, 0, +tilt as well.
+    steps = int(round(yaw_limit / yaw_step))
+    yaw = np.linspace(-steps * yaw_step, steps * yaw_step, 2 * steps + 1)
+    offsets = np.array([-tilt, 0.0, tilt]) if tilt > 0.0 else np.zeros(1)
+
+    grid = np.meshgrid(roll + offsets, pitch + offsets, yaw, indexing='ij')
+    return np.column_stack([axis.ravel() for axis in grid])
+
+
+class GraspSearch(object):
+    # Ranks grasp orientations before they are planned. Every candidate needs a collision free IK solution for all
+    # of its poses, the solutions are chained like the planned segments. The cost is the joint distance of the
+    # chain plus a penalty for the rotation away from the original orientation.
+    def __init__(self, pool, max_candidates=5, rotation_weight=0.5):
+        self.pool = pool
+        self.max_candidates = max_candidates
+        self.rotation_weight = rotation_weight
+
+    def chain_cost(self, client, group_name, eef_link, joint_names, start_positions, poses, attached_objects):
+        seed = np.asarray(start_positions, dtype=np.float64)
+        cost = 0.0
+
+        for (pose, attached) in zip(poses, attached_objects):
+            solution = client.compute_ik(group_name, eef_link, make_robot_state(joint_names, seed, attached), pose,
+                                         joint_names)
+            if solution is None:
+                return None
+
+            solution = np.asarray(solution, dtype=np.float64)
+            cost += np.linalg.norm(solution - seed)
+            seed = solution
+
+        return cost
+
+    def rank(self, group_name, eef_link, joint_names, start_positions, orientations, reference, candidate_poses,
+             attached_objects):
+        # candidate_poses holds the poses of every orientation, attached_objects the attached objects per pose
+        costs = np.array([cost if cost is not None else np.inf for cost in self.pool.map(
+            self.chain_cost, [(group_name, eef_link, joint_names, start_positions, poses, attached_objects)
+                              for poses in candidate_poses])])
+
+        rotation = np.abs(np.asarray(orientations) - np.asarray(reference)).sum(axis=1)
+        costs += self.rotation_weight * rotation
+
+        order = [i for i in np.argsort(costs, kind='mergesort') if np.isfinite(costs[i])][:self.max_candidates]
+
+        rospy.loginfo("Grasp search: " + str(int(np.isfinite(costs).sum())) + " of " + str(len(orientations)) +
+                      " orientations reachable")
+        return [orientations[i].tolist() for i in order]
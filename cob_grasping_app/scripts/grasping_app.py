@@ -1,9 +1,11 @@
 #!/usr/bin/python
+import numpy as np
+import os
 import rospkg
+import time
 import unittest
 import yaml
 from copy import copy
-from pyassimp import pyassimp
 from re import findall
 from subprocess import call
 
@@ -12,116 +14,164 @@ import rostopic
 import smach
 import tf
 from atf_recorder import RecordingManager
+from adaptive_cartesian import AdaptiveCartesianPlanner
+from attachments import AttachmentManager
+from clearance import ClearanceMap
+from frame_resolver import FrameResolver, frame_matrix
+from geometry_msgs.msg import Pose
+from grasp_search import GraspSearch, sample_orientations
 from interactive_markers.interactive_marker_server import *
 from interactive_markers.menu_handler import *
+from joint_roadmap import JointRoadmap
+from latency_metrics import NULL_SPAN, LatencyRecorder
+from mesh_loader import MeshCache
 from moveit_commander import MoveGroupCommander, PlanningSceneInterface
-from moveit_msgs.msg import RobotState, AttachedCollisionObject, CollisionObject, PlanningScene, RobotTrajectory
-from shape_msgs.msg import MeshTriangle, Mesh, SolidPrimitive
+from moveit_msgs.msg import RobotState, CollisionObject, PlanningScene, RobotTrajectory
+from parallel_planning import ParallelSegmentPlanner, Segment
+from path_simplification import LeverArms, PathSimplifier
+from plan_prefetch import PlanPrefetcher
+from planner_statistics import PlannerSelector, PlannerStatistics
+from planning_services import PlanningClient, PlanningClientPool
+from portfolio_planning import PortfolioPlanner
+from reachability_map import ReachabilityMap
+from scene_model import SceneCatalogue
+from scene_updates import PlanningSceneClient, scene_diff
+from shape_msgs.msg import SolidPrimitive
+from shared_scene import SharedSceneWriter
 from simple_script_server import *
-from visualization_msgs.msg import InteractiveMarkerControl, Marker
+from trajectory_cache import TrajectoryCache, TrajectoryValidator
+from trajectory_processing import SMOOTHING_OFFSET, JointLimits, concatenate_trajectories, process_trajectory
+from visualization_msgs.msg import InteractiveMarkerControl
 
 
-def smooth_cartesian_path(traj):
-    time_offset = 200000000  # 0.2s
+def simplify_path(group_name=None, attached_objects=()):
+    # Path simplification step of process_trajectory, shortcuts only with a group to check them for
+    if path_simplifier is None:
+        return None
+    return lambda arrays: path_simplifier.simplify(arrays, group_name, attached_objects)
 
-    for i in xrange(len(traj.joint_trajectory.points)):
-        traj.joint_trajectory.points[i].time_from_start += rospy.Duration(0, time_offset)
 
-    traj.joint_trajectory.points[-1].time_from_start += rospy.Duration(0, time_offset)
+def postprocess_linear_plan(traj, eef_link):
+    # Linear segments have to stay on their line: no shortcuts, points are only dropped within the joint tolerance
+    # that keeps eef_link within linear_decimation_tolerance of the planned path. Retimed at the full joint limits
+    # like compute_cartesian_path does.
+    simplify = None
+    if path_simplifier is not None and path_simplifier.linear_tolerance is not None:
+        simplify = lambda arrays: path_simplifier.decimate_linear(arrays, eef_link)
 
-    return traj
+    if joint_limits is None:
+        return traj if simplify is None else process_trajectory(traj, simplify=simplify)
+    return process_trajectory(traj, limits=joint_limits.limits(traj.joint_trajectory.joint_names), simplify=simplify)
 
 
-def fix_velocities(traj):
-    # fix trajectories to stop at the end
-    traj.joint_trajectory.points[-1].velocities = [0] * 7
+def postprocess_plan(traj, speed, group_name=None, attached_objects=()):
+    # Smoothing offsets and speed scaling in one pass, with retiming the speed scales the limits
+    simplify = simplify_path(group_name, attached_objects)
+    if joint_limits is not None:
+        return process_trajectory(traj, time_offset=SMOOTHING_OFFSET, end_offset=SMOOTHING_OFFSET,
+                                  limits=joint_limits.limits(traj.joint_trajectory.joint_names, speed),
+                                  simplify=simplify)
+    return process_trajectory(traj, time_offset=SMOOTHING_OFFSET, end_offset=SMOOTHING_OFFSET, speed=speed,
+                              simplify=simplify)
 
-    # fix trajectories to be slower
-    speed_factor = 1.0
-    for i in xrange(len(traj.joint_trajectory.points)):
-        traj.joint_trajectory.points[i].time_from_start *= speed_factor
 
-    return traj
+def timed(kind, name, retries=0):
+    # Span of the latency recorder, does nothing if it is disabled
+    if latency_metrics is None:
+        return NULL_SPAN
+    return latency_metrics.span(kind, name, retries)
 
 
-def scale_joint_trajectory_speed(traj, scale):
-    # Create a new trajectory object
-    new_traj = RobotTrajectory()
+def record_planning(segment, arm, planner_id, success, start):
+    if planner_statistics is not None and segment is not None:
+        planner_statistics.record(segment, arm, planner_id, success, time.time() - start)
 
-    # Initialize the new trajectory to be the same as the planned trajectory
-    new_traj.joint_trajectory = traj.joint_trajectory
 
-    # Get the number of joints involved
-    n_joints = len(traj.joint_trajectory.joint_names)
+def statistics_recorder(arm):
+    # record(segment, planner_id, success, latency) for the portfolio and parallel planners, None without statistics
+    if planner_statistics is None:
+        return None
 
-    # Get the number of points on the trajectory
-    n_points = len(traj.joint_trajectory.points)
+    def record(segment, planner_id, success, latency):
+        planner_statistics.record(segment, arm, planner_id, success, latency)
+    return record
 
-    # Store the trajectory points
-    points = list(traj.joint_trajectory.points)
 
-    # Cycle through all points and scale the time from start, speed and acceleration
-    for i in xrange(n_points):
-        point = JointTrajectoryPoint()
-        point.time_from_start = traj.joint_trajectory.points[i].time_from_start / scale
-        point.velocities = list(traj.joint_trajectory.points[i].velocities)
-        point.accelerations = list(traj.joint_trajectory.points[i].accelerations)
-        point.positions = traj.joint_trajectory.points[i].positions
+def plan_selected(planer, group_name=None, segment=None, planner_id=""):
+    # planer.plan() with the planner chosen for the segment, planner_id (the one set on the planer) without planner
+    # selection. The call is recorded in the planner statistics.
+    arm = None if group_name is None else group_name.replace("arm_", "")
+    if planner_selector is not None and arm is not None and segment is not None:
+        planner_id = planner_selector.select(segment, arm)
+        planer.set_planner_id(planner_id)
 
-        for j in xrange(n_joints):
-            point.velocities[j] = point.velocities[j] * scale
-            point.accelerations[j] = point.accelerations[j] * scale * scale
+    start = time.time()
+    traj = planer.plan()
+    if arm is not None:
+        record_planning(segment, arm, planner_id, len(traj.joint_trajectory.points) > 0, start)
+    return traj
 
-        points[i] = point
 
-    # Assign the modified points to the new trajectory
-    new_traj.joint_trajectory.points = points
+def plan_joint_target(planer, start_state, goal_positions, group_name=None, segment=None, planner_id=""):
+    # planer.plan() to a joint target, raced over the planner portfolio if it is enabled. Like plan() an empty
+    # trajectory is returned if planning failed.
+    if portfolio_planner is None or group_name is None:
+        planer.set_start_state(start_state)
 
-    # Return the new trajecotry
-    return new_traj
+        planer.clear_pose_targets()
+        planer.set_joint_value_target(goal_positions)
 
+        return plan_selected(planer, group_name, segment, planner_id)
 
-def plan_movement(planer, start_pose, goal_pose, speed):
-    planer.set_start_state(start_pose)
+    traj = portfolio_planner.plan(group_name, start_state, start_state.joint_state.name, goal_positions, segment,
+                                  statistics_recorder(group_name.replace("arm_", "")))
+    return RobotTrajectory() if traj is None else traj
 
-    planer.clear_pose_targets()
-    planer.set_joint_value_target(goal_pose)
 
-    plan = planer.plan()
+def plan_movement(planer, start_pose, goal_pose, speed, group_name=None, segment=None, planner_id=""):
+    plan = plan_joint_target(planer, start_pose, goal_pose, group_name, segment, planner_id)
 
-    plan = smooth_cartesian_path(plan)
-    plan = scale_joint_trajectory_speed(plan, speed)
+    plan = postprocess_plan(plan, speed, group_name, start_pose.attached_collision_objects)
     return plan
 
 
+def plan_roadmap_movement(planer, arm, start_state, goal_name, goal_positions, speed, segment=None, planner_id=""):
+    # plan_movement between named configurations, answered from the joint roadmap if the arm is at one of its nodes
+    if joint_roadmap is None:
+        return plan_movement(planer, start_state, goal_positions, speed, "arm_" + arm, segment, planner_id)
+
+    start_name = joint_roadmap.node_at(arm, start_state.joint_state.position)
+    if start_name is not None:
+        plan = joint_roadmap.lookup(arm, start_name, goal_name, start_state.attached_collision_objects)
+        if plan is not None:
+            rospy.loginfo("Trajectory " + start_name + " -> " + goal_name + " from roadmap")
+            # The arm is only within the roadmap tolerance of the node
+            plan.joint_trajectory.points[0].positions = list(start_state.joint_state.position)
+            return postprocess_plan(plan, speed, "arm_" + arm, start_state.attached_collision_objects)
+
+    plan = plan_joint_target(planer, start_state, goal_positions, "arm_" + arm, segment, planner_id)
+    traj = postprocess_plan(plan, speed, "arm_" + arm, start_state.attached_collision_objects)
+
+    # The roadmap keeps the unprocessed plan, the speed is applied whenever it is used
+    joint_roadmap.add_node(arm, goal_name, goal_positions)
+    if start_name is not None:
+        joint_roadmap.add_edge(arm, start_name, goal_name,
+                               [attached.object.id for attached in start_state.attached_collision_objects], plan)
+    return traj
+
+
 def add_remove_object(co_operation, co_object, co_position, co_type):
+    transaction = scene_client.transaction()
+
     if co_operation == "add":
-        co_object.operation = CollisionObject.ADD
-        pose = Pose()
-        pose.position.x = co_position[0]
-        pose.position.y = co_position[1]
-        pose.position.z = co_position[2]
-        pose.orientation.x = co_position[3]
-        pose.orientation.y = co_position[4]
-        pose.orientation.z = co_position[5]
-        pose.orientation.w = co_position[6]
-
-        if co_type == "mesh":
-            co_object.mesh_poses.append(pose)
-        elif co_type == "primitive":
-            co_object.primitive_poses.append(pose)
-        else:
-            rospy.logerr("Invalid type")
+        transaction.add(co_object, co_position, co_type)
     elif co_operation == "remove":
-        co_object.operation = CollisionObject.REMOVE
-        planning_scene.world.collision_objects[:] = []
+        transaction.remove(co_object.id)
     else:
         rospy.logerr("Invalid command")
         return
 
-    planning_scene.world.collision_objects.append(co_object)
-    pub_planning_scene.publish(planning_scene)
-    rospy.sleep(0.1)
+    transaction.commit()
 
 
 class SceneManager(smach.State):
@@ -148,11 +198,19 @@ class SceneManager(smach.State):
 
         self.server = InteractiveMarkerServer("grasping_targets")
         self.menu_handler = MenuHandler()
+        self.marker_names = set()  # markers on the server, updated on every scene switch
 
         # ---- LOAD DATA ----
-        self.scene_data = self.load_data(self.path_scene)
+        rospy.loginfo("Reading data from yaml file...")
+        self.scenes = SceneCatalogue.load(self.path_scene, rospkg.RosPack().get_path("cob_grasping_app"))
+        self.mesh_cache = MeshCache(rospy.get_param(rospy.get_name() + "/mesh_cache_dir",
+                                                    "~/.ros/cob_grasping_app/mesh_cache"))
         self.positions_changed = False
 
+        # Targets are checked against the environment mesh and the obstacles before they are planned
+        self.clearance_check = rospy.get_param(rospy.get_name() + "/clearance_check", False)
+        self.clearance_maps = {}  # fingerprint -> ClearanceMap
+
         # ---- BUILD MENU ----
         self.menu_handler.insert("Start execution", callback=self.start_planning)
         self.menu_handler.insert("Stopp execution", callback=self.stop_planning)
@@ -161,7 +219,7 @@ class SceneManager(smach.State):
         env_entry = self.menu_handler.insert("Environment")
 
         env_menu_id = 4
-        for i, item in enumerate(sorted(self.scene_data)):
+        for i, item in enumerate(self.scenes):
             if item == self.scenario:
                 self.menu_handler.setCheckState(self.menu_handler.insert(item, callback=self.change_environment,
                                                                          parent=env_entry), MenuHandler.CHECKED)
@@ -198,59 +256,28 @@ class SceneManager(smach.State):
             self.start_manipulation.wait()
             self.start_manipulation.clear()
 
+            # Unreachable targets have to be moved before the manipulation starts
+            while not self.exit and not self.targets_reachable():
+                rospy.logerr("Move the unreachable targets and click start again")
+                self.start_manipulation.wait()
+                self.start_manipulation.clear()
+
+        elif not self.targets_reachable():
+            rospy.logwarn("Starting with unreachable targets")
+
         if self.exit:
             return "exit"
 
+        scene = self.scenes[self.scenario]
+
         # ---- SET ACTIVE ARM ----
-        userdata.active_arm = self.scene_data[self.scenario]["positions"]["arm"]
+        userdata.active_arm = scene.arm
 
+        # ---- POSITIONS ----
         if self.planning_method != "joint":
+            userdata.arm_positions.update(scene.arm_positions())
 
-            # ---- POSITIONS FOR RIGHT ARM ----
-            waypoints_r = []
-            if len(self.scene_data[self.scenario]["positions"]["waypoint_r"]) != 0:
-                for item in self.scene_data[self.scenario]["positions"]["waypoint_r"]:
-                    waypoints_r.append(Point(item[0], item[1], item[2]))
-
-            userdata.arm_positions["right"] = {"start": Point(self.scene_data[self.scenario]["positions"]["start_r"][0],
-                                                              self.scene_data[self.scenario]["positions"]["start_r"][1],
-                                                              self.scene_data[self.scenario]["positions"]["start_r"][2]
-                                                              ),
-                                               "waypoints": waypoints_r,
-                                               "goal": Point(self.scene_data[self.scenario]["positions"]["goal_r"][0],
-                                                             self.scene_data[self.scenario]["positions"]["goal_r"][1],
-                                                             self.scene_data[self.scenario]["positions"]["goal_r"][2]
-                                                             )
-                                               }
-
-            # ---- POSITIONS FOR LEFT ARM ----
-            waypoints_l = []
-            if len(self.scene_data[self.scenario]["positions"]["waypoint_l"]) != 0:
-                for item in self.scene_data[self.scenario]["positions"]["waypoint_l"]:
-                    waypoints_l.append(Point(item[0], item[1], item[2]))
-
-            userdata.arm_positions["left"] = {"start": Point(self.scene_data[self.scenario]["positions"]["goal_r"][0],
-                                                             self.scene_data[self.scenario]["positions"]["goal_r"][1],
-                                                             self.scene_data[self.scenario]["positions"]["goal_r"][2]),
-                                              "waypoints": waypoints_l,
-                                              "goal": Point(self.scene_data[self.scenario]["positions"]["goal_l"][0],
-                                                            self.scene_data[self.scenario]["positions"]["goal_l"][1],
-                                                            self.scene_data[self.scenario]["positions"]["goal_l"][2]
-                                                            )
-                                              }
-
-            userdata.arm_positions["poses"] = [self.scene_data[self.scenario]["poses"]["start"],
-                                               self.scene_data[self.scenario]["poses"]["end"]]
-
-        else:
-            userdata.arm_positions["poses"] = [self.scene_data[self.scenario]["poses"]["start"],
-                                               self.scene_data[self.scenario]["poses"]["approach"],
-                                               self.scene_data[self.scenario]["poses"]["grasp"],
-                                               self.scene_data[self.scenario]["poses"]["lift"],
-                                               self.scene_data[self.scenario]["poses"]["move"],
-                                               self.scene_data[self.scenario]["poses"]["drop"],
-                                               self.scene_data[self.scenario]["poses"]["retreat"],
-                                               self.scene_data[self.scenario]["poses"]["end"]]
+        userdata.arm_positions["poses"] = scene.pose_names(self.planning_method)
 
         # ---- SWITCH ARM ----
         userdata.switch_arm = self.switch_arm
@@ -261,58 +288,60 @@ class SceneManager(smach.State):
             self.positions_changed = False
 
         # ---- OBJECT INFORMATIONS ----
-        userdata.object = self.scene_data[self.scenario]["object"]
+        userdata.object = scene.object
 
         return "succeeded"
 
+    def targets(self):
+        # (arm, marker name, position) of every cartesian target, the left arm starts at the right arm goal
+        scene = self.scenes[self.scenario]
+        targets = [("right", "right_arm_start", scene.positions["start_r"]),
+                   ("right", "right_arm_goal", scene.positions["goal_r"]),
+                   ("left", "right_arm_goal", scene.positions["goal_r"]),
+                   ("left", "left_arm_goal", scene.positions["goal_l"])]
+        if self.use_waypoints:
+            for (arm, name) in [("right", "waypoint_r"), ("left", "waypoint_l")]:
+                targets += [(arm, name + str(i + 1), item) for (i, item) in enumerate(scene.waypoints[name])]
+
+        return targets
+
     @staticmethod
-    def load_data(filename):
-        rospy.loginfo("Reading data from yaml file...")
+    def is_reachable(arm, position):
+        if arm not in reachability_maps:
+            return True
 
-        with open(filename, 'r') as stream:
-            doc = yaml.load(stream)
+        if isinstance(position, Point):
+            position = [position.x, position.y, position.z]
+        return reachability_maps[arm].reachable([position])[0]
 
-        return doc
+    def targets_reachable(self):
+        if self.planning_method == "joint" or len(reachability_maps) == 0:
+            return True
+
+        # The second arm is only used when the arms are switched
+        used_arms = ["left", "right"] if self.switch_arm else [self.scenes[self.scenario].arm]
+
+        reachable = True
+        for (arm, target_name, position) in self.targets():
+            if arm in used_arms and not self.is_reachable(arm, position):
+                rospy.logerr("Target " + target_name + " is not reachable with the " + arm + " arm")
+                reachable = False
+
+        return reachable
 
     def save_data(self, filename):
         rospy.loginfo("Writing data to yaml file...")
-        stream = file(filename, 'w')
-        yaml.dump(self.scene_data, stream)
-
-    @staticmethod
-    def load_mesh(filename, scale):
+        self.scenes.save(filename)
 
-        scene = pyassimp.load(filename)
-        if not scene.meshes:
-            rospy.logerr('Unable to load mesh')
+    def load_mesh(self, filename, scale):
+        try:
+            return self.mesh_cache.mesh(filename, scale)
+        except (IOError, OSError, ValueError), e:
+            rospy.logerr('Unable to load mesh: ' + str(e))
             return
 
-        mesh = Mesh()
-        for face in scene.meshes[0].faces:
-            triangle = MeshTriangle()
-            if len(face.indices) == 3:
-                triangle.vertex_indices = [face.indices[0], face.indices[1], face.indices[2]]
-            mesh.triangles.append(triangle)
-        for vertex in scene.meshes[0].vertices:
-            point = Point()
-            point.x = vertex[0] * scale
-            point.y = vertex[1] * scale
-            point.z = vertex[2] * scale
-            mesh.vertices.append(point)
-        pyassimp.release(scene)
-
-        return mesh
-
     def make_box(self, color):
-        marker = Marker()
-
-        marker.type = self.scene_data[self.scenario]["object"]["shape"]
-        marker.scale.x = self.scene_data[self.scenario]["object"]["dimension"][0]  # Diameter in x
-        marker.scale.y = self.scene_data[self.scenario]["object"]["dimension"][1]  # Diameter in y
-        marker.scale.z = self.scene_data[self.scenario]["object"]["dimension"][2]  # Height
-        marker.color = color
-
-        return marker
+        return self.scenes[self.scenario].marker_template(color)
 
     def make_boxcontrol(self, msg, color):
         control = InteractiveMarkerControl()
@@ -339,32 +368,30 @@ class SceneManager(smach.State):
     def process_feedback(self, feedback):
         if feedback.event_type == InteractiveMarkerFeedback.MOUSE_UP:
             name = ''.join(i for i in feedback.marker_name if not i.isdigit())
+            scene = self.scenes[self.scenario]
+            position = [feedback.pose.position.x, feedback.pose.position.y, feedback.pose.position.z]
             if feedback.marker_name == "right_arm_start":
-                self.scene_data[self.scenario]["positions"]["start_r"] = [feedback.pose.position.x,
-                                                                          feedback.pose.position.y,
-                                                                          feedback.pose.position.z]
+                scene.set_position("start_r", position)
             elif feedback.marker_name == "right_arm_goal":
-                self.scene_data[self.scenario]["positions"]["goal_r"] = [feedback.pose.position.x,
-                                                                         feedback.pose.position.y,
-                                                                         feedback.pose.position.z]
+                scene.set_position("goal_r", position)
             elif feedback.marker_name == "left_arm_goal":
-                self.scene_data[self.scenario]["positions"]["goal_l"] = [feedback.pose.position.x,
-                                                                         feedback.pose.position.y,
-                                                                         feedback.pose.position.z]
+                scene.set_position("goal_l", position)
             elif "waypoint_" in name:
                 numbers = []
                 for s in feedback.marker_name:
                     numbers = findall("[-+]?\d+[\.]?\d*", s)
 
                 number = int(numbers[0]) - 1
-                self.scene_data[self.scenario]["positions"][name][number] = [feedback.pose.position.x,
-                                                                             feedback.pose.position.y,
-                                                                             feedback.pose.position.z]
+                scene.set_waypoint(name, number, position)
 
             rospy.loginfo("Position " + feedback.marker_name + ": x = " + str(feedback.pose.position.x) +
                           " | y = " + str(feedback.pose.position.y) + " | z = " + str(feedback.pose.position.z))
             self.server.applyChanges()
 
+            for (arm, target_name, position) in self.targets():
+                if target_name == feedback.marker_name and not self.is_reachable(arm, position):
+                    rospy.logwarn("Position " + feedback.marker_name + " is not reachable with the " + arm + " arm")
+
             self.positions_changed = True
 
     def add_waypoint(self, feedback):
@@ -372,16 +399,18 @@ class SceneManager(smach.State):
         color = ColorRGBA(0.0, 0.0, 1.0, 1.0)
         name = ""
 
+        scene = self.scenes[self.scenario]
         if "right" in self.menu_handler.getTitle(feedback.menu_entry_id):
-            name = "waypoint_r" + str(len(self.scene_data[self.scenario]["positions"]["waypoint_r"]) + 1)
-            self.scene_data[self.scenario]["positions"]["waypoint_r"].append(position)
+            name = "waypoint_r" + str(len(scene.waypoints["waypoint_r"]) + 1)
+            scene.add_waypoint("waypoint_r", [position.x, position.y, position.z])
 
         elif "left" in self.menu_handler.getTitle(feedback.menu_entry_id):
-            name = "waypoint_l" + str(len(self.scene_data[self.scenario]["positions"]["waypoint_l"]) + 1)
-            self.scene_data[self.scenario]["positions"]["waypoint_l"].append(position)
+            name = "waypoint_l" + str(len(scene.waypoints["waypoint_l"]) + 1)
+            scene.add_waypoint("waypoint_l", [position.x, position.y, position.z])
 
         # Add marker to scene
         self.make_marker(name, color, InteractiveMarkerControl.MOVE_3D, position)
+        self.marker_names.add(name)
 
         self.menu_handler.reApply(self.server)
         self.server.applyChanges()
@@ -397,9 +426,10 @@ class SceneManager(smach.State):
         numbers = []
 
         if "waypoint_" in wp_name:
+            scene = self.scenes[self.scenario]
 
             # Delete all waypoints
-            for i in xrange(0, len(self.scene_data[self.scenario]["positions"][name])):
+            for i in xrange(0, len(scene.waypoints[name])):
                 self.server.erase(name + str(i + 1))
             self.server.applyChanges()
 
@@ -407,16 +437,13 @@ class SceneManager(smach.State):
             for s in wp_name:
                 numbers = findall("[-+]?\d+[\.]?\d*", s)
             number = int(numbers[0]) - 1
-            del self.scene_data[self.scenario]["positions"][name][number]
+            scene.delete_waypoint(name, number)
+            self.marker_names.discard(name + str(len(scene.waypoints[name]) + 1))
 
             # Build remaining waypoints
             color = ColorRGBA(0.0, 0.0, 1.0, 1.0)
-            if len(self.scene_data[self.scenario]["positions"][name]) != 0:
-                for i in xrange(0, len(self.scene_data[self.scenario]["positions"][name])):
-                    self.make_marker(name + str(i + 1), color, InteractiveMarkerControl.MOVE_3D,
-                                     Point(self.scene_data[self.scenario]["positions"][name][i][0],
-                                           self.scene_data[self.scenario]["positions"][name][i][1],
-                                           self.scene_data[self.scenario]["positions"][name][i][2]))
+            for (i, point) in enumerate(scene.waypoint_points[name]):
+                self.make_marker(name + str(i + 1), color, InteractiveMarkerControl.MOVE_3D, point)
 
             self.menu_handler.reApply(self.server)
             self.server.applyChanges()
@@ -467,128 +494,98 @@ class SceneManager(smach.State):
             self.spawn_environment()
 
     def spawn_environment(self):
-        # Clear environment
-        self.clear_environment()
+        # Only the difference to the current collision world is sent, as one planning scene diff: objects of the
+        # previous scene are removed, obstacles with the same id and geometry are moved or kept
+        global spawned_scene
+
+        transaction = scene_client.transaction()
 
-        # Spawn environment
         rospy.loginfo("Spawning environment '" + self.scenario + "'")
 
-        environment = CollisionObject()
-        environment.id = self.scenario
-        environment.header.stamp = rospy.Time.now()
-        environment.header.frame_id = "base_link"
-        filename = rospkg.RosPack().get_path("cob_grasping_app") + self.scene_data[self.scenario]["environment"]["mesh"]
-        scale = self.scene_data[self.scenario]["environment"]["scaling"]
-        environment.meshes.append(self.load_mesh(filename, scale))
-
-        q = quaternion_from_euler((self.scene_data[self.scenario]["environment"]["orientation"][0] / 180.0) * math.pi,
-                                  (self.scene_data[self.scenario]["environment"]["orientation"][1] / 180.0) * math.pi,
-                                  (self.scene_data[self.scenario]["environment"]["orientation"][2] / 180.0) * math.pi)
-
-        position = [self.scene_data[self.scenario]["environment"]["position"][0],
-                    self.scene_data[self.scenario]["environment"]["position"][1],
-                    self.scene_data[self.scenario]["environment"]["position"][2],
-                    q[0], q[1], q[2], q[3]]
-
-        add_remove_object("add", copy(environment), position, "mesh")
-
-        if len(self.scene_data[self.scenario]["environment"]["additional_obstacles"]) != 0 \
-                and self.spawn_obstacles != "none":
-            for item in self.scene_data[self.scenario]["environment"]["additional_obstacles"]:
-                if self.spawn_obstacles == "all":
-                    collision_object = CollisionObject()
-                    collision_object.header.stamp = rospy.Time.now()
-                    collision_object.header.frame_id = "base_link"
-                    collision_object.id = item["id"]
-                    object_shape = SolidPrimitive()
-                    object_shape.type = item["shape"]
-                    object_shape.dimensions.append(item["size"][0])  # X
-                    object_shape.dimensions.append(item["size"][1])  # Y
-                    object_shape.dimensions.append(item["size"][2])  # Z
-                    collision_object.primitives.append(object_shape)
-
-                    q = quaternion_from_euler((item["orientation"][0] / 180.0) * math.pi,
-                                              (item["orientation"][1] / 180.0) * math.pi,
-                                              (item["orientation"][2] / 180.0) * math.pi)
-
-                    position = [item["position"][0], item["position"][1], item["position"][2], q[0], q[1], q[2], q[3]]
-                    add_remove_object("add", collision_object, position, "primitive")
-
-                elif item["id"] == self.spawn_obstacles:
-                    collision_object = CollisionObject()
-                    collision_object.header.stamp = rospy.Time.now()
-                    collision_object.header.frame_id = "base_link"
-                    collision_object.id = item["id"]
-                    object_shape = SolidPrimitive()
-                    object_shape.type = item["shape"]
-                    object_shape.dimensions.append(item["size"][0])  # X
-                    object_shape.dimensions.append(item["size"][1])  # Y
-                    object_shape.dimensions.append(item["size"][2])  # Z
-                    collision_object.primitives.append(object_shape)
-
-                    q = quaternion_from_euler((item["orientation"][0] / 180.0) * math.pi,
-                                              (item["orientation"][1] / 180.0) * math.pi,
-                                              (item["orientation"][2] / 180.0) * math.pi)
-
-                    position = [item["position"][0], item["position"][1], item["position"][2], q[0], q[1], q[2], q[3]]
-                    add_remove_object("add", collision_object, position, "primitive")
-                    break
+        scene = self.scenes[self.scenario]
+        target = [scene.get_environment_object(self.load_mesh)] + scene.obstacle_objects(self.spawn_obstacles)
+        (kept, moved, added, removed) = scene_diff(scene_client.world_objects(), target, self.scenes.object_ids())
+
+        for object_id in removed + ["object"]:
+            transaction.remove(object_id)
+        for co_object in moved:
+            transaction.move(co_object)
+        for co_object in added:
+            transaction.add_object(co_object)
+
+        rospy.loginfo("Scene diff: " + str(len(kept)) + " kept, " + str(len(moved)) + " moved, " + str(len(added)) +
+                      " added, " + str(len(removed)) + " removed")
+
+        # Cached trajectories and roadmap edges of this scene are only valid for the same collision world
+        if trajectory_cache is not None:
+            trajectory_cache.set_scene(self.scenario, scene.fingerprint(self.spawn_obstacles))
+        if joint_roadmap is not None:
+            joint_roadmap.set_scene(self.scenario, scene.fingerprint(self.spawn_obstacles))
+        if planner_statistics is not None:
+            planner_statistics.set_scene(self.scenario)
+        spawned_scene = (self.scenario, scene.fingerprint(self.spawn_obstacles))
+
+        transaction.commit()
+
+        if self.clearance_check:
+            self.update_clearance_map(scene)
 
         self.spawn_marker()
 
-    def clear_environment(self):
-        co_object = CollisionObject()
-        for i in self.scene_data:
-            co_object.id = i
-            add_remove_object("remove", copy(co_object), "", "")
-            if len(self.scene_data[i]["environment"]["additional_obstacles"]) != 0:
-                for item in self.scene_data[i]["environment"]["additional_obstacles"]:
-                    co_object.id = item["id"]
-                    add_remove_object("remove", copy(co_object), "", "")
+    def update_clearance_map(self, scene):
+        global scene_clearance
 
-        co_object.id = "object"
-        add_remove_object("remove", copy(co_object), "", "")
+        fingerprint = scene.fingerprint(self.spawn_obstacles)
+        if fingerprint not in self.clearance_maps:
+            try:
+                mesh_arrays = self.mesh_cache.load(scene.mesh_file, scene.scaling)
+            except (IOError, OSError, ValueError), e:
+                rospy.logwarn("Clearance check without environment mesh: " + str(e))
+                mesh_arrays = None
+            self.clearance_maps[fingerprint] = ClearanceMap.from_scene(scene, mesh_arrays, self.spawn_obstacles)
+
+        scene_clearance = self.clearance_maps[fingerprint]
+
+    def update_marker(self, name, color, position):
+        # Markers of the same shape are only moved, others are replaced
+        int_marker = self.server.get(name)
+        if int_marker is not None and name in self.marker_names:
+            box = int_marker.controls[0].markers[0]
+            template = self.make_box(color)
+            if (box.type, box.scale, box.color) == (template.type, template.scale, template.color):
+                pose = Pose()
+                pose.position = position
+                self.server.setPose(name, pose)
+                return
 
-        self.server.clear()
-        self.server.applyChanges()
+        self.make_marker(name, color, InteractiveMarkerControl.MOVE_3D, position)
 
     def spawn_marker(self):
         color = ColorRGBA(1.0, 0.0, 0.0, 1.0)
+        scene = self.scenes[self.scenario]
+
+        # Markers of the previous scene that this one does not have, e.g. additional waypoints
+        names = set(["right_arm_start", "right_arm_goal", "left_arm_goal"])
+        if self.use_waypoints:
+            for name in ["waypoint_r", "waypoint_l"]:
+                names.update(name + str(i + 1) for i in xrange(len(scene.waypoint_points[name])))
+        for name in self.marker_names - names:
+            self.server.erase(name)
 
         # ---- BUILD POSITION MARKER ----
-        self.make_marker("right_arm_start", copy(color), InteractiveMarkerControl.MOVE_3D,
-                         Point(self.scene_data[self.scenario]["positions"]["start_r"][0],
-                               self.scene_data[self.scenario]["positions"]["start_r"][1],
-                               self.scene_data[self.scenario]["positions"]["start_r"][2]))
-        self.make_marker("right_arm_goal", copy(color), InteractiveMarkerControl.MOVE_3D,
-                         Point(self.scene_data[self.scenario]["positions"]["goal_r"][0],
-                               self.scene_data[self.scenario]["positions"]["goal_r"][1],
-                               self.scene_data[self.scenario]["positions"]["goal_r"][2]))
-        self.make_marker("left_arm_goal", copy(color), InteractiveMarkerControl.MOVE_3D,
-                         Point(self.scene_data[self.scenario]["positions"]["goal_l"][0],
-                               self.scene_data[self.scenario]["positions"]["goal_l"][1],
-                               self.scene_data[self.scenario]["positions"]["goal_l"][2]))
+        self.update_marker("right_arm_start", color, scene.points["start_r"])
+        self.update_marker("right_arm_goal", color, scene.points["goal_r"])
+        self.update_marker("left_arm_goal", color, scene.points["goal_l"])
 
         # ---- BUILD WAYPOINT MARKER ----
         if self.use_waypoints:
-            color.r = 0.0
-            color.b = 1.0
-
-            if len(self.scene_data[self.scenario]["positions"]["waypoint_r"]) != 0:
-                for i in xrange(0, len(self.scene_data[self.scenario]["positions"]["waypoint_r"])):
-                    self.make_marker("waypoint_r" + str(i + 1), color, InteractiveMarkerControl.MOVE_3D,
-                                     Point(self.scene_data[self.scenario]["positions"]["waypoint_r"][i][0],
-                                           self.scene_data[self.scenario]["positions"]["waypoint_r"][i][1],
-                                           self.scene_data[self.scenario]["positions"]["waypoint_r"][i][2]))
-
-            if len(self.scene_data[self.scenario]["positions"]["waypoint_l"]) != 0:
-                for i in xrange(0, len(self.scene_data[self.scenario]["positions"]["waypoint_l"])):
-                    self.make_marker("waypoint_l" + str(i + 1), color, InteractiveMarkerControl.MOVE_3D,
-                                     Point(self.scene_data[self.scenario]["positions"]["waypoint_l"][i][0],
-                                           self.scene_data[self.scenario]["positions"]["waypoint_l"][i][1],
-                                           self.scene_data[self.scenario]["positions"]["waypoint_l"][i][2]))
+            color = ColorRGBA(0.0, 0.0, 1.0, 1.0)
 
-            self.server.applyChanges()
+            for name in ["waypoint_r", "waypoint_l"]:
+                for (i, point) in enumerate(scene.waypoint_points[name]):
+                    self.update_marker(name + str(i + 1), color, point)
+
+        self.marker_names = names
 
         # ---- APPLY MENU TO MARKER ----
         self.menu_handler.apply(self.server, "right_arm_start")
@@ -633,11 +630,15 @@ class StartPosition(smach.State):
         start_state.is_diff = True
 
         try:
-            traj = plan_movement(planer,
-                                 start_state,
-                                 config.points[0].positions,
-                                 userdata.joint_trajectory_speed
-                                 )
+            traj = plan_roadmap_movement(planer,
+                                         userdata.active_arm,
+                                         start_state,
+                                         userdata.arm_positions["poses"][0],
+                                         config.points[0].positions,
+                                         userdata.joint_trajectory_speed,
+                                         "start",
+                                         "LBKPIECEkConfigDefault"
+                                         )
 
         except (ValueError, IndexError):
             if userdata.error_counter >= userdata.error_max:
@@ -681,7 +682,6 @@ class EndPosition(smach.State):
         object_shape.dimensions.append(userdata.object["dimension"][2])  # Height
         object_shape.dimensions.append(userdata.object["dimension"][0] * 0.5)  # Radius
         collision_object.primitives.append(object_shape)
-        add_remove_object("remove", copy(collision_object), "", "")
 
         if userdata.planning_method != "joint":
 
@@ -695,6 +695,11 @@ class EndPosition(smach.State):
                         userdata.joint_goal_position.z,
                         0.0, 0.0, 0.0, 1.0]
 
+        # The object must not be in the scene while the next manipulation is planned
+        if plan_prefetcher is not None:
+            plan_prefetcher.wait()
+
+        # Replaces the object if it is still in the scene
         add_remove_object("add", copy(collision_object), position, "primitive")
 
         global abort_execution
@@ -716,11 +721,15 @@ class EndPosition(smach.State):
         start_state.is_diff = True
 
         try:
-            traj = plan_movement(planer,
-                                 start_state,
-                                 config.points[0].positions,
-                                 userdata.joint_trajectory_speed
-                                 )
+            traj = plan_roadmap_movement(planer,
+                                         userdata.active_arm,
+                                         start_state,
+                                         userdata.arm_positions["poses"][-1],
+                                         config.points[0].positions,
+                                         userdata.joint_trajectory_speed,
+                                         "end",
+                                         "LBKPIECEkConfigDefault"
+                                         )
 
         except (ValueError, IndexError):
             if userdata.error_counter >= userdata.error_max:
@@ -741,29 +750,74 @@ class EndPosition(smach.State):
 
 
 class Planning(smach.State):
-    def __init__(self):
+    def __init__(self, switch_arm=None):
         smach.State.__init__(self,
                              outcomes=['succeeded', 'failed', 'error'],
                              input_keys=['active_arm', 'cs_orientation', 'error_max', 'object', 'manipulation_options',
                                          'arm_positions', 'error_counter', 'planning_method', 'joint_trajectory_speed',
-                                         'computed_trajectories'],
+                                         'computed_trajectories', 'switch_arm'],
                              output_keys=['cs_position', 'cs_orientation', 'error_message', 'error_counter',
                                           'joint_goal_position', 'computed_trajectories'])
 
         self.tf_listener = tf.TransformListener()
+        if latency_metrics is not None:
+            latency_metrics.instrument(self.tf_listener, ["lookupTransform"], "tf")
         self.planer = mgc_right
 
+        # Target poses are resolved in process, TF is only used for external frames
+        self.frame_resolver = FrameResolver(self.tf_listener)
+        self.frame_resolver.register("current_object", self.object_frame)
+
         self.eef_step = rospy.get_param("/eef_step")
         self.jump_threshold = rospy.get_param("/jump_threshold")
         self.planer_id = rospy.get_param("/planer_id")
 
         rospy.loginfo("Using planer: '" + str(self.planer_id) + "'")
 
+        # Linear segments start with a coarse eef_step that is only refined where the path fails
+        self.adaptive_cartesian = rospy.get_param(rospy.get_name() + "/adaptive_cartesian", False)
+        if self.adaptive_cartesian:
+            self.adaptive_steps = (rospy.get_param(rospy.get_name() + "/adaptive_eef_step_max", 0.04),
+                                   rospy.get_param(rospy.get_name() + "/adaptive_eef_step_min", 0.005),
+                                   rospy.get_param(rospy.get_name() + "/adaptive_refine_distance", 0.05))
+            self.planning_client = PlanningClient()
+
+        # Plan all pick and place segments at once with a pool of planning service clients
+        self.parallel_planning = rospy.get_param(rospy.get_name() + "/parallel_planning", False) or \
+            plan_prefetcher is not None
+        self.grasp_search_enabled = rospy.get_param(rospy.get_name() + "/grasp_search", False)
+        if self.parallel_planning or self.grasp_search_enabled:
+            # One client per pick & place segment and move_group instance by default
+            self.planning_pool = PlanningClientPool(rospy.get_param(rospy.get_name() + "/planning_services", [""]),
+                                                    rospy.get_param(rospy.get_name() + "/planning_clients", 6))
+            rospy.loginfo("Parallel planning with " + str(self.planning_pool.size) + " planning clients")
+
+        # Plan the next manipulation while the current one is executed, SwitchArm predicts the next arm
+        self.switch_arm = switch_arm
+        self.prefetch_timeout = rospy.get_param(rospy.get_name() + "/pipelined_planning_timeout", 10.0)
+
+        # Cached and prefetched trajectories are checked against the current planning scene before they are used
+        if trajectory_cache is not None or plan_prefetcher is not None:
+            self.trajectory_validator = TrajectoryValidator(
+                PlanningClient(), rospy.get_param(rospy.get_name() + "/trajectory_cache_check_stride", 10))
+
+        # Rank all grasp orientations with an IK check instead of rotating by 5 degrees per failed attempt
+        if self.grasp_search_enabled:
+            self.grasp_search = GraspSearch(self.planning_pool,
+                                            rospy.get_param(rospy.get_name() + "/grasp_candidates", 5))
+            self.grasp_tilt = rospy.get_param(rospy.get_name() + "/grasp_search_tilt", 0.0)
+        self.grasp_rankings = {}
+        self.attempt = 0
+
+        self.clearance_margin = rospy.get_param(rospy.get_name() + "/clearance_margin", 0.005)
+        self.clearance_step = rospy.get_param(rospy.get_name() + "/clearance_step", 0.01)
+
+        self.streaming_execution = rospy.get_param(rospy.get_name() + "/streaming_execution", False)
+
+        self.start_state = RobotState()
+
         self.traj_name = ""
-        self.traj_pick = []
-        self.traj_place = []
 
-        self.cs_ready = False
         self.last_state = 0
 
         self.joint_order = ["approach", "grasp", "lift", "move", "drop", "retreat"]
@@ -778,22 +832,8 @@ class Planning(smach.State):
         self.planer.set_planner_id(self.planer_id)
         self.planer.allow_replanning(True)
 
-        if userdata.cs_orientation[2] >= 0.5 * math.pi:
-            # Rotate clockwise
-            userdata.cs_orientation[3] = -1.0
-        elif userdata.cs_orientation[2] <= -0.5 * math.pi:
-            # Rotate counterclockwise
-            userdata.cs_orientation[3] = 1.0
-
-        if userdata.cs_orientation[3] == 1.0:
-            userdata.cs_orientation[2] += (5.0 / 180.0) * math.pi
-        elif userdata.cs_orientation[3] == -1.0:
-            userdata.cs_orientation[2] -= (5.0 / 180.0) * math.pi
-
-        if userdata.active_arm == "left":
-            userdata.cs_orientation[0] = math.pi
-        elif userdata.active_arm == "right":
-            userdata.cs_orientation[0] = 0.0
+        self.select_orientation(userdata, self.attempt)
+        self.attempt += 1
 
         global abort_execution
 
@@ -816,10 +856,9 @@ class Planning(smach.State):
         if not execution:
             if userdata.error_counter >= userdata.error_max:
                 userdata.error_counter = 0
-                self.traj_pick[:] = []
-                self.traj_place[:] = []
                 userdata.cs_position = "start"
                 userdata.cs_orientation[2] = 0.0
+                self.attempt = 0
 
                 self.timer_activated = False
                 planning_recorder.error()
@@ -830,562 +869,513 @@ class Planning(smach.State):
 
         planning_recorder.stop()
         self.timer_activated = True
+        self.attempt = 0
+
+        if plan_prefetcher is not None and self.switch_arm is not None:
+            self.prefetch_next_cycle(userdata)
 
         userdata.error_counter = 0
         return "succeeded"
 
-    def plan_cartesian(self, userdata):
-
-        if len(self.traj_pick) < 3:
-
-            # -------------------- PICK --------------------
-            # ----------- APPROACH -----------
-            self.traj_name = "approach"
-            traj_approach = RobotTrajectory()
-            start_state = RobotState()
-
-            (config, error_code) = sss.compose_trajectory("arm_" + userdata.active_arm,
-                                                          userdata.arm_positions["poses"][0])
-            if error_code != 0:
-                rospy.logerr("unable to parse configuration")
-                return False
-
-            start_state.joint_state.name = config.joint_names
-            start_state.joint_state.position = self.planer.get_current_joint_values()
-            start_state.attached_collision_objects[:] = []
-            start_state.is_diff = True
-            self.planer.set_start_state(start_state)
-
-            approach_pose_offset = PoseStamped()
-            approach_pose_offset.header.frame_id = "current_object"
-            approach_pose_offset.header.stamp = rospy.Time(0)
-            approach_pose_offset.pose.position.x = -userdata.manipulation_options["approach_dist"]
-            approach_pose_offset.pose.orientation.w = 1
-
-            try:
-                approach_pose = self.tf_listener.transformPose("base_link", approach_pose_offset)
-            except Exception, e:
-                userdata.error_message = "Could not transform pose. Exception: " + str(e)
-                userdata.error_counter += 1
-                self.traj_pick[:] = []
-                return False
-
-            if userdata.planning_method == "cartesian_linear":
-
-                (traj_approach, frac_approach) = self.planer.compute_cartesian_path([approach_pose.pose], self.eef_step,
-                                                                                    self.jump_threshold, True)
-
-                if frac_approach < 0.5:
-                    rospy.logerr("Plan " + self.traj_name + ": " + str(round(frac_approach * 100, 2)) + "%")
-                elif 0.5 <= frac_approach < 1.0:
-                    rospy.logwarn("Plan " + self.traj_name + ": " + str(round(frac_approach * 100, 2)) + "%")
-                else:
-                    rospy.loginfo("Plan " + self.traj_name + ": " + str(round(frac_approach * 100, 2)) + "%")
-
-                if frac_approach != 1.0:
-                    userdata.error_message = "Unable to plan " + self.traj_name + " trajectory"
-                    userdata.error_counter += 1
-                    self.traj_pick[:] = []
-                    return False
-
-            elif userdata.planning_method == "cartesian" or userdata.planning_method == "cartesian_mixed":
-
-                self.planer.clear_pose_targets()
-                self.planer.set_pose_target(approach_pose.pose, self.planer.get_end_effector_link())
-
-                try:
-                    traj_approach = self.planer.plan()
-                    traj_approach = smooth_cartesian_path(traj_approach)
-                    traj_approach = scale_joint_trajectory_speed(traj_approach, userdata.joint_trajectory_speed)
-                except (ValueError, IndexError):
-                    rospy.loginfo("Plan " + self.traj_name + ": failed")
-                    userdata.error_message = "Unable to plan " + self.traj_name + " trajectory"
-                    userdata.error_counter += 1
-                    self.traj_pick[:] = []
-                    return False
-                else:
-                    rospy.loginfo("Plan " + self.traj_name + ": succeeded")
-
-            self.traj_pick.append(traj_approach)
-
-            # ----------- GRASP -----------
-            self.traj_name = "grasp"
-            traj_grasp = RobotTrajectory()
-            start_state = RobotState()
-
-            traj_approach_endpoint = traj_approach.joint_trajectory.points[-1]
-            start_state.joint_state.name = traj_approach.joint_trajectory.joint_names
-            start_state.joint_state.position = traj_approach_endpoint.positions
-            start_state.attached_collision_objects[:] = []
-            start_state.is_diff = True
-            self.planer.set_start_state(start_state)
-
-            grasp_pose_offset = PoseStamped()
-            grasp_pose_offset.header.frame_id = "current_object"
-            grasp_pose_offset.header.stamp = rospy.Time(0)
-            grasp_pose_offset.pose.orientation.w = 1
-
-            try:
-                grasp_pose = self.tf_listener.transformPose("base_link", grasp_pose_offset)
-            except Exception, e:
-                userdata.error_message = "Could not transform pose. Exception: " + str(e)
-                userdata.error_counter += 1
-                self.traj_pick[:] = []
-                return False
+    def select_orientation(self, userdata, attempt):
+        if self.grasp_search_enabled and userdata.planning_method != "joint":
+            candidates = self.grasp_candidates(userdata)
+            if attempt < len(candidates):
+                userdata.cs_orientation[0:3] = candidates[attempt]
+                return
+
+            if attempt == len(candidates):
+                rospy.logwarn("All ranked grasp orientations failed, rotating step by step")
+
+        self.update_orientation(userdata.active_arm, userdata.cs_orientation)
+
+    def grasp_candidates(self, userdata):
+        # Ranked once per scene, arm, object position and object, the targets alternate between two positions. IK
+        # and clearance checks depend on the collision world.
+        position = userdata.arm_positions[userdata.active_arm]["start"]
+        key = (spawned_scene, userdata.active_arm, round(position.x, 3), round(position.y, 3), round(position.z, 3),
+               repr(userdata.object), repr(userdata.manipulation_options))
+        if key in self.grasp_rankings:
+            return self.grasp_rankings[key]
+
+        (config, error_code) = sss.compose_trajectory("arm_" + userdata.active_arm,
+                                                      userdata.arm_positions["poses"][0])
+        if error_code != 0:
+            rospy.logerr("unable to parse configuration")
+            return []
 
-            if userdata.planning_method == "cartesian_linear" or userdata.planning_method == "cartesian_mixed":
-                (traj_grasp, frac_grasp) = self.planer.compute_cartesian_path([grasp_pose.pose], self.eef_step,
-                                                                              self.jump_threshold, True)
-
-                if frac_grasp < 0.5:
-                    rospy.logerr("Plan " + self.traj_name + ": " + str(round(frac_grasp * 100, 2)) + "%")
-                elif 0.5 <= frac_grasp < 1.0:
-                    rospy.logwarn("Plan " + self.traj_name + ": " + str(round(frac_grasp * 100, 2)) + "%")
-                else:
-                    rospy.loginfo("Plan " + self.traj_name + ": " + str(round(frac_grasp * 100, 2)) + "%")
-
-                if frac_grasp != 1.0:
-                    userdata.error_message = "Unable to plan " + self.traj_name + " trajectory"
-                    userdata.error_counter += 1
-                    self.traj_pick[:] = []
-                    return False
+        if userdata.active_arm == "left":
+            planer = mgc_left
+            reference = [math.pi, userdata.cs_orientation[1], 0.0]
+        else:
+            planer = mgc_right
+            reference = [0.0, userdata.cs_orientation[1], 0.0]
+
+        orientations = sample_orientations(reference[0], reference[1], tilt=self.grasp_tilt)
+        if userdata.active_arm in reachability_maps:
+            orientations = orientations[reachability_maps[userdata.active_arm].orientation_mask(
+                [position.x, position.y, position.z], orientations)]
+        offsets = self.pick_offsets(userdata)
+        candidate_poses = [self.frame_resolver.poses("current_object", offsets, userdata, "start", orientation)
+                           for orientation in orientations]
+        if scene_clearance is not None and len(orientations) != 0:
+            clear = scene_clearance.points_clear(
+                [[pose.position.x, pose.position.y, pose.position.z] for poses in candidate_poses for pose in poses],
+                self.clearance_margin).reshape(len(orientations), -1).all(axis=1)
+            orientations = orientations[clear]
+            candidate_poses = [poses for (poses, keep) in zip(candidate_poses, clear) if keep]
+        attached = [[], [], attachments.attached_objects(userdata.active_arm, userdata.object)]
+
+        self.grasp_rankings[key] = self.grasp_search.rank("arm_" + userdata.active_arm,
+                                                          planer.get_end_effector_link(), config.joint_names,
+                                                          config.points[0].positions, orientations, reference,
+                                                          candidate_poses, attached)
+        return self.grasp_rankings[key]
 
-            elif userdata.planning_method == "cartesian":
+    @staticmethod
+    def update_orientation(active_arm, cs_orientation):
+        if cs_orientation[2] >= 0.5 * math.pi:
+            # Rotate clockwise
+            cs_orientation[3] = -1.0
+        elif cs_orientation[2] <= -0.5 * math.pi:
+            # Rotate counterclockwise
+            cs_orientation[3] = 1.0
+
+        if cs_orientation[3] == 1.0:
+            cs_orientation[2] += (5.0 / 180.0) * math.pi
+        elif cs_orientation[3] == -1.0:
+            cs_orientation[2] -= (5.0 / 180.0) * math.pi
+
+        if active_arm == "left":
+            cs_orientation[0] = math.pi
+        elif active_arm == "right":
+            cs_orientation[0] = 0.0
+
+    def prefetch_next_cycle(self, userdata):
+        # Same changes as SWITCH_ARM, SWITCH_TARGETS and the first PLANNING attempt of the next manipulation
+        next_cycle = self.switch_arm.next_cycle(userdata)
+        if next_cycle is None:
+            return
 
-                self.planer.clear_pose_targets()
-                self.planer.set_pose_target(grasp_pose.pose, self.planer.get_end_effector_link())
+        predicted = smach.UserData()
+        (predicted.active_arm, switch_targets) = next_cycle
+        predicted.planning_method = userdata.planning_method
+        predicted.joint_trajectory_speed = userdata.joint_trajectory_speed
+        predicted.manipulation_options = userdata.manipulation_options
+        predicted.object = userdata.object
+
+        predicted.arm_positions = dict((arm, dict(userdata.arm_positions[arm])) for arm in ["left", "right"])
+        predicted.arm_positions["poses"] = list(userdata.arm_positions["poses"])
+        if switch_targets:
+            SwitchTargets.switch_positions(predicted.arm_positions, predicted.planning_method)
+
+        predicted.cs_orientation = list(userdata.cs_orientation)
+        if predicted.active_arm != userdata.active_arm:
+            SwitchArm.set_arm_orientation(predicted.active_arm, predicted.cs_orientation)
+        predicted.cs_orientation[2] = 0.0
+        self.select_orientation(predicted, 0)
+
+        # The next manipulation starts from the start position
+        (config, error_code) = sss.compose_trajectory("arm_" + predicted.active_arm,
+                                                      predicted.arm_positions["poses"][0])
+        if error_code != 0:
+            rospy.logerr("unable to parse configuration")
+            return
 
-                try:
-                    traj_grasp = self.planer.plan()
-                    traj_grasp = smooth_cartesian_path(traj_grasp)
-                    traj_grasp = scale_joint_trajectory_speed(traj_grasp, userdata.joint_trajectory_speed)
-                except (ValueError, IndexError):
-                    rospy.loginfo("Plan " + self.traj_name + ": failed")
-                    userdata.error_message = "Unable to plan " + self.traj_name + " trajectory"
-                    userdata.error_counter += 1
-                    self.traj_pick[:] = []
-                    return False
-                else:
-                    rospy.loginfo("Plan " + self.traj_name + ": succeeded")
+        if predicted.active_arm == "left":
+            planer = mgc_left
+        else:
+            planer = mgc_right
 
-            self.traj_pick.append(traj_grasp)
+        segments = self.cartesian_segments(predicted)
+        segment_planner = ParallelSegmentPlanner(self.planning_pool, "arm_" + predicted.active_arm,
+                                                 planer.get_end_effector_link(), self.planer_id,
+                                                 self.eef_step, self.jump_threshold,
+                                                 cartesian_planner=self.cartesian_planner(
+                                                     predicted.active_arm, planer.get_end_effector_link()),
+                                                 record=statistics_recorder(predicted.active_arm))
 
-            # ----------- LIFT -----------
-            self.traj_name = "lift"
-            traj_lift = RobotTrajectory()
-            start_state = RobotState()
+        rospy.loginfo("Planning next manipulation with " + predicted.active_arm + " arm in the background")
+        plan_prefetcher.submit(self.segments_key(predicted, segments), self.plan_prefetched, predicted,
+                               segment_planner, config.joint_names, config.points[0].positions, segments)
 
-            traj_grasp_endpoint = traj_grasp.joint_trajectory.points[-1]
-            start_state.joint_state.name = traj_grasp.joint_trajectory.joint_names
-            start_state.joint_state.position = traj_grasp_endpoint.positions
-
-            # Attach object
-            object_shape = SolidPrimitive()
-            object_shape.type = userdata.object["shape"]
-            object_shape.dimensions.append(userdata.object["dimension"][2])  # Height
-            object_shape.dimensions.append(userdata.object["dimension"][0] * 0.5)  # Radius
-
-            object_pose = Pose()
-            object_pose.orientation.w = 1.0
-
-            object_collision = CollisionObject()
-            object_collision.header.frame_id = "gripper_" + userdata.active_arm + "_grasp_link"
-            object_collision.id = "object"
-            object_collision.primitives.append(object_shape)
-            object_collision.primitive_poses.append(object_pose)
-            object_collision.operation = CollisionObject.ADD
-
-            object_attached = AttachedCollisionObject()
-            object_attached.link_name = "gripper_" + userdata.active_arm + "_grasp_link"
-            object_attached.object = object_collision
-            object_attached.touch_links = ["gripper_" + userdata.active_arm + "_base_link",
-                                           "gripper_" + userdata.active_arm + "_camera_link",
-                                           "gripper_" + userdata.active_arm + "_finger_1_link",
-                                           "gripper_" + userdata.active_arm + "_finger_2_link",
-                                           "gripper_" + userdata.active_arm + "_grasp_link",
-                                           "gripper_" + userdata.active_arm + "_palm_link"]
-
-            start_state.attached_collision_objects.append(object_attached)
-
-            start_state.is_diff = True
-            self.planer.set_start_state(start_state)
-
-            lift_pose_offset = PoseStamped()
-            lift_pose_offset.header.frame_id = "current_object"
-            lift_pose_offset.header.stamp = rospy.Time(0)
-            if userdata.active_arm == "left":
-                lift_pose_offset.pose.position.z = -userdata.manipulation_options["lift_height"]
-            elif userdata.active_arm == "right":
-                lift_pose_offset.pose.position.z = userdata.manipulation_options["lift_height"]
-            lift_pose_offset.pose.orientation.w = 1
+    def plan_prefetched(self, userdata, segment_planner, joint_names, start_positions, segments):
+        # Runs in the prefetch thread, must not use the move group commanders
+        return start_positions, self.plan_in_parallel(userdata, segment_planner, joint_names, start_positions,
+                                                      segments)
 
-            try:
-                lift_pose = self.tf_listener.transformPose("base_link", lift_pose_offset)
-            except Exception, e:
-                userdata.error_message = "Could not transform pose. Exception: " + str(e)
-                userdata.error_counter += 1
-                self.traj_pick[:] = []
-                return False
+    @staticmethod
+    def segments_key(userdata, segments):
+        return (userdata.active_arm, userdata.planning_method, userdata.joint_trajectory_speed,
+                tuple(segment.key() for segment in segments))
 
-            if userdata.planning_method == "cartesian_linear" or userdata.planning_method == "cartesian_mixed":
+    def prefetched_trajectories(self, userdata, segments, start_positions):
+        result = plan_prefetcher.take(self.segments_key(userdata, segments), self.prefetch_timeout)
+        if result is None:
+            return []
 
-                (traj_lift, frac_lift) = self.planer.compute_cartesian_path([lift_pose.pose], self.eef_step,
-                                                                            self.jump_threshold, True)
+        (predicted_start, trajectories) = result
+        if len(trajectories) == 0:
+            return []
 
-                if frac_lift < 0.5:
-                    rospy.logerr("Plan " + self.traj_name + ": " + str(round(frac_lift * 100, 2)) + "%")
-                elif 0.5 <= frac_lift < 1.0:
-                    rospy.logwarn("Plan " + self.traj_name + ": " + str(round(frac_lift * 100, 2)) + "%")
-                else:
-                    rospy.loginfo("Plan " + self.traj_name + ": " + str(round(frac_lift * 100, 2)) + "%")
+        if np.max(np.abs(np.asarray(predicted_start) - np.asarray(start_positions))) > 0.01:
+            rospy.logwarn("Prefetched trajectories start too far from the current position")
+            return []
 
-                if frac_lift != 1.0:
-                    userdata.error_message = "Unable to plan " + self.traj_name + " trajectory"
-                    userdata.error_counter += 1
-                    self.traj_pick[:] = []
-                    return False
+        # The scene may have changed while they were planned
+        for (i, (traj, segment)) in enumerate(zip(trajectories, segments)):
+            if not self.trajectory_validator.is_valid("arm_" + userdata.active_arm, traj, segment.attached_objects):
+                rospy.logwarn("Prefetched " + segment.name + " trajectory is not valid in the current planning scene")
+                trajectories = trajectories[:i]
+                break
 
-            elif userdata.planning_method == "cartesian":
+        if len(trajectories) != 0:
+            trajectories[0].joint_trajectory.points[0].positions = list(start_positions)
 
-                self.planer.clear_pose_targets()
-                self.planer.set_pose_target(lift_pose.pose, self.planer.get_end_effector_link())
+        for segment in segments[:len(trajectories)]:
+            rospy.loginfo("Plan " + segment.name + ": prefetched")
 
-                try:
-                    traj_lift = self.planer.plan()
-                    traj_lift = smooth_cartesian_path(traj_lift)
-                    traj_lift = scale_joint_trajectory_speed(traj_lift, userdata.joint_trajectory_speed)
-                except (ValueError, IndexError):
-                    rospy.loginfo("Plan " + self.traj_name + ": failed")
-                    userdata.error_message = "Unable to plan " + self.traj_name + " trajectory"
-                    userdata.error_counter += 1
-                    self.traj_pick[:] = []
-                    return False
-                else:
-                    rospy.loginfo("Plan " + self.traj_name + ": succeeded")
+        return trajectories
 
-            self.traj_pick.append(traj_lift)
+    def plan_cartesian(self, userdata):
 
-            userdata.cs_position = "goal"
-            userdata.error_counter = 0
-            userdata.cs_orientation[2] = 0.0
+        if self.parallel_planning:
+            return self.plan_cartesian_parallel(userdata)
 
-            rospy.loginfo("Pick planning complete")
+        (config, error_code) = sss.compose_trajectory("arm_" + userdata.active_arm,
+                                                      userdata.arm_positions["poses"][0])
+        if error_code != 0:
+            rospy.logerr("unable to parse configuration")
             return False
 
-        else:
-
-            if not self.cs_ready:
-                rospy.logwarn("Target coordinate system not ready")
-                self.cs_ready = True
-                rospy.sleep(0.05)
-                return False
-
-            # -------------------- PLACE --------------------
-            # ----------- MOVE -----------
-            self.traj_name = "move"
-            traj_move = RobotTrajectory()
-
-            try:
-                traj_lift_endpoint = self.traj_pick[2].joint_trajectory.points[-1]
-            except AttributeError:
-                self.traj_pick[:] = []
-                self.traj_place[:] = []
-                userdata.cs_position = "start"
-                userdata.error_message = "Error: " + str(AttributeError)
-                userdata.error_counter += 1
-                return False
-
-            start_state = RobotState()
-            start_state.joint_state.name = self.traj_pick[2].joint_trajectory.joint_names
-            start_state.joint_state.position = traj_lift_endpoint.positions
-
-            # Attach object
-            object_shape = SolidPrimitive()
-            object_shape.type = userdata.object["shape"]
-            object_shape.dimensions.append(userdata.object["dimension"][2])  # Height
-            object_shape.dimensions.append(userdata.object["dimension"][0] * 0.5)  # Radius
-
-            object_pose = Pose()
-            object_pose.orientation.w = 1.0
-
-            object_collision = CollisionObject()
-            object_collision.header.frame_id = "gripper_" + userdata.active_arm + "_grasp_link"
-            object_collision.id = "object"
-            object_collision.primitives.append(object_shape)
-            object_collision.primitive_poses.append(object_pose)
-            object_collision.operation = CollisionObject.ADD
-
-            object_attached = AttachedCollisionObject()
-            object_attached.link_name = "gripper_" + userdata.active_arm + "_grasp_link"
-            object_attached.object = object_collision
-            object_attached.touch_links = ["gripper_" + userdata.active_arm + "_base_link",
-                                           "gripper_" + userdata.active_arm + "_camera_link",
-                                           "gripper_" + userdata.active_arm + "_finger_1_link",
-                                           "gripper_" + userdata.active_arm + "_finger_2_link",
-                                           "gripper_" + userdata.active_arm + "_grasp_link",
-                                           "gripper_" + userdata.active_arm + "_palm_link"]
-
-            start_state.attached_collision_objects.append(object_attached)
-
-            start_state.is_diff = True
-            self.planer.set_start_state(start_state)
-
-            self.planer.clear_pose_targets()
-            move_pose_offset = PoseStamped()
-            move_pose_offset.header.frame_id = "current_object"
-            move_pose_offset.header.stamp = rospy.Time(0)
-            if userdata.active_arm == "left":
-                move_pose_offset.pose.position.z = -userdata.manipulation_options["lift_height"]
-            elif userdata.active_arm == "right":
-                move_pose_offset.pose.position.z = userdata.manipulation_options["lift_height"]
-            move_pose_offset.pose.orientation.w = 1
-
-            try:
-                move_pose = self.tf_listener.transformPose("base_link", move_pose_offset)
-            except Exception, e:
-                userdata.error_message = "Could not transform pose. Exception: " + str(e)
-                userdata.error_counter += 1
-                self.traj_place[:] = []
-                return False
+        # Pick and place targets are resolved at once, no need to wait for the "current_object" frame
+        segments = self.cartesian_segments(userdata)
+        if not self.targets_clear(userdata, segments):
+            return False
 
-            if userdata.planning_method == "cartesian_linear":
+        trajectories = []
+        if not self.plan_serial(userdata, config.joint_names, segments, trajectories):
+            return False
 
-                way_move = []
+        rospy.loginfo("Pick and place planning complete")
 
-                if len(userdata.arm_positions[userdata.active_arm]["waypoints"]) != 0:
-                    for item in userdata.arm_positions[userdata.active_arm]["waypoints"]:
-                        wpose_offset = PoseStamped()
-                        wpose_offset.header.frame_id = "current_object"
-                        wpose_offset.header.stamp = rospy.Time(0)
-                        wpose_offset.pose.orientation.w = 1
+        return self.finish_trajectories(userdata, trajectories)
 
-                        try:
-                            wpose = self.tf_listener.transformPose("base_link", wpose_offset)
-                        except Exception, e:
-                            userdata.error_message = "Could not transform pose. Exception: " + str(e)
-                            userdata.error_counter += 1
-                            self.traj_place[:] = []
-                            return False
+    def plan_cartesian_parallel(self, userdata):
+        (config, error_code) = sss.compose_trajectory("arm_" + userdata.active_arm,
+                                                      userdata.arm_positions["poses"][0])
+        if error_code != 0:
+            rospy.logerr("unable to parse configuration")
+            return False
 
-                        wpose.pose.position = item
-                        way_move.append(wpose.pose)
+        segments = self.cartesian_segments(userdata)
+        if not self.targets_clear(userdata, segments):
+            return False
 
-                way_move.append(move_pose.pose)
+        segment_planner = ParallelSegmentPlanner(self.planning_pool, "arm_" + userdata.active_arm,
+                                                 self.planer.get_end_effector_link(), self.planer_id,
+                                                 self.eef_step, self.jump_threshold,
+                                                 cartesian_planner=self.cartesian_planner(
+                                                     userdata.active_arm, self.planer.get_end_effector_link()),
+                                                 record=statistics_recorder(userdata.active_arm))
+
+        trajectories = []
+        start_positions = self.planer.get_current_joint_values()
+
+        # ----------- PREFETCHED SEGMENTS -----------
+        if plan_prefetcher is not None:
+            trajectories = self.prefetched_trajectories(userdata, segments, start_positions)
+            if len(trajectories) != 0:
+                start_positions = trajectories[-1].joint_trajectory.points[-1].positions
+
+        # ----------- CACHED SEGMENTS -----------
+        for segment in segments[len(trajectories):]:
+            self.traj_name = segment.name
+            traj = self.cached_trajectory(userdata, self.cache_key(userdata, start_positions,
+                                                                   segment.attached_objects, segment.poses,
+                                                                   segment.linear),
+                                          start_positions, segment.attached_objects)
+            if traj is None:
+                break
+
+            rospy.loginfo("Plan " + segment.name + ": cached")
+            trajectories.append(traj)
+            start_positions = traj.joint_trajectory.points[-1].positions
+
+        # ----------- PARALLEL PLANNING -----------
+        trajectories += self.plan_in_parallel(userdata, segment_planner, config.joint_names, start_positions,
+                                              segments[len(trajectories):])
+
+        # ----------- SERIAL REPLANNING -----------
+        if not self.plan_serial(userdata, config.joint_names, segments[len(trajectories):], trajectories):
+            return False
 
-                (traj_move, frac_move) = self.planer.compute_cartesian_path(way_move, self.eef_step,
-                                                                            self.jump_threshold, True)
+        rospy.loginfo("Pick and place planning complete")
 
-                if frac_move < 0.5:
-                    rospy.logerr("Plan " + self.traj_name + ": " + str(round(frac_move * 100, 2)) + "%")
-                elif 0.5 <= frac_move < 1.0:
-                    rospy.logwarn("Plan " + self.traj_name + ": " + str(round(frac_move * 100, 2)) + "%")
-                else:
-                    rospy.loginfo("Plan " + self.traj_name + ": " + str(round(frac_move * 100, 2)) + "%")
+        return self.finish_trajectories(userdata, trajectories)
 
-                if frac_move != 1.0:
-                    userdata.error_message = "Unable to plan " + self.traj_name + " trajectory"
-                    userdata.error_counter += 1
-                    self.traj_place[:] = []
-                    return False
+    def targets_clear(self, userdata, segments):
+        # Rejects the orientation before anything is planned if a target pose (the grasp pose is the object pose)
+        # or a linear movement between two targets gets too close to the environment
+        if scene_clearance is None:
+            return True
 
-            elif userdata.planning_method == "cartesian" or userdata.planning_method == "cartesian_mixed":
-                self.planer.clear_pose_targets()
-                self.planer.set_pose_target(move_pose.pose, self.planer.get_end_effector_link())
+        (points, owners, starts, ends, names) = ([], [], [], [], [])
+        for (i, segment) in enumerate(segments):
+            path = [[pose.position.x, pose.position.y, pose.position.z] for pose in segment.poses]
+            points.extend(path)
+            owners.extend([segment.name] * len(path))
+
+            # The first segment starts wherever the arm is
+            if segment.linear and i != 0:
+                path = points[-len(path) - 1:]
+                starts.extend(path[:-1])
+                ends.extend(path[1:])
+                names.extend([segment.name] * (len(path) - 1))
+
+        blocked = [name for (name, clear) in zip(owners, scene_clearance.points_clear(points, self.clearance_margin))
+                   if not clear]
+        if starts:
+            blocked += [name for (name, clear) in
+                        zip(names, scene_clearance.segments_clear(starts, ends, self.clearance_margin,
+                                                                  self.clearance_step)) if not clear]
+        if not blocked:
+            return True
 
-                try:
-                    traj_move = self.planer.plan()
-                    traj_move = smooth_cartesian_path(traj_move)
-                    traj_move = scale_joint_trajectory_speed(traj_move, userdata.joint_trajectory_speed)
-                except (ValueError, IndexError):
-                    rospy.loginfo("Plan " + self.traj_name + ": failed")
-                    userdata.error_message = "Unable to plan " + self.traj_name + " trajectory"
-                    userdata.error_counter += 1
-                    self.traj_place[:] = []
-                    return False
-                else:
-                    rospy.loginfo("Plan " + self.traj_name + ": succeeded")
+        rospy.logwarn("Targets too close to the environment: " + ", ".join(sorted(set(blocked))))
+        userdata.error_message = "Targets of " + ", ".join(sorted(set(blocked))) + " too close to the environment"
+        userdata.error_counter += 1
+        return False
 
-            self.traj_place.append(traj_move)
+    def plan_serial(self, userdata, joint_names, segments, trajectories):
+        # Appends the planned segments to trajectories, every segment starts at the end of the previous one
+        for segment in segments:
+            self.traj_name = segment.name
 
-            # ----------- DROP -----------
-            self.traj_name = "drop"
-            traj_drop = RobotTrajectory()
-            start_state = RobotState()
+            if len(trajectories) == 0:
+                self.set_start_state(joint_names, self.planer.get_current_joint_values(), segment.attached_objects)
+            else:
+                self.set_start_state(trajectories[-1].joint_trajectory.joint_names,
+                                     trajectories[-1].joint_trajectory.points[-1].positions,
+                                     segment.attached_objects)
 
-            traj_move_endpoint = traj_move.joint_trajectory.points[-1]
-            start_state.joint_state.name = traj_move.joint_trajectory.joint_names
-            start_state.joint_state.position = traj_move_endpoint.positions
-
-            # Attach object
-            object_shape = SolidPrimitive()
-            object_shape.type = userdata.object["shape"]
-            object_shape.dimensions.append(userdata.object["dimension"][2])  # Height
-            object_shape.dimensions.append(userdata.object["dimension"][0] * 0.5)  # Radius
-
-            object_pose = Pose()
-            object_pose.orientation.w = 1.0
-
-            object_collision = CollisionObject()
-            object_collision.header.frame_id = "gripper_" + userdata.active_arm + "_grasp_link"
-            object_collision.id = "object"
-            object_collision.primitives.append(object_shape)
-            object_collision.primitive_poses.append(object_pose)
-            object_collision.operation = CollisionObject.ADD
-
-            object_attached = AttachedCollisionObject()
-            object_attached.link_name = "gripper_" + userdata.active_arm + "_grasp_link"
-            object_attached.object = object_collision
-            object_attached.touch_links = ["gripper_" + userdata.active_arm + "_base_link",
-                                           "gripper_" + userdata.active_arm + "_camera_link",
-                                           "gripper_" + userdata.active_arm + "_finger_1_link",
-                                           "gripper_" + userdata.active_arm + "_finger_2_link",
-                                           "gripper_" + userdata.active_arm + "_grasp_link",
-                                           "gripper_" + userdata.active_arm + "_palm_link"]
-
-            start_state.attached_collision_objects.append(object_attached)
-
-            start_state.is_diff = True
-            self.planer.set_start_state(start_state)
-
-            drop_pose_offset = PoseStamped()
-            drop_pose_offset.header.frame_id = "current_object"
-            drop_pose_offset.pose.orientation.w = 1
-            try:
-                drop_pose = self.tf_listener.transformPose("base_link", drop_pose_offset)
-            except Exception, e:
-                userdata.error_message = "Could not transform pose. Exception: " + str(e)
-                userdata.error_counter += 1
-                self.traj_place[:] = []
+            with timed("segment", segment.name, self.attempt):
+                traj = self.plan_segment(userdata, segment.poses, segment.linear)
+            if traj is None:
                 return False
 
-            if userdata.planning_method == "cartesian_linear" or userdata.planning_method == "cartesian_mixed":
+            trajectories.append(traj)
 
-                (traj_drop, frac_drop) = self.planer.compute_cartesian_path([drop_pose.pose], self.eef_step,
-                                                                            self.jump_threshold, True)
-
-                if frac_drop < 0.5:
-                    rospy.logerr("Plan " + self.traj_name + ": " + str(round(frac_drop * 100, 2)) + "%")
-                elif 0.5 <= frac_drop < 1.0:
-                    rospy.logwarn("Plan " + self.traj_name + ": " + str(round(frac_drop * 100, 2)) + "%")
-                else:
-                    rospy.loginfo("Plan " + self.traj_name + ": " + str(round(frac_drop * 100, 2)) + "%")
-
-                if frac_drop != 1.0:
-                    userdata.error_message = "Unable to plan " + self.traj_name + " trajectory"
-                    userdata.error_counter += 1
-                    self.traj_place[:] = []
-                    return False
+        return True
 
-            elif userdata.planning_method == "cartesian":
+    def plan_in_parallel(self, userdata, segment_planner, joint_names, start_positions, segments):
+        trajectories = []
+        for (traj, segment) in zip(segment_planner.plan(joint_names, start_positions, segments), segments):
+            cache_key = self.cache_key(userdata, start_positions, segment.attached_objects, segment.poses,
+                                       segment.linear)
+            if not segment.linear:
+                traj = postprocess_plan(traj, userdata.joint_trajectory_speed, "arm_" + userdata.active_arm,
+                                        segment.attached_objects)
+            else:
+                traj = postprocess_linear_plan(traj, segment_planner.eef_link)
+            if cache_key is not None:
+                trajectory_cache.put(cache_key, traj)
+
+            trajectories.append(traj)
+            start_positions = traj.joint_trajectory.points[-1].positions
+
+        return trajectories
+
+    def cartesian_segments(self, userdata):
+        linear = userdata.planning_method == "cartesian_linear"
+        mixed = linear or userdata.planning_method == "cartesian_mixed"
+
+        # The place orientation is reset like in the serial pick -> place transition
+        pick_orientation = userdata.cs_orientation
+        place_orientation = [userdata.cs_orientation[0], userdata.cs_orientation[1], 0.0]
+
+        approach_dist = userdata.manipulation_options["approach_dist"]
+        lift_offset = self.lift_offset(userdata)
+        attached = attachments.attached_objects(userdata.active_arm, userdata.object)
+
+        (approach, grasp, lift) = self.frame_resolver.poses("current_object", self.pick_offsets(userdata),
+                                                            userdata, "start", pick_orientation)
+        (move, drop, retreat) = self.frame_resolver.poses(
+            "current_object", [[0.0, 0.0, lift_offset], [0.0, 0.0, 0.0], [-approach_dist, 0.0, 0.0]],
+            userdata, "goal", place_orientation)
+
+        # Waypoints keep the place orientation
+        way_move = []
+        if linear:
+            for item in userdata.arm_positions[userdata.active_arm]["waypoints"]:
+                wpose = Pose()
+                wpose.position = item
+                wpose.orientation = drop.orientation
+                way_move.append(wpose)
+        way_move.append(move)
+
+        return [Segment("approach", [approach], linear),
+                Segment("grasp", [grasp], mixed),
+                Segment("lift", [lift], mixed, attached),
+                Segment("move", way_move, linear, attached),
+                Segment("drop", [drop], mixed, attached),
+                Segment("retreat", [retreat], mixed)]
+
+    @classmethod
+    def pick_offsets(cls, userdata):
+        # Offsets in the object frame: pre-grasp, grasp, lift
+        return [[-userdata.manipulation_options["approach_dist"], 0.0, 0.0],
+                [0.0, 0.0, 0.0],
+                [0.0, 0.0, cls.lift_offset(userdata)]]
 
-                self.planer.clear_pose_targets()
-                self.planer.set_pose_target(drop_pose.pose, self.planer.get_end_effector_link())
+    @staticmethod
+    def object_frame(userdata, cs_position, orientation):
+        # Same frame as "current_object" broadcasted by SM.broadcast_tf, computed from the userdata directly
+        return frame_matrix(userdata.arm_positions[userdata.active_arm][cs_position], orientation)
 
-                try:
-                    traj_drop = self.planer.plan()
-                    traj_drop = smooth_cartesian_path(traj_drop)
-                    traj_drop = scale_joint_trajectory_speed(traj_drop, userdata.joint_trajectory_speed)
-                except (ValueError, IndexError):
-                    rospy.loginfo("Plan " + self.traj_name + ": failed")
-                    userdata.error_message = "Unable to plan " + self.traj_name + " trajectory"
-                    userdata.error_counter += 1
-                    self.traj_place[:] = []
-                    return False
-                else:
-                    rospy.loginfo("Plan " + self.traj_name + ": succeeded")
+    @staticmethod
+    def lift_offset(userdata):
+        if userdata.active_arm == "left":
+            return -userdata.manipulation_options["lift_height"]
+        return userdata.manipulation_options["lift_height"]
 
-            self.traj_place.append(traj_drop)
+    def set_start_state(self, joint_names, positions, attached_objects=None):
+        start_state = RobotState()
+        start_state.joint_state.name = joint_names
+        start_state.joint_state.position = positions
+        start_state.attached_collision_objects[:] = attached_objects or []
+        start_state.is_diff = True
+        self.planer.set_start_state(start_state)
+        self.start_state = start_state
 
-            # ----------- RETREAT -----------
-            self.traj_name = "retreat"
-            traj_retreat = RobotTrajectory()
-            start_state = RobotState()
+    def plan_pose_target(self, userdata, pose):
+        # Like plan_joint_target, the portfolio plans to the IK solution of the pose
+        if portfolio_planner is None:
+            self.planer.clear_pose_targets()
+            self.planer.set_pose_target(pose, self.planer.get_end_effector_link())
+            return plan_selected(self.planer, "arm_" + userdata.active_arm, self.traj_name, self.planer_id)
+
+        traj = portfolio_planner.plan_pose("arm_" + userdata.active_arm, self.planer.get_end_effector_link(),
+                                           self.start_state, pose, self.start_state.joint_state.name, self.traj_name,
+                                           statistics_recorder(userdata.active_arm))
+        return RobotTrajectory() if traj is None else traj
+
+    def cartesian_planner(self, arm, eef_link):
+        if not self.adaptive_cartesian:
+            return None
+
+        return AdaptiveCartesianPlanner("arm_" + arm, eef_link, self.adaptive_steps[0], self.adaptive_steps[1],
+                                        self.jump_threshold, self.adaptive_steps[2])
+
+    def cache_key(self, userdata, start_positions, attached_objects, targets, linear):
+        if trajectory_cache is None:
+            return None
+
+        return trajectory_cache.key(userdata.active_arm, start_positions, targets,
+                                    self.planer_id if portfolio_planner is None else portfolio_planner.key(),
+                                    userdata.planning_method, self.eef_step, self.jump_threshold,
+                                    [attached.object.id for attached in attached_objects],
+                                    (linear, userdata.joint_trajectory_speed, joint_limits is not None,
+                                     None if path_simplifier is None else path_simplifier.key()) +
+                                    (self.adaptive_steps if self.adaptive_cartesian else ()))
+
+    def cached_trajectory(self, userdata, key, start_positions, attached_objects):
+        if key is None:
+            return None
+
+        traj = trajectory_cache.get(key)
+        if traj is None:
+            return None
+
+        if not self.trajectory_validator.is_valid("arm_" + userdata.active_arm, traj, attached_objects):
+            rospy.logwarn("Cached " + self.traj_name + " trajectory is not valid in the current planning scene")
+            trajectory_cache.discard(key)
+            return None
+
+        # The start state only matches within the cache resolution
+        traj.joint_trajectory.points[0].positions = list(start_positions)
+        return traj
+
+    def plan_segment(self, userdata, poses, linear):
+        cache_key = self.cache_key(userdata, self.start_state.joint_state.position,
+                                   self.start_state.attached_collision_objects, poses, linear)
+        traj = self.cached_trajectory(userdata, cache_key, self.start_state.joint_state.position,
+                                      self.start_state.attached_collision_objects)
+        if traj is not None:
+            rospy.loginfo("Plan " + self.traj_name + ": cached")
+            return traj
+
+        if linear:
+            start = time.time()
+            if self.adaptive_cartesian:
+                (traj, fraction, steps) = self.cartesian_planner(
+                    userdata.active_arm, self.planer.get_end_effector_link()).plan(self.planning_client,
+                                                                                   self.start_state, poses,
+                                                                                   self.traj_name)
+            else:
+                (traj, fraction) = self.planer.compute_cartesian_path(poses, self.eef_step, self.jump_threshold,
+                                                                      True)
+            record_planning(self.traj_name, userdata.active_arm, "compute_cartesian_path", fraction == 1.0, start)
+
+            if fraction < 0.5:
+                rospy.logerr("Plan " + self.traj_name + ": " + str(round(fraction * 100, 2)) + "%")
+            elif 0.5 <= fraction < 1.0:
+                rospy.logwarn("Plan " + self.traj_name + ": " + str(round(fraction * 100, 2)) + "%")
+            else:
+                rospy.loginfo("Plan " + self.traj_name + ": " + str(round(fraction * 100, 2)) + "%")
 
-            traj_drop_endpoint = traj_drop.joint_trajectory.points[-1]
-            start_state.joint_state.name = traj_drop.joint_trajectory.joint_names
-            start_state.joint_state.position = traj_drop_endpoint.positions
-            start_state.attached_collision_objects[:] = []
-            start_state.is_diff = True
-            self.planer.set_start_state(start_state)
+            if fraction != 1.0:
+                userdata.error_message = "Unable to plan " + self.traj_name + " trajectory"
+                userdata.error_counter += 1
+                return None
 
-            retreat_pose_offset = PoseStamped()
-            retreat_pose_offset.header.frame_id = "current_object"
-            retreat_pose_offset.header.stamp = rospy.Time(0)
-            retreat_pose_offset.pose.position.x = -userdata.manipulation_options["approach_dist"]
-            retreat_pose_offset.pose.orientation.w = 1
+            traj = postprocess_linear_plan(traj, self.planer.get_end_effector_link())
 
+        else:
             try:
-                retreat_pose = self.tf_listener.transformPose("base_link", retreat_pose_offset)
-            except Exception, e:
-                userdata.error_message = "Could not transform pose. Exception: " + str(e)
+                traj = self.plan_pose_target(userdata, poses[-1])
+                traj = postprocess_plan(traj, userdata.joint_trajectory_speed, "arm_" + userdata.active_arm,
+                                        self.start_state.attached_collision_objects)
+            except (ValueError, IndexError):
+                rospy.loginfo("Plan " + self.traj_name + ": failed")
+                userdata.error_message = "Unable to plan " + self.traj_name + " trajectory"
                 userdata.error_counter += 1
-                self.traj_place[:] = []
-                return False
-
-            if userdata.planning_method == "cartesian_linear" or userdata.planning_method == "cartesian_mixed":
-
-                (traj_retreat, frac_retreat) = self.planer.compute_cartesian_path([retreat_pose.pose], self.eef_step,
-                                                                                  self.jump_threshold, True)
-
-                if frac_retreat < 0.5:
-                    rospy.logerr("Plan " + self.traj_name + ": " + str(round(frac_retreat * 100, 2)) + "%")
-                elif 0.5 <= frac_retreat < 1.0:
-                    rospy.logwarn("Plan " + self.traj_name + ": " + str(round(frac_retreat * 100, 2)) + "%")
-                else:
-                    rospy.loginfo("Plan " + self.traj_name + ": " + str(round(frac_retreat * 100, 2)) + "%")
-
-                if frac_retreat != 1.0:
-                    userdata.error_message = "Unable to plan " + self.traj_name + " trajectory"
-                    userdata.error_counter += 1
-                    self.traj_place[:] = []
-                    return False
-
-            elif userdata.planning_method == "cartesian":
-
-                self.planer.clear_pose_targets()
-                self.planer.set_pose_target(retreat_pose.pose, self.planer.get_end_effector_link())
-
-                try:
-                    traj_retreat = self.planer.plan()
-                    traj_retreat = smooth_cartesian_path(traj_retreat)
-                    traj_retreat = scale_joint_trajectory_speed(traj_retreat, userdata.joint_trajectory_speed)
-                except (ValueError, IndexError):
-                    rospy.loginfo("Plan " + self.traj_name + ": failed")
-                    userdata.error_message = "Unable to plan " + self.traj_name + " trajectory"
-                    userdata.error_counter += 1
-                    self.traj_place[:] = []
-                    return False
-                else:
-                    rospy.loginfo("Plan " + self.traj_name + ": succeeded")
+                return None
+            else:
+                rospy.loginfo("Plan " + self.traj_name + ": succeeded")
 
-            self.traj_place.append(traj_retreat)
+        if cache_key is not None:
+            trajectory_cache.put(cache_key, traj)
 
-            rospy.loginfo("Place planning complete")
+        return traj
 
-            # ----------- TRAJECTORY OPERATIONS -----------
-            userdata.computed_trajectories = self.traj_pick + self.traj_place
+    def finish_trajectories(self, userdata, trajectories):
+        # ----------- TRAJECTORY OPERATIONS -----------
+        userdata.computed_trajectories = trajectories
 
-            rospy.loginfo("Smooth trajectories and fix velocities")
+        rospy.loginfo("Smooth trajectories and fix velocities")
 
-            try:
-                for i in xrange(0, len(userdata.computed_trajectories)):
-                    userdata.computed_trajectories[i] = smooth_cartesian_path(userdata.computed_trajectories[i])
-                    userdata.computed_trajectories[i] = fix_velocities(userdata.computed_trajectories[i])
-            except (ValueError, IndexError, AttributeError):
-                userdata.computed_trajectories[:] = []
-                self.traj_pick[:] = []
-                self.traj_place[:] = []
-                userdata.cs_position = "start"
-                userdata.error_message = "Error: " + str(AttributeError)
-                userdata.error_counter += 1
-                return False
+        # Streamed segments are joined and blended, only the first and the last one need an offset. The joined
+        # trajectories stop at their end.
+        last = len(userdata.computed_trajectories) - 1
 
+        try:
+            for i in xrange(0, len(userdata.computed_trajectories)):
+                userdata.computed_trajectories[i] = process_trajectory(
+                    userdata.computed_trajectories[i],
+                    time_offset=0.0 if self.streaming_execution and i != 0 else SMOOTHING_OFFSET,
+                    end_offset=0.0 if self.streaming_execution and i != last else SMOOTHING_OFFSET,
+                    stop_at_end=not self.streaming_execution)
+        except (ValueError, IndexError, AttributeError):
+            userdata.computed_trajectories[:] = []
             userdata.cs_position = "start"
-            self.cs_ready = False
-            self.traj_pick[:] = []
-            self.traj_place[:] = []
+            userdata.error_message = "Error: " + str(AttributeError)
+            userdata.error_counter += 1
+            return False
 
-            return True
+        userdata.cs_position = "start"
+
+        return True
 
     def plan_joint(self, userdata):
 
@@ -1408,42 +1398,30 @@ class Planning(smach.State):
 
             if 2 <= i <= 4:
                 # Attach object
-                object_shape = SolidPrimitive()
-                object_shape.type = userdata.object["shape"]
-                object_shape.dimensions.append(userdata.object["dimension"][2])  # Height
-                object_shape.dimensions.append(userdata.object["dimension"][0] * 0.5)  # Radius
-
-                object_pose = Pose()
-                object_pose.orientation.w = 1.0
-
-                object_collision = CollisionObject()
-                object_collision.header.frame_id = "gripper_" + userdata.active_arm + "_grasp_link"
-                object_collision.id = "object"
-                object_collision.primitives.append(object_shape)
-                object_collision.primitive_poses.append(object_pose)
-                object_collision.operation = CollisionObject.ADD
-
-                object_attached = AttachedCollisionObject()
-                object_attached.link_name = "gripper_" + userdata.active_arm + "_grasp_link"
-                object_attached.object = object_collision
-                object_attached.touch_links = ["gripper_" + userdata.active_arm + "_base_link",
-                                               "gripper_" + userdata.active_arm + "_camera_link",
-                                               "gripper_" + userdata.active_arm + "_finger_1_link",
-                                               "gripper_" + userdata.active_arm + "_finger_2_link",
-                                               "gripper_" + userdata.active_arm + "_grasp_link",
-                                               "gripper_" + userdata.active_arm + "_palm_link"]
-
-                start_state.attached_collision_objects.append(object_attached)
-
+                start_state.attached_collision_objects.append(attachments.attached_object(userdata.active_arm,
+                                                                                          userdata.object))
             else:
                 start_state.attached_collision_objects[:] = []
 
+            cache_key = self.cache_key(userdata, start_state.joint_state.position,
+                                       start_state.attached_collision_objects, [config.points[0].positions], False)
+            plan = self.cached_trajectory(userdata, cache_key, start_state.joint_state.position,
+                                          start_state.attached_collision_objects)
+            if plan is not None:
+                rospy.loginfo("Planned trajectory " + self.joint_order[i] + " from cache")
+                userdata.computed_trajectories.append(plan)
+                continue
+
             try:
-                plan = plan_movement(self.planer,
-                                     start_state,
-                                     config.points[0].positions,
-                                     userdata.joint_trajectory_speed
-                                     )
+                plan = plan_roadmap_movement(self.planer,
+                                             userdata.active_arm,
+                                             start_state,
+                                             userdata.arm_positions["poses"][i + 1],
+                                             config.points[0].positions,
+                                             userdata.joint_trajectory_speed,
+                                             self.joint_order[i],
+                                             self.planer_id
+                                             )
             except (ValueError, IndexError, AttributeError):
                 rospy.logerr("Planning trajectory " + self.joint_order[i] + " failed")
                 userdata.error_message = "Error: " + str(AttributeError)
@@ -1455,6 +1433,9 @@ class Planning(smach.State):
                 rospy.loginfo("Planned trajectory " + self.joint_order[i] + " successfully")
                 userdata.computed_trajectories.append(plan)
 
+                if cache_key is not None:
+                    trajectory_cache.put(cache_key, plan)
+
         self.last_state = 0
 
         return True
@@ -1464,11 +1445,20 @@ class Execution(smach.State):
     def __init__(self):
         smach.State.__init__(self,
                              outcomes=['succeeded', 'error'],
-                             input_keys=['active_arm', 'planning_method', 'computed_trajectories'],
+                             input_keys=['active_arm', 'planning_method', 'computed_trajectories', 'object'],
                              output_keys=['error_message', 'joint_goal_position', 'computed_trajectories'])
 
         self.planer = mgc_right
 
+        # Join consecutive segments into one trajectory, the arm only stops where the gripper is moved
+        self.streaming_execution = rospy.get_param(rospy.get_name() + "/streaming_execution", False)
+        self.blend_window = rospy.get_param(rospy.get_name() + "/streaming_blend_window", 0.5)
+        self.use_gripper = rospy.get_param(rospy.get_name() + "/move_gripper", False)
+        self.attach_object = rospy.get_param(rospy.get_name() + "/attach_object", False)
+
+        self.segment_names = ["approach", "grasp", "lift", "move", "drop", "retreat"]
+        self.gripper_actions = {"approach": "open", "grasp": "close", "drop": "open", "retreat": "close"}
+
     def execute(self, userdata):
 
         if userdata.active_arm == "left":
@@ -1488,25 +1478,23 @@ class Execution(smach.State):
 
         # ----------- EXECUTE -----------
         rospy.loginfo("---- Start execution ---")
-        rospy.loginfo("------- Approach -------")
-        self.planer.execute(userdata.computed_trajectories[0])
-        # self.move_gripper(userdata, "gripper_" + userdata.active_arm, "open")
-        rospy.loginfo("--------- Grasp --------")
-        self.planer.execute(userdata.computed_trajectories[1])
-        # self.move_gripper(userdata, "gripper_" + userdata.active_arm, "close")
-        rospy.loginfo("--------- Lift ---------")
-        self.planer.execute(userdata.computed_trajectories[2])
-        rospy.loginfo("--------- Move ---------")
-        self.planer.execute(userdata.computed_trajectories[3])
-        rospy.loginfo("--------- Drop ---------")
-        self.planer.execute(userdata.computed_trajectories[4])
-        # self.move_gripper(userdata, "gripper_" + userdata.active_arm, "open")
-        if userdata.planning_method == "joint":
-            userdata.joint_goal_position = \
-                self.planer.get_current_pose(self.planer.get_end_effector_link()).pose.position
-        rospy.loginfo("-------- Retreat -------")
-        self.planer.execute(userdata.computed_trajectories[5])
-        # self.move_gripper(userdata, "gripper_" + userdata.active_arm, "close")
+        if self.streaming_execution:
+            succeeded = self.execute_streaming(userdata)
+        else:
+            for i in xrange(len(userdata.computed_trajectories)):
+                rospy.loginfo((" " + self.segment_names[i].title() + " ").center(24, "-"))
+                self.planer.execute(userdata.computed_trajectories[i])
+                self.segment_finished(userdata, i)
+            succeeded = True
+
+        if not succeeded:
+            abort_execution = False
+            attachments.detach_all()
+            userdata.computed_trajectories[:] = []
+            userdata.error_message = "Execution aborted by user"
+            execution_recorder.error()
+            return "error"
+
         rospy.loginfo("-- Execution finished --")
 
         execution_recorder.stop()
@@ -1516,6 +1504,76 @@ class Execution(smach.State):
 
         return "succeeded"
 
+    def segment_finished(self, userdata, index):
+        name = self.segment_names[index]
+
+        if name == "drop" and userdata.planning_method == "joint":
+            userdata.joint_goal_position = \
+                self.planer.get_current_pose(self.planer.get_end_effector_link()).pose.position
+
+        if self.use_gripper and name in self.gripper_actions:
+            self.move_gripper(userdata, "gripper_" + userdata.active_arm, self.gripper_actions[name])
+
+        # The object is carried from grasp to drop and left where it was dropped
+        if self.attach_object:
+            if name == "grasp":
+                attachments.attach(userdata.active_arm, userdata.object)
+            elif name == "drop":
+                attachments.detach(userdata.active_arm)
+
+    def execute_streaming(self, userdata):
+        # Segments are split after every gripper action, the arm has to stop there
+        chains = [[]]
+        for i in xrange(len(userdata.computed_trajectories)):
+            chains[-1].append(i)
+            if self.use_gripper and self.segment_names[i] in self.gripper_actions:
+                chains.append([])
+
+        for chain in chains:
+            if len(chain) == 0:
+                continue
+
+            (traj, end_times) = concatenate_trajectories([userdata.computed_trajectories[i] for i in chain],
+                                                         blend_window=self.blend_window)
+
+            rospy.loginfo((" " + " / ".join(self.segment_names[i].title() for i in chain) + " ").center(24, "-"))
+            start_time = rospy.Time.now()
+            self.planer.execute(traj, wait=False)
+
+            # Boundary events are timed by the trajectory, the last one waits until the arm has arrived
+            for (i, end_time) in zip(chain, end_times):
+                if not self.wait_until(start_time + rospy.Duration.from_sec(end_time)):
+                    return False
+
+                if i == chain[-1]:
+                    self.wait_for_positions(traj.joint_trajectory.points[-1].positions)
+
+                rospy.loginfo("Segment " + self.segment_names[i] + " finished")
+                self.segment_finished(userdata, i)
+
+        return True
+
+    def wait_until(self, stamp):
+        rate = rospy.Rate(100)
+        while not rospy.is_shutdown() and rospy.Time.now() < stamp:
+            if abort_execution:
+                self.planer.stop()
+                return False
+            rate.sleep()
+
+        return not rospy.is_shutdown()
+
+    def wait_for_positions(self, positions, tolerance=0.01, timeout=2.0):
+        deadline = rospy.Time.now() + rospy.Duration.from_sec(timeout)
+        rate = rospy.Rate(100)
+        while not rospy.is_shutdown() and rospy.Time.now() < deadline:
+            if np.max(np.abs(np.asarray(self.planer.get_current_joint_values()) - np.asarray(positions))) <= tolerance:
+                return True
+            rate.sleep()
+
+        rospy.logwarn("Arm did not reach the end of the trajectory within " + str(timeout) + "s")
+        return False
+
     @staticmethod
     def move_gripper(userdata, component_name, pos):
         error_code = -1
@@ -1548,39 +1606,44 @@ class SwitchArm(smach.State):
         self.counter = 1
 
     def execute(self, userdata):
-        if self.counter == userdata.manipulation_options["repeats"]:
+        next_cycle = self.next_cycle(userdata)
+        if next_cycle is None:
             return "finished"
 
-        elif not userdata.switch_arm:
-            userdata.cs_position = "start"
-            userdata.cs_orientation[2] = 0.0
-            self.counter += 1.0
+        (active_arm, switch_targets) = next_cycle
+
+        userdata.cs_position = "start"
+        userdata.cs_orientation[2] = 0.0
+        self.counter += 1.0
 
+        if switch_targets:
             return "switch_targets"
 
-        elif userdata.switch_arm:
-            if self.counter % 2 == 0:
-                userdata.cs_position = "start"
-                userdata.cs_orientation[2] = 0.0
-                self.counter += 1.0
+        userdata.active_arm = active_arm
+        self.set_arm_orientation(active_arm, userdata.cs_orientation)
 
-                return "switch_targets"
+        return "succeeded"
 
-            if userdata.active_arm == "left":
-                userdata.active_arm = "right"
-                userdata.cs_orientation[3] = 1.0
-                userdata.cs_orientation[0] = 0.0
+    def next_cycle(self, userdata):
+        # Returns the arm of the next manipulation and if the targets are switched, None after the last one
+        if self.counter == userdata.manipulation_options["repeats"]:
+            return None
 
-            elif userdata.active_arm == "right":
-                userdata.active_arm = "left"
-                userdata.cs_orientation[3] = -1.0
-                userdata.cs_orientation[0] = math.pi
+        if not userdata.switch_arm or self.counter % 2 == 0:
+            return userdata.active_arm, True
 
-            userdata.cs_position = "start"
-            userdata.cs_orientation[2] = 0.0
-            self.counter += 1.0
+        if userdata.active_arm == "left":
+            return "right", False
+        return "left", False
 
-        return "succeeded"
+    @staticmethod
+    def set_arm_orientation(active_arm, cs_orientation):
+        if active_arm == "right":
+            cs_orientation[3] = 1.0
+            cs_orientation[0] = 0.0
+        elif active_arm == "left":
+            cs_orientation[3] = -1.0
+            cs_orientation[0] = math.pi
 
 
 class SwitchTargets(smach.State):
@@ -1591,26 +1654,26 @@ class SwitchTargets(smach.State):
                              output_keys=['arm_positions'])
 
     def execute(self, userdata):
-        if userdata.planning_method != "joint":
-            (userdata.arm_positions["right"]["start"], userdata.arm_positions["right"]["goal"]) = \
-                self.switch_values(userdata.arm_positions["right"]["start"],
-                                   userdata.arm_positions["right"]["goal"])
-            (userdata.arm_positions["left"]["start"], userdata.arm_positions["left"]["goal"]) = \
-                self.switch_values(userdata.arm_positions["left"]["start"],
-                                   userdata.arm_positions["left"]["goal"])
-
-            userdata.arm_positions["right"]["waypoints"] = \
-                list(reversed(userdata.arm_positions["right"]["waypoints"]))
-            userdata.arm_positions["left"]["waypoints"] = \
-                list(reversed(userdata.arm_positions["left"]["waypoints"]))
-        else:
-            temp = [userdata.arm_positions["poses"][0], userdata.arm_positions["poses"][-1]]
-            userdata.arm_positions["poses"] = list(reversed(userdata.arm_positions["poses"]))
-            userdata.arm_positions["poses"][0] = temp[0]
-            userdata.arm_positions["poses"][-1] = temp[-1]
+        self.switch_positions(userdata.arm_positions, userdata.planning_method)
 
         return "succeeded"
 
+    @classmethod
+    def switch_positions(cls, arm_positions, planning_method):
+        if planning_method != "joint":
+            (arm_positions["right"]["start"], arm_positions["right"]["goal"]) = \
+                cls.switch_values(arm_positions["right"]["start"], arm_positions["right"]["goal"])
+            (arm_positions["left"]["start"], arm_positions["left"]["goal"]) = \
+                cls.switch_values(arm_positions["left"]["start"], arm_positions["left"]["goal"])
+
+            arm_positions["right"]["waypoints"] = list(reversed(arm_positions["right"]["waypoints"]))
+            arm_positions["left"]["waypoints"] = list(reversed(arm_positions["left"]["waypoints"]))
+        else:
+            temp = [arm_positions["poses"][0], arm_positions["poses"][-1]]
+            arm_positions["poses"] = list(reversed(arm_positions["poses"]))
+            arm_positions["poses"][0] = temp[0]
+            arm_positions["poses"][-1] = temp[-1]
+
     @staticmethod
     def switch_values(item1, item2):
         temp = item1
@@ -1635,23 +1698,160 @@ class SM(smach.StateMachine):
         smach.StateMachine.__init__(self, outcomes=['ended'])
 
         # ---- INITIALIZATION ----
-        global sss, mgc_left, mgc_right, planning_scene, planning_scene_interface, pub_planning_scene, \
-            planning_recorder, execution_recorder, abort_execution
+        global sss, mgc_left, mgc_right, scene_client, planning_scene_interface, pub_planning_scene, \
+            planning_recorder, execution_recorder, abort_execution, trajectory_cache, plan_prefetcher, \
+            reachability_maps, joint_roadmap, attachments, joint_limits, path_simplifier, latency_metrics, \
+            portfolio_planner, planner_statistics, planner_selector, scene_clearance, spawned_scene
         sss = simple_script_server()
         mgc_left = MoveGroupCommander("arm_left")
         mgc_right = MoveGroupCommander("arm_right")
 
-        planning_scene = PlanningScene()
-        planning_scene.is_diff = True
-
         planning_scene_interface = PlanningSceneInterface()
         pub_planning_scene = rospy.Publisher("planning_scene", PlanningScene, queue_size=1)
+        scene_client = PlanningSceneClient(pub_planning_scene)
+
+        # ---- SHARED SCENE ----
+        # Collision objects in shared memory for other processes, e.g. planning or checking workers
+        if rospy.get_param(rospy.get_name() + "/shared_scene", False):
+            scene_client.mirror = SharedSceneWriter(rospy.get_param(rospy.get_name() + "/shared_scene_name",
+                                                                    "cob_grasping_app_scene"))
+            rospy.on_shutdown(scene_client.mirror.close)
+            rospy.loginfo("Shared scene: " + scene_client.mirror.filename)
+
+        # ---- LATENCY METRICS ----
+        if rospy.get_param(rospy.get_name() + "/latency_metrics", False):
+            latency_metrics = LatencyRecorder(rospy.get_param(rospy.get_name() + "/latency_metrics_size", 100000))
+            self.latency_metrics_file = rospy.get_param(rospy.get_name() + "/latency_metrics_file",
+                                                        "~/.ros/cob_grasping_app/latency_metrics.csv")
+
+            for mgc in [mgc_left, mgc_right]:
+                latency_metrics.instrument(mgc, ["plan", "compute_cartesian_path"], "planner", mgc.get_name() + ".")
+            latency_metrics.instrument(PlanningClient, ["plan", "cartesian_path", "compute_ik", "compute_fk",
+                                                        "is_state_valid"], "planner", "PlanningClient.")
+            latency_metrics.instrument(pub_planning_scene, ["publish"], "scene", "planning_scene.")
+            latency_metrics.instrument(scene_client, ["commit", "attach", "detach", "reset"], "scene",
+                                       "PlanningSceneClient.")
+            rospy.on_shutdown(self.flush_latency_metrics)
+        else:
+            latency_metrics = None
+        attachments = AttachmentManager(scene_client)
 
         planning_recorder = RecordingManager("planning")
         execution_recorder = RecordingManager("execution")
 
         abort_execution = False
 
+        # ---- TRAJECTORY CACHE ----
+        if rospy.get_param(rospy.get_name() + "/trajectory_cache", False):
+            trajectory_cache = TrajectoryCache(rospy.get_param(rospy.get_name() + "/trajectory_cache_dir",
+                                                               "~/.ros/cob_grasping_app/trajectory_cache"),
+                                               rospy.get_param(rospy.get_name() + "/trajectory_cache_size", 1000))
+            rospy.loginfo("Trajectory cache with " + str(len(trajectory_cache)) + " entries loaded")
+            rospy.on_shutdown(self.flush_trajectory_cache)
+        else:
+            trajectory_cache = None
+
+        # ---- JOINT ROADMAP ----
+        if rospy.get_param(rospy.get_name() + "/joint_roadmap", False):
+            joint_roadmap = JointRoadmap(rospy.get_param(rospy.get_name() + "/joint_roadmap_dir",
+                                                         "~/.ros/cob_grasping_app/joint_roadmap"),
+                                         TrajectoryValidator(PlanningClient(),
+                                                             rospy.get_param(rospy.get_name() +
+                                                                             "/joint_roadmap_check_stride", 2)),
+                                         rospy.get_param(rospy.get_name() + "/joint_roadmap_tolerance", 0.02))
+            rospy.on_shutdown(joint_roadmap.log_statistics)
+        else:
+            joint_roadmap = None
+
+        # ---- TRAJECTORY RETIMING ----
+        if rospy.get_param(rospy.get_name() + "/time_optimal_retiming", False):
+            joint_limits = JointLimits(
+                default_velocity=rospy.get_param(rospy.get_name() + "/retiming_default_velocity", 1.0),
+                default_acceleration=rospy.get_param(rospy.get_name() + "/retiming_default_acceleration", 1.0))
+        else:
+            joint_limits = None
+
+        # ---- PATH SIMPLIFICATION ----
+        shortcutting = rospy.get_param(rospy.get_name() + "/path_shortcutting", False)
+        decimation = rospy.get_param(rospy.get_name() + "/path_decimation", False)
+        if shortcutting or decimation:
+            path_simplifier = PathSimplifier(
+                PlanningClient() if shortcutting else None,
+                rospy.get_param(rospy.get_name() + "/shortcut_iterations", 30),
+                rospy.get_param(rospy.get_name() + "/shortcut_resolution", 0.05),
+                rospy.get_param(rospy.get_name() + "/decimation_tolerance", 0.005) if decimation else None,
+                linear_tolerance=rospy.get_param(rospy.get_name() + "/linear_decimation_tolerance", 0.001)
+                if decimation else None,
+                lever_arms=LeverArms() if decimation else None)
+        else:
+            path_simplifier = None
+
+        # ---- PLANNER PORTFOLIO ----
+        portfolio = rospy.get_param(rospy.get_name() + "/planner_portfolio", [])
+        if portfolio:
+            # One planning client per planner and move_group instance, so all planners run at the same time
+            portfolio_planner = PortfolioPlanner(
+                PlanningClientPool(rospy.get_param(rospy.get_name() + "/planning_services", [""]), len(portfolio)),
+                portfolio,
+                rospy.get_param(rospy.get_name() + "/planner_portfolio_mode", "first"),
+                rospy.get_param(rospy.get_name() + "/planner_portfolio_deadline", 5.0))
+            rospy.loginfo("Planner portfolio: " + ", ".join(portfolio))
+        else:
+            portfolio_planner = None
+
+        # ---- PLANNER SELECTION ----
+        candidates = rospy.get_param(rospy.get_name() + "/planner_selection", [])
+        if rospy.get_param(rospy.get_name() + "/planner_statistics", False) or candidates:
+            planner_statistics = PlannerStatistics(
+                rospy.get_param(rospy.get_name() + "/planner_statistics_file",
+                                "~/.ros/cob_grasping_app/planner_statistics.yaml"),
+                rospy.get_param(rospy.get_name() + "/planner_statistics_window", 200))
+            rospy.on_shutdown(self.save_planner_statistics)
+        else:
+            planner_statistics = None
+
+        if candidates and portfolio_planner is not None:
+            rospy.logwarn("Planner selection is not used together with the planner portfolio")
+            planner_selector = None
+        elif candidates:
+            planner_selector = PlannerSelector(planner_statistics, candidates,
+                                               rospy.get_param(rospy.get_name() + "/planner_selection_min_calls", 1))
+            rospy.loginfo("Planner selection: " + ", ".join(candidates))
+        else:
+            planner_selector = None
+
+        # ---- CLEARANCE CHECK ----
+        # Built by SCENE_MANAGER for every spawned scene
+        scene_clearance = None
+        spawned_scene = None  # (scenario, fingerprint) of the collision world, set by SCENE_MANAGER
+
+        # ---- REACHABILITY MAPS ----
+        reachability_maps = {}
+        reachability_dir = os.path.expanduser(rospy.get_param(rospy.get_name() + "/reachability_map_dir",
+                                                              "~/.ros/cob_grasping_app/reachability"))
+        for arm in ["left", "right"]:
+            filename = os.path.join(reachability_dir, "arm_" + arm + ".rmap")
+            if os.path.isfile(filename):
+                try:
+                    reachability_maps[arm] = ReachabilityMap.load(filename)
+                    rospy.loginfo("Reachability map for " + arm + " arm loaded")
+                except (IOError, ValueError), e:
+                    rospy.logwarn("Unable to load reachability map '" + filename + "': " + str(e))
+
+        # ---- PIPELINED PLANNING ----
+        if rospy.get_param(rospy.get_name() + "/pipelined_planning", False):
+            if rospy.get_param("/planning_method") == "joint":
+                rospy.logwarn("Pipelined planning is only available for cartesian planning methods")
+                plan_prefetcher = None
+            elif rospy.get_param(rospy.get_name() + "/attach_object", False):
+                # The next manipulation would be planned with the object still attached
+                rospy.logwarn("Pipelined planning is not available if the object is attached during execution")
+                plan_prefetcher = None
+            else:
+                plan_prefetcher = PlanPrefetcher()
+        else:
+            plan_prefetcher = None
+
         # ---- GET PARAMETER ----
         self.userdata.active_arm = "right"
         self.userdata.planning_method = rospy.get_param("/planning_method")
@@ -1698,42 +1898,79 @@ class SM(smach.StateMachine):
             self.br = tf.TransformBroadcaster()
             rospy.Timer(rospy.Duration.from_sec(0.01), self.broadcast_tf)
 
+        switch_arm = SwitchArm()
+
         with self:
             # ---- STATES ----
-            smach.StateMachine.add('SCENE_MANAGER', SceneManager(),
+            smach.StateMachine.add('SCENE_MANAGER', self.instrumented('SCENE_MANAGER', SceneManager()),
                                    transitions={'succeeded': 'START_POSITION',
                                                 'exit': 'ended'})
 
-            smach.StateMachine.add('START_POSITION', StartPosition(),
+            smach.StateMachine.add('START_POSITION', self.instrumented('START_POSITION', StartPosition()),
                                    transitions={'succeeded': 'PLANNING',
                                                 'failed': 'START_POSITION',
                                                 'error': 'ERROR'})
 
-            smach.StateMachine.add('PLANNING', Planning(),
+            smach.StateMachine.add('PLANNING', self.instrumented('PLANNING', Planning(switch_arm)),
                                    transitions={'succeeded': 'EXECUTION',
                                                 'failed': 'PLANNING',
                                                 'error': 'ERROR'})
 
-            smach.StateMachine.add('EXECUTION', Execution(),
+            smach.StateMachine.add('EXECUTION', self.instrumented('EXECUTION', Execution()),
                                    transitions={'succeeded': 'END_POSITION',
                                                 'error': 'ERROR'})
 
-            smach.StateMachine.add('END_POSITION', EndPosition(),
+            smach.StateMachine.add('END_POSITION', self.instrumented('END_POSITION', EndPosition()),
                                    transitions={'succeeded': 'SWITCH_ARM',
                                                 'failed': 'END_POSITION',
                                                 'error': 'ERROR'})
 
-            smach.StateMachine.add('SWITCH_ARM', SwitchArm(),
+            smach.StateMachine.add('SWITCH_ARM', self.instrumented('SWITCH_ARM', switch_arm),
                                    transitions={'succeeded': 'START_POSITION',
                                                 'switch_targets': 'SWITCH_TARGETS',
                                                 'finished': 'ended'})
 
-            smach.StateMachine.add('SWITCH_TARGETS', SwitchTargets(),
+            smach.StateMachine.add('SWITCH_TARGETS', self.instrumented('SWITCH_TARGETS', SwitchTargets()),
                                    transitions={'succeeded': 'START_POSITION'})
 
-            smach.StateMachine.add('ERROR', Error(),
+            smach.StateMachine.add('ERROR', self.instrumented('ERROR', Error()),
                                    transitions={'finished': 'ended'})
 
+    def instrumented(self, label, state):
+        if latency_metrics is None:
+            return state
+        return latency_metrics.instrument_state(label, state)
+
+    def execute(self, parent_ud=smach.UserData()):
+        try:
+            return smach.StateMachine.execute(self, parent_ud)
+        finally:
+            self.flush_latency_metrics()
+
+    def flush_trajectory_cache(self):
+        try:
+            trajectory_cache.flush()
+        except (IOError, OSError), e:
+            rospy.logwarn("Unable to write the trajectory cache index: " + str(e))
+
+    def save_planner_statistics(self):
+        try:
+            planner_statistics.save()
+        except (IOError, OSError), e:
+            rospy.logwarn("Unable to write planner statistics: " + str(e))
+        planner_statistics.log_summary()
+
+    def flush_latency_metrics(self):
+        # At the end of execute and on shutdown, only written again if there are new entries
+        if latency_metrics is None or not latency_metrics.unflushed():
+            return
+
+        try:
+            latency_metrics.flush(self.latency_metrics_file)
+        except (IOError, OSError), e:
+            rospy.logwarn("Unable to write latency metrics: " + str(e))
+        latency_metrics.log_summary()
+
     def broadcast_tf(self, event):
         self.br.sendTransform(
             (self.userdata.arm_positions[self.userdata.active_arm][self.userdata.cs_position].x,
@@ -1755,6 +1992,11 @@ class TestRecording(unittest.TestCase):
         self.services = robot_config['wait_for_services']
 
     def tearDown(self):
+        # The parallel suite runner stops the gazebo instance of its worker, others must keep running. The bench
+        # daemon keeps gazebo alive for the next run.
+        if "GRASPING_APP_TEST_WORKER" in os.environ or "GRASPING_APP_BENCH_DAEMON" in os.environ:
+            return
+
         call("killall gzclient", shell=True)
         call("killall gzserver", shell=True)
 
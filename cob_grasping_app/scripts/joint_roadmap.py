@@ -0,0 +1,273 @@
+#!/usr/bin/python
+import hashlib
+import heapq
+import os
+import threading
+from StringIO import StringIO
+
+import numpy as np
+import yaml
+
+import rospy
+from moveit_msgs.msg import RobotTrajectory
+from trajectory_msgs.msg import JointTrajectoryPoint
+
+from trajectory_processing import concatenate_trajectories
+
+
+def reverse_trajectory(traj):
+    # The same path backwards: time is mirrored, velocities change their sign
+    reversed_traj = RobotTrajectory()
+    reversed_traj.joint_trajectory.header = traj.joint_trajectory.header
+    reversed_traj.joint_trajectory.joint_names = list(traj.joint_trajectory.joint_names)
+
+    points = traj.joint_trajectory.points
+    duration = points[-1].time_from_start
+    for point in reversed(points):
+        reversed_point = JointTrajectoryPoint()
+        reversed_point.positions = list(point.positions)
+        reversed_point.velocities = [-v for v in point.velocities]
+        reversed_point.accelerations = list(point.accelerations)
+        reversed_point.time_from_start = duration - point.time_from_start
+        reversed_traj.joint_trajectory.points.append(reversed_point)
+
+    return reversed_traj
+
+
+def path_length(traj):
+    positions = np.array([point.positions for point in traj.joint_trajectory.points], dtype=np.float64)
+    return float(np.linalg.norm(np.diff(positions, axis=0), axis=1).sum()) if len(positions) > 1 else 0.0
+
+
+class JointRoadmap(object):
+    # Verified joint space edges between the named configurations of the arms (start_1, approach_1, ...), stored per
+    # scene. Edges are the unprocessed planner results and are used in both directions, a lookup chains them with a
+    # shortest path search. Every edge of a path is checked against the current planning scene before it is used,
+    # invalid edges are dropped. The roadmap of a scene is cleared when the scene is spawned with a different
+    # fingerprint.
+    def __init__(self, directory, validator, tolerance=0.02):
+        self.directory = os.path.expanduser(directory)
+        self.validator = validator
+        self.tolerance = tolerance
+
+        self.scene_id = None
+        self.fingerprint = ""
+        self.hits = 0
+        self.misses = 0
+
+        self.lock = threading.Lock()
+        self.nodes = {}  # arm -> {name: positions}
+        self.edges = {}  # (arm, attached_ids) -> {name: {name: [filename, cost]}}, stored from the lower name
+
+    # ---- FILES ----
+    def scene_directory(self):
+        return os.path.join(self.directory, self.scene_id)
+
+    def index_file(self):
+        return os.path.join(self.scene_directory(), "roadmap.yaml")
+
+    def edge_file(self, filename):
+        return os.path.join(self.scene_directory(), filename)
+
+    def load(self):
+        self.nodes = {}
+        self.edges = {}
+        if not os.path.isfile(self.index_file()):
+            return
+
+        with open(self.index_file(), 'r') as stream:
+            doc = yaml.safe_load(stream) or {}
+
+        if doc.get("fingerprint") != self.fingerprint:
+            rospy.loginfo("Joint roadmap: scene '" + self.scene_id + "' changed, roadmap cleared")
+            for (arm, attached_ids, name_a, name_b, filename, cost) in doc.get("edges", []):
+                self.delete_file(filename)
+            return
+
+        self.nodes = doc.get("nodes", {})
+        for (arm, attached_ids, name_a, name_b, filename, cost) in doc.get("edges", []):
+            if os.path.isfile(self.edge_file(filename)):
+                self.connect((arm, tuple(attached_ids)), name_a, name_b, [filename, cost])
+
+    def save(self):
+        # Caller holds the lock
+        edges = []
+        for ((arm, attached_ids), adjacency) in self.edges.iteritems():
+            for (name_a, neighbours) in adjacency.iteritems():
+                for (name_b, (filename, cost)) in neighbours.iteritems():
+                    if name_a < name_b:
+                        edges.append([arm, list(attached_ids), name_a, name_b, filename, cost])
+
+        doc = {"fingerprint": self.fingerprint, "nodes": self.nodes, "edges": sorted(edges)}
+
+        if not os.path.isdir(self.scene_directory()):
+            os.makedirs(self.scene_directory())
+
+        filename = self.index_file() + ".tmp"
+        with open(filename, 'w') as stream:
+            yaml.safe_dump(doc, stream)
+        os.rename(filename, self.index_file())
+
+    def delete_file(self, filename):
+        try:
+            os.remove(self.edge_file(filename))
+        except OSError:
+            pass
+
+    # ---- SCENE ----
+    def set_scene(self, scene_id, fingerprint):
+        with self.lock:
+            self.scene_id = scene_id
+            self.fingerprint = fingerprint
+            self.load()
+
+    # ---- NODES ----
+    def add_node(self, arm, name, positions):
+        with self.lock:
+            if self.scene_id is None:
+                return
+
+            positions = [float(value) for value in positions]
+            known = self.nodes.setdefault(arm, {}).get(name)
+            if known is not None and np.allclose(known, positions, atol=1e-6):
+                return
+
+            # The configuration was changed, its edges lead somewhere else now
+            if known is not None:
+                for (key, adjacency) in self.edges.items():
+                    if key[0] == arm:
+                        for neighbour in adjacency.get(name, {}).keys():
+                            self.disconnect(key, name, neighbour)
+
+            self.nodes[arm][name] = positions
+            self.save()
+
+    def node_at(self, arm, positions):
+        # Name of the configuration the arm is in, None if it is not at a node
+        best = (None, self.tolerance)
+        for (name, node_positions) in self.nodes.get(arm, {}).iteritems():
+            distance = np.max(np.abs(np.asarray(node_positions) - np.asarray(positions)))
+            if distance <= best[1]:
+                best = (name, distance)
+        return best[0]
+
+    # ---- EDGES ----
+    def connect(self, key, name_a, name_b, value):
+        adjacency = self.edges.setdefault(key, {})
+        adjacency.setdefault(name_a, {})[name_b] = value
+        adjacency.setdefault(name_b, {})[name_a] = value
+
+    def disconnect(self, key, name_a, name_b):
+        # Caller holds the lock
+        adjacency = self.edges.get(key, {})
+        value = adjacency.get(name_a, {}).pop(name_b, None)
+        adjacency.get(name_b, {}).pop(name_a, None)
+        if value is not None:
+            self.delete_file(value[0])
+
+    def add_edge(self, arm, name_from, name_to, attached_ids, traj):
+        if name_from == name_to:
+            return
+
+        key = (arm, tuple(sorted(attached_ids)))
+
+        # Stored in the direction of the lower name
+        if name_to < name_from:
+            (name_from, name_to, traj) = (name_to, name_from, reverse_trajectory(traj))
+
+        filename = hashlib.sha1(repr((key, name_from, name_to))).hexdigest() + ".traj"
+
+        buff = StringIO()
+        traj.serialize(buff)
+
+        with self.lock:
+            if self.scene_id is None:
+                return
+
+            if not os.path.isdir(self.scene_directory()):
+                os.makedirs(self.scene_directory())
+            with open(self.edge_file(filename), 'wb') as stream:
+                stream.write(buff.getvalue())
+
+            self.connect(key, name_from, name_to, [filename, path_length(traj)])
+            self.save()
+
+    def read_edge(self, key, name_from, name_to):
+        # Caller holds the lock
+        (filename, cost) = self.edges[key][name_from][name_to]
+        try:
+            with open(self.edge_file(filename), 'rb') as stream:
+                traj = RobotTrajectory()
+                traj.deserialize(stream.read())
+        except Exception, e:
+            rospy.logwarn("Joint roadmap: unable to read edge " + filename + ": " + str(e))
+            return None
+
+        return traj if name_from < name_to else reverse_trajectory(traj)
+
+    # ---- SEARCH ----
+    def shortest_path(self, key, name_from, name_to):
+        # Dijkstra over the joint space length of the edges
+        adjacency = self.edges.get(key, {})
+        queue = [(0.0, name_from, [name_from])]
+        visited = set()
+        while queue:
+            (cost, name, path) = heapq.heappop(queue)
+            if name == name_to:
+                return path
+            if name in visited:
+                continue
+            visited.add(name)
+
+            for (neighbour, (filename, edge_cost)) in adjacency.get(name, {}).iteritems():
+                if neighbour not in visited:
+                    heapq.heappush(queue, (cost + edge_cost, neighbour, path + [neighbour]))
+
+        return None
+
+    def lookup(self, arm, name_from, name_to, attached_objects=()):
+        # Unprocessed trajectory from one node to another or None if there is no valid path. The path is read with
+        # the lock held, the validity checks are service calls and run without it.
+        key = (arm, tuple(sorted(attached.object.id for attached in attached_objects)))
+
+        while True:
+            with self.lock:
+                scene_id = self.scene_id
+                path = self.shortest_path(key, name_from, name_to)
+                if path is None or len(path) < 2:
+                    self.misses += 1
+                    return None
+
+                edges = [(name_a, name_b, self.edges[key][name_a][name_b], self.read_edge(key, name_a, name_b))
+                         for (name_a, name_b) in zip(path[:-1], path[1:])]
+
+            invalid = None
+            for (name_a, name_b, value, traj) in edges:
+                if traj is None or not self.validator.is_valid("arm_" + arm, traj, attached_objects):
+                    invalid = (name_a, name_b, value)
+                    break
+
+            if invalid is None:
+                with self.lock:
+                    self.hits += 1
+                trajectories = [traj for (name_a, name_b, value, traj) in edges]
+                if len(trajectories) == 1:
+                    return trajectories[0]
+                return concatenate_trajectories(trajectories, blend=False)[0]
+
+            (name_a, name_b, value) = invalid
+            rospy.logwarn("Joint roadmap: edge " + name_a + " -> " + name_b + " is not valid anymore")
+            with self.lock:
+                # Unless the edge was replaced in the meantime
+                if self.scene_id == scene_id and self.edges.get(key, {}).get(name_a, {}).get(name_b) is value:
+                    self.disconnect(key, name_a, name_b)
+                    self.save()
+
+    def log_statistics(self):
+        with self.lock:
+            rospy.loginfo("Joint roadmap: " + str(self.hits) + " hits, " + str(self.misses) + " misses, " +
+                          str(len(self)) + " edges")
+
+    def __len__(self):
+        return sum(len(neighbours) for adjacency in self.edges.itervalues()
+                   for neighbours in adjacency.itervalues()) // 2
@@ -0,0 +1,187 @@
+#!/usr/bin/python
+import functools
+import os
+import threading
+import time
+
+import numpy as np
+
+import rospy
+
+
+COLUMNS = ["start", "wall", "cpu", "kind", "name", "retries", "outcome"]
+
+
+class Span(object):
+    # Times one block, retries and outcome can be set inside of it
+    __slots__ = ["recorder", "kind", "name", "retries", "outcome", "start", "cpu"]
+
+    def __init__(self, recorder, kind, name, retries=0):
+        self.recorder = recorder
+        self.kind = kind
+        self.name = name
+        self.retries = retries
+        self.outcome = ""
+
+    def __enter__(self):
+        self.start = time.time()
+        self.cpu = time.clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = time.time() - self.start
+        cpu = time.clock() - self.cpu
+        if exc_type is not None:
+            self.outcome = exc_type.__name__
+        self.recorder.record(self.kind, self.name, self.start, wall, cpu, self.retries, self.outcome)
+        return False
+
+
+class NullSpan(object):
+    # Used if no recorder is active
+    __slots__ = ["retries", "outcome"]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class LatencyRecorder(object):
+    # Wall and CPU time of states, segments and service calls in a fixed size ring buffer of NumPy columns, the
+    # oldest entries are overwritten. Strings are stored as indices into a list of names. CPU time is the time of the
+    # whole process (time.clock), calls running in other threads at the same time are included.
+    def __init__(self, capacity=100000):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.count = 0
+        self.flushed = 0  # count at the last flush
+
+        self.start = np.zeros(capacity, dtype=np.float64)
+        self.wall = np.zeros(capacity, dtype=np.float64)
+        self.cpu = np.zeros(capacity, dtype=np.float64)
+        self.kind = np.zeros(capacity, dtype=np.int32)
+        self.name = np.zeros(capacity, dtype=np.int32)
+        self.retries = np.zeros(capacity, dtype=np.int32)
+        self.outcome = np.zeros(capacity, dtype=np.int32)
+
+        self.strings = [""]
+        self.string_ids = {"": 0}
+
+    def string_id(self, value):
+        # Caller holds the lock
+        string_id = self.string_ids.get(value)
+        if string_id is None:
+            string_id = self.string_ids[value] = len(self.strings)
+            self.strings.append(value)
+        return string_id
+
+    def record(self, kind, name, start, wall, cpu, retries=0, outcome=""):
+        with self.lock:
+            i = self.count % self.capacity
+            self.start[i] = start
+            self.wall[i] = wall
+            self.cpu[i] = cpu
+            self.kind[i] = self.string_id(kind)
+            self.name[i] = self.string_id(name)
+            self.retries[i] = retries
+            self.outcome[i] = self.string_id(str(outcome))
+            self.count += 1
+
+    def span(self, kind, name, retries=0):
+        return Span(self, kind, name, retries)
+
+    # ---- INSTRUMENTATION ----
+    def wrap(self, func, kind, name):
+        # A function that was wrapped before is wrapped again from its original, e.g. a class instrumented by an
+        # earlier recorder
+        func = getattr(func, "original", func)
+
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            with Span(self, kind, name):
+                return func(*args, **kwargs)
+        timed.original = func
+        return timed
+
+    def instrument(self, obj, method_names, kind, prefix=""):
+        # Replaces the methods of an object (or a class) with timed ones
+        for method_name in method_names:
+            setattr(obj, method_name, self.wrap(getattr(obj, method_name), kind, prefix + method_name))
+
+    def instrument_state(self, label, state):
+        # Times every execute() of a smach state, repeated executions without another state in between count as
+        # retries
+        execute = state.execute
+        recorder = self
+        retries = [0]
+
+        def timed_execute(userdata):
+            with Span(recorder, "state", label, retries[0]) as span:
+                outcome = execute(userdata)
+                span.outcome = outcome
+            retries[0] = retries[0] + 1 if outcome in ["failed", "error"] else 0
+            return outcome
+
+        state.execute = timed_execute
+        return state
+
+    # ---- EXPORT ----
+    def columns(self):
+        # Oldest entry first, strings resolved
+        with self.lock:
+            n = min(self.count, self.capacity)
+            order = (np.arange(n) + max(0, self.count - self.capacity)) % self.capacity
+            strings = np.array(self.strings, dtype=object)
+            return {"start": self.start[order], "wall": self.wall[order], "cpu": self.cpu[order],
+                    "kind": strings[self.kind[order]], "name": strings[self.name[order]],
+                    "retries": self.retries[order], "outcome": strings[self.outcome[order]]}
+
+    def unflushed(self):
+        with self.lock:
+            return self.count - self.flushed
+
+    def flush(self, filename):
+        # .npz: one array per column, anything else: CSV
+        with self.lock:
+            count = self.count
+        filename = os.path.expanduser(filename)
+        if os.path.dirname(filename) and not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+
+        columns = self.columns()
+        if filename.endswith(".npz"):
+            np.savez(filename, **dict((key, value.astype(str) if value.dtype == object else value)
+                                      for (key, value) in columns.iteritems()))
+        else:
+            with open(filename, 'w') as stream:
+                stream.write(",".join(COLUMNS) + "\n")
+                for row in zip(*[columns[key] for key in COLUMNS]):
+                    stream.write("%.6f,%.6f,%.6f,%s,%s,%d,%s\n" % row)
+
+        rospy.loginfo("Latency metrics: " + str(len(columns["start"])) + " entries written to " + filename)
+        with self.lock:
+            self.flushed = count
+        return filename
+
+    def summary(self):
+        # (kind, name, count, total wall, mean wall, max wall, total cpu) sorted by total wall time
+        columns = self.columns()
+        keys = np.array([kind + "/" + name for (kind, name) in zip(columns["kind"], columns["name"])], dtype=object)
+        rows = []
+        for key in set(keys):
+            mask = keys == key
+            wall = columns["wall"][mask]
+            (kind, name) = key.split("/", 1)
+            rows.append((kind, name, int(mask.sum()), float(wall.sum()), float(wall.mean()), float(wall.max()),
+                         float(columns["cpu"][mask].sum())))
+        return sorted(rows, key=lambda row: -row[3])
+
+    def log_summary(self):
+        for (kind, name, count, total, mean, maximum, cpu) in self.summary():
+            rospy.loginfo("%-8s %-32s %6d x  total %8.3fs  mean %7.3fs  max %7.3fs  cpu %8.3fs" %
+                          (kind, name, count, total, mean, maximum, cpu))
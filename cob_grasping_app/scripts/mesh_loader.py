@@ -0,0 +1,181 @@
+#!/usr/bin/python
+import hashlib
+import os
+import re
+import tempfile
+
+import numpy as np
+
+import rospy
+from geometry_msgs.msg import Point
+from shape_msgs.msg import Mesh, MeshTriangle
+
+
+# Binary STL: 80 byte header, uint32 triangle count, then one 50 byte record per triangle
+STL_HEADER_SIZE = 84
+STL_RECORD = np.dtype([("normal", "<f4", (3,)),
+                       ("vertices", "<f4", (3, 3)),
+                       ("attributes", "<u2")])
+
+ASCII_VERTEX = re.compile(r"vertex\s+(\S+)\s+(\S+)\s+(\S+)")
+
+
+def is_binary_stl(filename):
+    size = os.path.getsize(filename)
+    if size < STL_HEADER_SIZE:
+        return False
+
+    with open(filename, 'rb') as stream:
+        stream.seek(80)
+        count = np.fromfile(stream, dtype="<u4", count=1)[0]
+
+    # ASCII files may start with "solid" as well, the size check is the reliable one
+    return size == STL_HEADER_SIZE + count * STL_RECORD.itemsize
+
+
+def read_binary_stl(filename):
+    # Returns a read only, memory-mapped (triangles x 3 x 3) view of the file
+    with open(filename, 'rb') as stream:
+        stream.seek(80)
+        count = int(np.fromfile(stream, dtype="<u4", count=1)[0])
+
+    if count == 0:
+        return np.zeros((0, 3, 3), dtype=np.float32)
+
+    records = np.memmap(filename, dtype=STL_RECORD, mode='r', offset=STL_HEADER_SIZE, shape=(count,))
+    return records["vertices"]
+
+
+def read_ascii_stl(filename):
+    with open(filename, 'r') as stream:
+        vertices = np.array(ASCII_VERTEX.findall(stream.read()), dtype=np.float32)
+
+    if vertices.shape[0] % 3 != 0:
+        raise ValueError("Invalid ASCII STL file '" + filename + "'")
+
+    return vertices.reshape(-1, 3, 3)
+
+
+def read_stl(filename):
+    if is_binary_stl(filename):
+        return read_binary_stl(filename)
+    return read_ascii_stl(filename)
+
+
+def deduplicate(triangle_vertices):
+    # STL stores every vertex once per triangle, merge identical ones and build the index list
+    flat = np.ascontiguousarray(triangle_vertices, dtype=np.float32).reshape(-1, 3)
+    if flat.shape[0] == 0:
+        return np.zeros((0, 3), dtype=np.float32), np.zeros((0, 3), dtype=np.uint32)
+
+    rows = flat.view(np.dtype((np.void, flat.dtype.itemsize * 3))).ravel()
+    _, first, inverse = np.unique(rows, return_index=True, return_inverse=True)
+
+    return flat[first], inverse.astype(np.uint32).reshape(-1, 3)
+
+
+def to_mesh_msg(vertices, triangles):
+    mesh = Mesh()
+    mesh.vertices = [Point(x, y, z) for (x, y, z) in vertices.tolist()]
+    mesh.triangles = [MeshTriangle(vertex_indices=indices) for indices in triangles.tolist()]
+    return mesh
+
+
+class MeshCache(object):
+    # Collision meshes as (vertices, triangles) arrays, scaled and deduplicated once per (path, mtime, scale).
+    # Processed meshes are stored in the cache directory, the mesh messages are kept in memory.
+    def __init__(self, directory=None):
+        self.directory = None
+        self.messages = {}
+        self.arrays = {}
+
+        if directory is not None:
+            directory = os.path.expanduser(directory)
+            try:
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                self.directory = directory
+            except OSError, e:
+                rospy.logwarn("Mesh cache directory not available, processed meshes are not stored: " + str(e))
+
+    @staticmethod
+    def key(filename, scale):
+        filename = os.path.abspath(filename)
+        return hashlib.sha1(repr((filename, os.path.getmtime(filename), float(scale)))).hexdigest()
+
+    def cache_file(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    def load(self, filename, scale):
+        key = self.key(filename, scale)
+        if key in self.arrays:
+            return self.arrays[key]
+
+        arrays = None
+        if self.directory is not None and os.path.isfile(self.cache_file(key)):
+            try:
+                data = np.load(self.cache_file(key))
+                arrays = (data["vertices"], data["triangles"])
+            except (IOError, KeyError, ValueError), e:
+                rospy.logwarn("Unable to read cached mesh for '" + filename + "': " + str(e))
+
+        if arrays is None:
+            arrays = self.process(filename, scale)
+
+            if self.directory is not None:
+                # Write to a unique temporary file first, other processes may read or build the same mesh at the
+                # same time
+                (fd, temp_file) = tempfile.mkstemp(suffix=".tmp.npz", dir=self.directory)
+                try:
+                    with os.fdopen(fd, 'wb') as stream:
+                        np.savez(stream, vertices=arrays[0], triangles=arrays[1])
+                    os.rename(temp_file, self.cache_file(key))
+                except (IOError, OSError), e:
+                    rospy.logwarn("Unable to store processed mesh for '" + filename + "': " + str(e))
+                    if os.path.isfile(temp_file):
+                        os.remove(temp_file)
+
+        self.arrays[key] = arrays
+        return arrays
+
+    @staticmethod
+    def process(filename, scale):
+        if os.path.splitext(filename)[1].lower() == ".stl":
+            vertices, triangles = deduplicate(read_stl(filename))
+        else:
+            vertices, triangles = read_assimp(filename)
+
+        return vertices.astype(np.float64) * scale, triangles
+
+    def mesh(self, filename, scale):
+        key = self.key(filename, scale)
+        if key not in self.messages:
+            vertices, triangles = self.load(filename, scale)
+            self.messages[key] = to_mesh_msg(vertices, triangles)
+            rospy.loginfo("Loaded mesh '" + os.path.basename(filename) + "': " + str(len(vertices)) +
+                          " vertices, " + str(len(triangles)) + " triangles")
+
+        return self.messages[key]
+
+
+def read_assimp(filename):
+    # Fallback for all other mesh formats, all meshes of the file are merged
+    from pyassimp import pyassimp
+
+    scene = pyassimp.load(filename)
+    try:
+        if not scene.meshes:
+            raise ValueError("Unable to load mesh '" + filename + "'")
+
+        vertices = []
+        triangles = []
+        offset = 0
+        for mesh in scene.meshes:
+            faces = [face.indices for face in mesh.faces if len(face.indices) == 3]
+            vertices.append(np.asarray(mesh.vertices, dtype=np.float32).reshape(-1, 3))
+            triangles.append(np.asarray(faces, dtype=np.uint32).reshape(-1, 3) + offset)
+            offset += vertices[-1].shape[0]
+    finally:
+        pyassimp.release(scene)
+
+    return np.concatenate(vertices), np.concatenate(triangles)
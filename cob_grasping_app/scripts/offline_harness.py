@@ -0,0 +1,566 @@
+#!/usr/bin/python
+import hashlib
+import math
+import os
+import tempfile
+import threading
+import time
+import types
+from copy import copy
+
+import numpy as np
+
+import rospy
+import tf
+from geometry_msgs.msg import Pose, PoseStamped
+from moveit_msgs.msg import CollisionObject, RobotTrajectory
+from trajectory_msgs.msg import JointTrajectory, JointTrajectoryPoint
+
+from scene_updates import PlanningSceneClient
+
+
+# Stand-ins for everything the state machine of grasping_app.py talks to: move_group, the script server, TF, the
+# planning scene, the interactive marker server, the ATF recorder and the parameter server. Nothing needs a ROS
+# master, every call takes the configured latency and fails with the configured rate.
+
+N_JOINTS = 7
+PACKAGE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Parameters of launch/grasping_app.launch, without waiting for the user
+DEFAULT_PARAMETERS = {"/scene_config": "scene_3",
+                      "/planer_id": "RRTConnectkConfigDefault",
+                      "/eef_step": 0.01,
+                      "/jump_threshold": 2,
+                      "/planning_method": "cartesian",
+                      "~scene_config_file": os.path.join(PACKAGE_PATH, "config", "scene_config.yaml"),
+                      "~standalone": True,
+                      "~switch_arm": True,
+                      "~wait_for_user": False,
+                      "~joint_trajectory_speed": 0.3,
+                      "~max_error": 50,
+                      "~lift_height": 0.02,
+                      "~approach_distance": 0.14,
+                      "~manipulation_repeats": 1,
+                      "~load_obstacles": "wall_r"}
+
+
+def group_joint_names(group_name):
+    return [group_name + "_" + str(i + 1) + "_joint" for i in xrange(N_JOINTS)]
+
+
+IK_MATRIX = np.random.RandomState(0).normal(0.0, 0.5, (N_JOINTS, 7))
+
+
+def named_pose(name):
+    # Same pose in front of the robot for the same name
+    seed = int(hashlib.sha1(name).hexdigest()[:8], 16)
+    values = np.random.RandomState(seed).uniform([0.3, -0.5, 0.5, -1.0, -1.0, -1.0, -1.0], [0.9, 0.5, 1.2] + [1.0] * 4)
+    values[3:] /= np.linalg.norm(values[3:])
+    pose = Pose()
+    (pose.position.x, pose.position.y, pose.position.z) = values[:3]
+    (pose.orientation.x, pose.orientation.y, pose.orientation.z, pose.orientation.w) = values[3:]
+    return pose
+
+
+def named_configuration(name):
+    # IK stand-in of the named pose
+    return pose_configuration(named_pose(name))
+
+
+def pose_configuration(pose):
+    # Smooth stand-in for an IK solution, close poses give close configurations. q and -q are the same orientation.
+    sign = -1.0 if pose.orientation.w < 0.0 else 1.0
+    values = [pose.position.x, pose.position.y, pose.position.z, sign * pose.orientation.x,
+              sign * pose.orientation.y, sign * pose.orientation.z, sign * pose.orientation.w]
+    return np.tanh(IK_MATRIX.dot(values))
+
+
+def pose_distance(pose_a, pose_b):
+    return math.sqrt((pose_b.position.x - pose_a.position.x) ** 2 + (pose_b.position.y - pose_a.position.y) ** 2 +
+                     (pose_b.position.z - pose_a.position.z) ** 2)
+
+
+def make_trajectory(joint_names, positions, velocity=0.5):
+    # Timed with a constant joint speed
+    traj = RobotTrajectory()
+    traj.joint_trajectory.joint_names = list(joint_names)
+    steps = np.concatenate([[0.0], np.max(np.abs(np.diff(positions, axis=0)), axis=1)])
+    times = np.cumsum(steps) / velocity
+    for (point, t) in zip(positions.tolist(), times.tolist()):
+        traj.joint_trajectory.points.append(JointTrajectoryPoint(positions=point, velocities=[0.0] * len(point),
+                                                                 accelerations=[0.0] * len(point),
+                                                                 time_from_start=rospy.Duration.from_sec(t)))
+    return traj
+
+
+class CallProfile(object):
+    # Latency (mean and uniform jitter in s) and failure rate of one kind of call
+    def __init__(self, latency=0.0, jitter=0.0, failure_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+
+    def call(self, harness):
+        # True if the call succeeds
+        with harness.lock:
+            delay = self.latency + (harness.random.uniform(-self.jitter, self.jitter) if self.jitter else 0.0)
+            failed = self.failure_rate > 0.0 and harness.random.rand() < self.failure_rate
+        harness.sleep(delay)
+        return not failed
+
+
+class FakeMoveGroupCommander(object):
+    # Plans straight joint space lines with a wiggle (like an unsimplified sampling based plan), cartesian paths
+    # with one point per eef_step. execute() jumps to the end of the trajectory after time_scale times its duration.
+    def __init__(self, harness, name):
+        self.harness = harness
+        self.name = name
+        self.joint_names = group_joint_names(name)
+        self.current = np.zeros(N_JOINTS)
+        self.pose = None
+
+        self.start = None
+        self.target = None
+        self.target_pose = None
+        self.planner_id = ""
+
+    def get_name(self):
+        return self.name
+
+    def get_end_effector_link(self):
+        return "gripper_" + self.name.replace("arm_", "") + "_grasp_link"
+
+    def get_current_joint_values(self):
+        return self.current.tolist()
+
+    def get_current_pose(self, end_effector_link=""):
+        pose = PoseStamped()
+        pose.header.frame_id = "base_link"
+        if self.pose is not None:
+            pose.pose = self.pose
+        return pose
+
+    def set_planner_id(self, planner_id):
+        self.planner_id = planner_id
+
+    def allow_replanning(self, value):
+        pass
+
+    def set_start_state(self, start_state):
+        positions = start_state.joint_state.position
+        self.start = np.asarray(positions, dtype=np.float64) if len(positions) == N_JOINTS else None
+
+    def clear_pose_targets(self):
+        self.target = None
+        self.target_pose = None
+
+    def set_joint_value_target(self, positions):
+        self.target = np.asarray(positions, dtype=np.float64)
+
+    def set_pose_target(self, pose, end_effector_link=""):
+        self.target = pose_configuration(pose)
+        self.target_pose = pose
+
+    def start_positions(self):
+        return self.current if self.start is None else self.start
+
+    def plan(self):
+        profile = self.harness.profiles.get("plan:" + self.planner_id, self.harness.profiles["plan"])
+        if not profile.call(self.harness) or self.target is None:
+            return RobotTrajectory()
+
+        self.harness.remember(self.target, self.target_pose)
+        return make_trajectory(self.joint_names, self.harness.joint_path(self.start_positions(), self.target))
+
+    def compute_cartesian_path(self, waypoints, eef_step, jump_threshold, avoid_collisions=True):
+        if len(waypoints) == 0:
+            return RobotTrajectory(), 0.0
+
+        (positions, fraction) = self.harness.cartesian_path(self.start_positions(), waypoints, eef_step)
+        return make_trajectory(self.joint_names, positions), fraction
+
+    def execute(self, traj, wait=True):
+        if not self.harness.profiles["execute"].call(self.harness):
+            return False
+
+        points = traj.joint_trajectory.points
+        if len(points) == 0:
+            return False
+
+        if wait:
+            self.harness.sleep(points[-1].time_from_start.to_sec() * self.harness.time_scale)
+        self.current = np.asarray(points[-1].positions, dtype=np.float64)
+        self.pose = self.harness.pose_at(self.current, self.pose)
+        return True
+
+    def stop(self):
+        pass
+
+
+class FakePlanningClient(object):
+    # Planning like FakeMoveGroupCommander, every planner id can have its own profile ("plan:<id>"). IK solutions
+    # are remembered for FK like planned targets. harness is set by OfflineHarness.install().
+    harness = None
+
+    def __init__(self, namespace="", frame_id="base_link"):
+        self.namespace = namespace
+        self.frame_id = frame_id
+
+    def wait_for_services(self, timeout=None):
+        pass
+
+    def plan(self, group_name, start_state, joint_names, goal_positions, planner_id, planning_time=5.0,
+             tolerance=1e-4):
+        profile = self.harness.profiles.get("plan:" + planner_id, self.harness.profiles["plan"])
+        if not profile.call(self.harness):
+            return None
+        return make_trajectory(joint_names, self.harness.joint_path(np.asarray(start_state.joint_state.position),
+                                                                    np.asarray(goal_positions)))
+
+    def cartesian_path(self, group_name, link_name, start_state, waypoints, eef_step, jump_threshold,
+                       avoid_collisions=True):
+        if len(waypoints) == 0:
+            return None, 0.0
+
+        (positions, fraction) = self.harness.cartesian_path(np.asarray(start_state.joint_state.position), waypoints,
+                                                            eef_step)
+        return make_trajectory(start_state.joint_state.name, positions), fraction
+
+    def compute_ik(self, group_name, link_name, seed_state, pose, joint_names, avoid_collisions=True, timeout=0.1,
+                   attempts=3):
+        positions = pose_configuration(pose)
+        self.harness.remember(positions, pose)
+        return positions.tolist()
+
+    def compute_fk(self, link_name, robot_state):
+        # Only named configurations and those planned or solved for have a pose, like a failed call otherwise
+        return self.harness.pose_at(robot_state.joint_state.position)
+
+    def is_state_valid(self, group_name, robot_state):
+        return self.harness.profiles["state_validity"].call(self.harness)
+
+
+class FakeHandle(object):
+    def __init__(self, error_code):
+        self.error_code = error_code
+
+    def wait(self, timeout=None):
+        pass
+
+    def get_error_code(self):
+        return self.error_code
+
+
+class FakeScriptServer(object):
+    # compose_trajectory() with a fixed configuration per pose name, move() for the grippers
+    def __init__(self, harness):
+        self.harness = harness
+
+    def compose_trajectory(self, component_name, parameter_name):
+        traj = JointTrajectory()
+        traj.joint_names = group_joint_names(component_name)
+        positions = named_configuration(parameter_name)
+        self.harness.remember(positions, named_pose(parameter_name))
+        traj.points.append(JointTrajectoryPoint(positions=positions.tolist()))
+        return traj, 0
+
+    def move(self, component_name, parameter_name, blocking=True):
+        return FakeHandle(0 if self.harness.profiles["gripper"].call(self.harness) else 1)
+
+
+class InMemoryTF(object):
+    # TransformListener and TransformBroadcaster at once, transforms are stored as (parent, child) pairs
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.transforms = {}
+
+    def sendTransform(self, translation, rotation, time, child, parent):
+        with self.lock:
+            self.transforms[(parent, child)] = (tuple(translation), tuple(rotation))
+
+    def lookupTransform(self, target_frame, source_frame, time):
+        with self.lock:
+            if (target_frame, source_frame) not in self.transforms:
+                raise tf.LookupException("No transform from " + source_frame + " to " + target_frame)
+            (translation, rotation) = self.transforms[(target_frame, source_frame)]
+        return list(translation), list(rotation)
+
+    def waitForTransform(self, target_frame, source_frame, time, timeout):
+        self.lookupTransform(target_frame, source_frame, time)
+
+
+class PlanningSceneModel(object):
+    # Publisher of planning_scene that applies every diff to an in-memory world, like move_group would
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.world = {}
+        self.attached = {}
+
+    def publish(self, scene):
+        with self.lock:
+            for attached in scene.robot_state.attached_collision_objects:
+                if attached.object.operation == CollisionObject.REMOVE:
+                    ids = [attached.object.id] if attached.object.id else self.attached.keys()
+                    for object_id in ids:
+                        if object_id in self.attached:
+                            self.world[object_id] = self.attached.pop(object_id).object
+                else:
+                    self.world.pop(attached.object.id, None)
+                    self.attached[attached.object.id] = attached
+
+            for co_object in scene.world.collision_objects:
+                if co_object.operation == CollisionObject.REMOVE:
+                    if co_object.id:
+                        self.world.pop(co_object.id, None)
+                    else:
+                        self.world.clear()
+                elif co_object.operation == CollisionObject.MOVE:
+                    if co_object.id in self.world:
+                        moved = copy(self.world[co_object.id])
+                        moved.primitive_poses = co_object.primitive_poses
+                        moved.mesh_poses = co_object.mesh_poses
+                        self.world[co_object.id] = moved
+                else:
+                    self.world[co_object.id] = co_object
+
+
+class FakePlanningSceneClient(PlanningSceneClient):
+    # The confirmed client, reading the in-memory scene instead of calling get_planning_scene
+    def __init__(self, publisher, timeout=2.0, poll_interval=0.001, geometry_poll_interval=0.001):
+        self.publisher = publisher
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.geometry_poll_interval = geometry_poll_interval
+        self.lock = threading.RLock()
+        self.objects = {}
+        self.attached = {}
+        self.mirror = None
+        self.confirm = True
+
+    def world_object_ids(self):
+        with self.publisher.lock:
+            return set(self.publisher.world)
+
+    def world_geometry(self):
+        with self.publisher.lock:
+            return dict(self.publisher.world)
+
+    def attached_object_ids(self):
+        with self.publisher.lock:
+            return set(self.publisher.attached)
+
+
+class NullPublisher(object):
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def publish(self, *args, **kwargs):
+        pass
+
+
+class FakeInteractiveMarkerServer(object):
+    # Keeps the markers, nobody is watching them
+    def __init__(self, topic_ns=""):
+        self.markers = {}
+
+    def insert(self, marker, feedback_cb=None, feedback_type=255):
+        self.markers[marker.name] = marker
+
+    def setCallback(self, name, feedback_cb, feedback_type=255):
+        return name in self.markers
+
+    def get(self, name):
+        return self.markers.get(name)
+
+    def setPose(self, name, pose, header=None):
+        if name not in self.markers:
+            return False
+        self.markers[name].pose = pose
+        return True
+
+    def erase(self, name):
+        return self.markers.pop(name, None) is not None
+
+    def clear(self):
+        self.markers.clear()
+
+    def applyChanges(self):
+        pass
+
+
+class FakeRecordingManager(object):
+    def __init__(self, name):
+        self.name = name
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def error(self):
+        pass
+
+
+class FakePlanningSceneInterface(object):
+    pass
+
+
+class FakeRosPack(object):
+    def get_path(self, package_name):
+        return PACKAGE_PATH
+
+
+class ParameterServer(object):
+    # rospy.get_param and friends, "~name" is a parameter of the node
+    def __init__(self, node_name, parameters):
+        self.node_name = node_name
+        self.parameters = {}
+        for (name, value) in parameters.iteritems():
+            self.set_param(name, value)
+
+    def resolve(self, name):
+        if name.startswith("~"):
+            return self.node_name + "/" + name[1:]
+        return name if name.startswith("/") else "/" + name
+
+    def get_param(self, name, default=KeyError):
+        name = self.resolve(name)
+        if name in self.parameters:
+            return self.parameters[name]
+
+        # Namespaces are returned as dictionaries
+        prefix = name.rstrip("/") + "/"
+        children = dict((key[len(prefix):], value) for (key, value) in self.parameters.iteritems()
+                        if key.startswith(prefix))
+        if children:
+            return children
+
+        if default is KeyError:
+            raise KeyError(name)
+        return default
+
+    def set_param(self, name, value):
+        self.parameters[self.resolve(name)] = value
+
+    def has_param(self, name):
+        try:
+            self.get_param(name)
+        except KeyError:
+            return False
+        return True
+
+    def get_name(self):
+        return self.node_name
+
+
+class OfflineHarness(object):
+    # Replaces the ROS interfaces of grasping_app with the stand-ins. install() has to be called before SM() is
+    # created, the process cannot talk to a real ROS system afterwards.
+    def __init__(self, parameters=None, profiles=None, seed=0, time_scale=0.0, points_per_rad=20):
+        self.random = np.random.RandomState(seed)
+        self.lock = threading.Lock()
+        self.time_scale = time_scale
+        self.points_per_rad = points_per_rad
+
+        self.profiles = dict((name, CallProfile()) for name in ["plan", "cartesian_path", "execute", "gripper",
+                                                                "state_validity"])
+        self.profiles.update(profiles or {})
+
+        self.slept = 0.0  # s spent in simulated latencies, all threads
+        self.poses = {}  # rounded configuration -> pose it was planned for, answers FK
+
+        merged = dict(DEFAULT_PARAMETERS)
+        merged["~mesh_cache_dir"] = tempfile.mkdtemp(prefix="grasping_app_mesh_cache_")
+        merged["~reachability_map_dir"] = tempfile.mkdtemp(prefix="grasping_app_reachability_")
+        merged["~planner_statistics_file"] = os.path.join(tempfile.mkdtemp(prefix="grasping_app_statistics_"),
+                                                          "planner_statistics.yaml")
+        merged.update(parameters or {})
+        self.parameters = ParameterServer("/grasping_app", merged)
+
+        self.tf = InMemoryTF()
+        self.scene = PlanningSceneModel()
+
+    def sleep(self, duration):
+        if duration > 0.0:
+            time.sleep(duration)
+            with self.lock:
+                self.slept += duration
+
+    def joint_path(self, start, target):
+        # Straight line with a wiggle, points_per_rad points along the largest joint motion
+        n_points = max(2, int(math.ceil(np.max(np.abs(target - start)) * self.points_per_rad)))
+        s = np.linspace(0.0, 1.0, n_points)[:, np.newaxis]
+        with self.lock:
+            wiggle = self.random.uniform(-0.05, 0.05, N_JOINTS)
+        return start + s * (target - start) + np.sin(math.pi * s) * wiggle
+
+    def remember(self, positions, pose):
+        if pose is not None:
+            with self.lock:
+                self.poses[tuple(np.round(positions, 6))] = pose
+
+    def pose_at(self, positions, default=None):
+        with self.lock:
+            return self.poses.get(tuple(np.round(positions, 6)), default)
+
+    def cartesian_path(self, start, waypoints, eef_step):
+        # (positions, fraction): one point per eef_step from the pose of start through the IK stand-ins of the
+        # waypoints. A failed call ends early with a random fraction.
+        positions = [start]
+        previous = self.pose_at(start, waypoints[0])
+        for pose in waypoints:
+            goal = pose_configuration(pose)
+            n_points = max(1, int(math.ceil(pose_distance(previous, pose) / max(eef_step, 1e-3))))
+            s = np.linspace(0.0, 1.0, n_points + 1)[1:, np.newaxis]
+            positions.extend(positions[-1] + s * (goal - positions[-1]))
+            previous = pose
+        positions = np.asarray(positions)
+
+        fraction = 1.0
+        if not self.profiles["cartesian_path"].call(self):
+            with self.lock:
+                fraction = self.random.uniform(0.3, 0.95)
+            positions = positions[:max(2, int(len(positions) * fraction))]
+        else:
+            self.remember(positions[-1], waypoints[-1])
+
+        return positions, fraction
+
+    def publisher(self, topic, *args, **kwargs):
+        if topic.lstrip("/") == "planning_scene":
+            return self.scene
+        return NullPublisher()
+
+    def install(self):
+        # ---- ROSPY ----
+        rospy.rostime.set_rostime_initialized(True)
+        rospy.get_param = self.parameters.get_param
+        rospy.set_param = self.parameters.set_param
+        rospy.has_param = self.parameters.has_param
+        rospy.get_name = self.parameters.get_name
+        rospy.Publisher = self.publisher
+
+        # ---- GRASPING APP ----
+        import grasping_app
+        import planning_services
+
+        tf_module = types.ModuleType("tf")
+        tf_module.TransformListener = lambda *args, **kwargs: self.tf
+        tf_module.TransformBroadcaster = lambda *args, **kwargs: self.tf
+        tf_module.LookupException = tf.LookupException
+
+        grasping_app.tf = tf_module
+        grasping_app.rospkg = types.ModuleType("rospkg")
+        grasping_app.rospkg.RosPack = FakeRosPack
+        grasping_app.MoveGroupCommander = lambda name: FakeMoveGroupCommander(self, name)
+        grasping_app.PlanningSceneInterface = FakePlanningSceneInterface
+        grasping_app.PlanningSceneClient = FakePlanningSceneClient
+        FakePlanningClient.harness = self
+        grasping_app.PlanningClient = FakePlanningClient
+        planning_services.PlanningClient = FakePlanningClient
+        grasping_app.simple_script_server = lambda: FakeScriptServer(self)
+        grasping_app.RecordingManager = FakeRecordingManager
+        grasping_app.InteractiveMarkerServer = FakeInteractiveMarkerServer
+
+        return grasping_app
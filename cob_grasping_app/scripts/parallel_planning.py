@@ -0,0 +1,138 @@
+#!/usr/bin/python
+import time
+
+import numpy as np
+
+import rospy
+from moveit_msgs.msg import RobotState
+
+
+def make_robot_state(joint_names, positions, attached_objects=()):
+    state = RobotState()
+    state.joint_state.name = list(joint_names)
+    state.joint_state.position = list(positions)
+    state.attached_collision_objects = list(attached_objects)
+    state.is_diff = True
+    return state
+
+
+class Segment(object):
+    # One part of the pick and place chain, e.g. "approach". Linear segments are planned with
+    # compute_cartesian_path through all poses, the others are planned in joint space to the IK solution of the
+    # last pose.
+    __slots__ = ["name", "poses", "linear", "attached_objects"]
+
+    def __init__(self, name, poses, linear, attached_objects=None):
+        self.name = name
+        self.poses = poses
+        self.linear = linear
+        self.attached_objects = attached_objects or []
+
+    def key(self, precision=4):
+        # Equal for segments with the same targets, e.g. to match a plan that was made in advance
+        return (self.name, self.linear, tuple(attached.object.id for attached in self.attached_objects),
+                tuple(tuple(round(value, precision) for value in (pose.position.x, pose.position.y, pose.position.z,
+                                                                   pose.orientation.x, pose.orientation.y,
+                                                                   pose.orientation.z, pose.orientation.w))
+                      for pose in self.poses))
+
+
+class ParallelSegmentPlanner(object):
+    # Plans a chain of segments concurrently. The start state of every segment is seeded with the predicted
+    # endpoint (IK solution) of the previous one. After planning, the chain is accepted up to the first segment
+    # whose seed turned out to be wrong, the remaining segments have to be replanned serially by the caller.
+    def __init__(self, pool, group_name, eef_link, planner_id, eef_step, jump_threshold, joint_tolerance=1e-3,
+                 cartesian_planner=None, record=None):
+        self.pool = pool
+        self.group_name = group_name
+        self.eef_link = eef_link
+        self.planner_id = planner_id
+        self.eef_step = eef_step
+        self.jump_threshold = jump_threshold
+        self.joint_tolerance = joint_tolerance
+        self.cartesian_planner = cartesian_planner  # AdaptiveCartesianPlanner, fixed eef_step if None
+        self.record = record  # record(segment, planner_id, success, latency) of every planned segment
+
+    def predict_endpoints(self, joint_names, start_positions, segments):
+        # IK solutions have to be chained, every solution is the seed for the next one
+        def predict(client):
+            predictions = []
+            seed = start_positions
+            for segment in segments:
+                seed = client.compute_ik(self.group_name, self.eef_link,
+                                         make_robot_state(joint_names, seed, segment.attached_objects),
+                                         segment.poses[-1], joint_names)
+                if seed is None:
+                    rospy.logwarn("No IK solution for '" + segment.name + "' target")
+                    break
+                predictions.append(seed)
+            return predictions
+
+        return self.pool.apply(predict)
+
+    def plan_segment(self, client, segment, joint_names, start_positions, goal_positions, index=0, failed=None):
+        # failed[0] is the first segment that failed or ended elsewhere than predicted, later ones are discarded
+        # anyway, so they are skipped instead of holding a client
+        if failed is not None and failed[0] < index:
+            return None
+
+        traj = self.plan_segment_from(client, segment, joint_names, start_positions, goal_positions)
+        if traj is None and failed is not None:
+            failed[0] = min(failed[0], index)
+        return traj
+
+    def plan_segment_from(self, client, segment, joint_names, start_positions, goal_positions):
+        start_state = make_robot_state(joint_names, start_positions, segment.attached_objects)
+
+        start = time.time()
+        if segment.linear:
+            if self.cartesian_planner is not None:
+                (traj, fraction, steps) = self.cartesian_planner.plan(client, start_state, segment.poses,
+                                                                      segment.name)
+            else:
+                (traj, fraction) = client.cartesian_path(self.group_name, self.eef_link, start_state,
+                                                         segment.poses, self.eef_step, self.jump_threshold)
+            if self.record is not None:
+                self.record(segment.name, "compute_cartesian_path", fraction == 1.0, time.time() - start)
+            if fraction != 1.0:
+                rospy.logwarn("Plan " + segment.name + " (parallel): " + str(round(fraction * 100, 2)) + "%")
+                return None
+        else:
+            traj = client.plan(self.group_name, start_state, joint_names, goal_positions, self.planner_id)
+            if self.record is not None:
+                self.record(segment.name, self.planner_id, traj is not None, time.time() - start)
+            if traj is None:
+                rospy.logwarn("Plan " + segment.name + " (parallel): failed")
+                return None
+
+        return traj
+
+    def matches(self, positions_a, positions_b):
+        return np.max(np.abs(np.asarray(positions_a) - np.asarray(positions_b))) <= self.joint_tolerance
+
+    def plan(self, joint_names, start_positions, segments):
+        predictions = self.predict_endpoints(joint_names, start_positions, segments)
+        seeds = [start_positions] + predictions
+
+        # Send all segments with a known start and goal at once
+        failed = [len(segments)]
+        results = [self.pool.apply_async(self.plan_segment, segment, joint_names, seeds[i], seeds[i + 1], i, failed)
+                   for i, segment in enumerate(segments[:len(predictions)])]
+
+        accepted = []
+        for i, result in enumerate(results):
+            traj = result.get()
+            if traj is None:
+                break
+
+            accepted.append(traj)
+
+            # A linear segment may end in a different IK branch than predicted, every later seed is wrong then
+            if not self.matches(traj.joint_trajectory.points[-1].positions, seeds[i + 1]):
+                rospy.logwarn("Predicted endpoint of '" + segments[i].name + "' was wrong")
+                failed[0] = min(failed[0], i)
+                break
+
+        rospy.loginfo("Parallel planning: " + str(len(accepted)) + " of " + str(len(segments)) +
+                      " segments accepted")
+        return accepted
@@ -0,0 +1,169 @@
+#!/usr/bin/python
+from xml.etree import ElementTree
+
+import numpy as np
+
+import rospy
+from parallel_planning import make_robot_state
+
+
+def decimation_indices(positions, tolerance):
+    # Douglas-Peucker in joint space: a point is dropped if no joint deviates more than tolerance from the straight
+    # line between the kept points around it. The first and the last point are always kept.
+    n_points = len(positions)
+    keep = np.zeros(n_points, dtype=bool)
+    keep[[0, -1]] = True
+
+    stack = [(0, n_points - 1)]
+    while stack:
+        (a, b) = stack.pop()
+        if b - a < 2:
+            continue
+
+        offsets = positions[a + 1:b] - positions[a]
+        chord = positions[b] - positions[a]
+        chord_length2 = np.dot(chord, chord)
+        if chord_length2 > 1e-18:
+            offsets = offsets - np.outer(np.dot(offsets, chord) / chord_length2, chord)
+
+        deviation = np.max(np.abs(offsets), axis=1)
+        i = int(np.argmax(deviation))
+        if deviation[i] > tolerance:
+            keep[a + 1 + i] = True
+            stack.append((a, a + 1 + i))
+            stack.append((a + 1 + i, b))
+
+    return np.flatnonzero(keep)
+
+
+def central_differences(values, times):
+    # Derivative at the inner points, zero at both ends
+    derivative = np.zeros_like(values)
+    derivative[1:-1] = (values[2:] - values[:-2]) / (times[2:] - times[:-2])[:, np.newaxis]
+    return derivative
+
+
+class LeverArms(object):
+    # Bound of how far a tip link moves when the joints of its chain move, from the joint origins of the URDF. A
+    # joint is at most the summed origin offsets of the joints between it and the tip away from it, so moving every
+    # joint by at most d rad moves the tip by at most d times the sum of these distances (1 m/m for prismatic
+    # joints).
+    def __init__(self, robot_description="/robot_description"):
+        self.joints = {}  # child link -> (parent link, joint name, joint type, origin offset)
+        self.totals = {}
+
+        try:
+            root = ElementTree.fromstring(rospy.get_param(robot_description))
+        except (KeyError, ElementTree.ParseError), e:
+            rospy.logwarn("Unable to read the kinematic chains from '" + robot_description + "': " + str(e))
+            return
+
+        for joint in root.findall("joint"):
+            origin = joint.find("origin")
+            xyz = [float(value) for value in origin.get("xyz", "0 0 0").split()] if origin is not None else [0.0]
+            self.joints[joint.find("child").get("link")] = (joint.find("parent").get("link"), joint.get("name"),
+                                                            joint.get("type"), float(np.linalg.norm(xyz)))
+
+    def total(self, joint_names, tip_link):
+        # Sum of the distances of joint_names to tip_link in m, None if a joint is not in the chain of the tip
+        key = (tuple(joint_names), tip_link)
+        if key not in self.totals:
+            (remaining, distance, total, link) = (set(joint_names), 0.0, 0.0, tip_link)
+            while remaining and link in self.joints:
+                (link, name, joint_type, offset) = self.joints[link]
+                if name in remaining:
+                    remaining.discard(name)
+                    total += 1.0 if joint_type == "prismatic" else distance
+                distance += offset
+            self.totals[key] = None if remaining else total
+        return self.totals[key]
+
+
+class PathSimplifier(object):
+    # Randomized shortcutting of joint space plans and decimation of nearly collinear points. A shortcut is the
+    # straight joint space line between two points of the path, it is checked every resolution rad against the
+    # current planning scene. The pairs are drawn with a fixed seed, so the same plan is always simplified the same
+    # way. Without retiming a shortcut keeps the mean speed of the part it replaces.
+    def __init__(self, client=None, iterations=30, resolution=0.05, tolerance=None, seed=0, linear_tolerance=None,
+                 lever_arms=None):
+        self.client = client
+        self.iterations = iterations
+        self.resolution = resolution
+        self.tolerance = tolerance
+        self.seed = seed
+        self.linear_tolerance = linear_tolerance  # m, largest deviation of the tip from a linear segment
+        self.lever_arms = lever_arms
+
+    def key(self):
+        # Everything the result depends on, part of the trajectory cache key
+        return (self.client is not None, self.iterations, self.resolution, self.tolerance, self.seed,
+                self.linear_tolerance)
+
+    def is_line_valid(self, group_name, joint_names, start, end, attached_objects):
+        # The end points are part of the planned path already
+        steps = int(np.ceil(np.max(np.abs(end - start)) / self.resolution))
+        for fraction in np.arange(1, steps) / float(steps):
+            state = make_robot_state(joint_names, (start + fraction * (end - start)).tolist(), attached_objects)
+            if not self.client.is_state_valid(group_name, state):
+                return False
+        return True
+
+    def shortcut(self, arrays, group_name, attached_objects=()):
+        random = np.random.RandomState(self.seed)
+        indices = np.arange(len(arrays))
+        times = arrays.time_from_start.copy()
+        shortened = False
+
+        for _ in xrange(self.iterations):
+            if len(indices) < 3:
+                break
+
+            (i, j) = sorted(random.choice(len(indices), 2, replace=False))
+            if j - i < 2:
+                continue
+
+            path = arrays.positions[indices[i:j + 1]]
+            arc = np.sum(np.sqrt(np.sum(np.diff(path, axis=0) ** 2, axis=1)))
+            chord = np.sqrt(np.sum((path[-1] - path[0]) ** 2))
+            if chord >= arc * (1.0 - 1e-6):
+                continue
+
+            if not self.is_line_valid(group_name, arrays.joint_names, path[0], path[-1], attached_objects):
+                continue
+
+            times[j:] -= (times[j] - times[i]) * (1.0 - chord / arc)
+            (indices, times) = (np.concatenate([indices[:i + 1], indices[j:]]),
+                                np.concatenate([times[:i + 1], times[j:]]))
+            shortened = True
+
+        if not shortened:
+            return arrays
+
+        arrays.select(indices)
+        arrays.time_from_start = times
+        if arrays.velocities is not None:
+            arrays.velocities = central_differences(arrays.positions, times)
+        if arrays.accelerations is not None:
+            arrays.accelerations = central_differences(central_differences(arrays.positions, times), times)
+        return arrays
+
+    def decimate(self, arrays):
+        if len(arrays) > 2:
+            arrays.select(decimation_indices(arrays.positions, self.tolerance))
+        return arrays
+
+    def decimate_linear(self, arrays, tip_link):
+        # Linear segments are decimated with the joint tolerance that keeps tip_link within linear_tolerance of the
+        # planned path. Without the chain of the tip all points are kept.
+        total = self.lever_arms.total(arrays.joint_names, tip_link)
+        if total is not None and len(arrays) > 2:
+            arrays.select(decimation_indices(arrays.positions, self.linear_tolerance / max(total, 1e-6)))
+        return arrays
+
+    def simplify(self, arrays, group_name=None, attached_objects=()):
+        # Without a group only decimation
+        if group_name is not None and self.client is not None and self.iterations > 0:
+            self.shortcut(arrays, group_name, attached_objects)
+        if self.tolerance is not None:
+            self.decimate(arrays)
+        return arrays
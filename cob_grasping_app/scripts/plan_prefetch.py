@@ -0,0 +1,81 @@
+#!/usr/bin/python
+import threading
+
+import rospy
+
+
+class PlanPrefetcher(object):
+    # Plans the next manipulation in a worker thread while the current one is executed. Only the latest job is
+    # kept, results of older jobs are dropped when they finish.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.key = None
+        self.result = None
+        self.done = None
+
+    def submit(self, key, func, *args):
+        with self.lock:
+            self.generation += 1
+            self.key = key
+            self.result = None
+            self.done = threading.Event()
+
+            thread = threading.Thread(target=self.run, args=(self.generation, self.done, func, args))
+            thread.daemon = True
+            thread.start()
+
+    def run(self, generation, done, func, args):
+        try:
+            result = func(*args)
+        except Exception, e:
+            rospy.logwarn("Prefetched planning failed: " + str(e))
+            result = None
+
+        with self.lock:
+            if generation == self.generation:
+                self.result = result
+        done.set()
+
+    def wait(self, timeout=None):
+        with self.lock:
+            done = self.done
+
+        if done is not None:
+            done.wait(timeout)
+
+    def take(self, key, timeout=None):
+        # Waits for the job planned for key, any other job is dropped
+        with self.lock:
+            if self.key is None:
+                return None
+
+            if self.key != key:
+                rospy.loginfo("Prefetched plan does not match the current manipulation")
+                self.cancel_locked()
+                return None
+
+            done = self.done
+
+        done.wait(timeout)
+
+        with self.lock:
+            if not done.is_set():
+                rospy.logwarn("Prefetched planning not finished within " + str(timeout) + "s")
+                result = None
+            else:
+                result = self.result
+            self.cancel_locked()
+
+        return result
+
+    def cancel(self):
+        with self.lock:
+            self.cancel_locked()
+
+    def cancel_locked(self):
+        # Caller holds the lock
+        self.generation += 1
+        self.key = None
+        self.result = None
+        self.done = None
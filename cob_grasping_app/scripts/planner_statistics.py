@@ -0,0 +1,105 @@
+#!/usr/bin/python
+import os
+import threading
+
+import numpy as np
+import yaml
+
+import rospy
+
+
+class PlannerStatistics(object):
+    # Success rate and latency of planning calls per scene, segment (approach, grasp, ...), arm and planner. Only the
+    # last window latencies of every entry are kept, so the statistics follow changes of the scene.
+    def __init__(self, filename, window=200):
+        self.filename = os.path.expanduser(filename)
+        self.window = window
+
+        self.scene_id = ""
+        self.lock = threading.Lock()
+        self.entries = {}  # (scene_id, segment, arm, planner_id) -> [calls, successes, latencies]
+
+        self.load()
+
+    def load(self):
+        if not os.path.isfile(self.filename):
+            return
+
+        with open(self.filename, 'r') as stream:
+            doc = yaml.safe_load(stream) or {}
+
+        for (scene_id, segment, arm, planner_id, calls, successes, latencies) in doc.get("entries", []):
+            self.entries[(scene_id, segment, arm, planner_id)] = [calls, successes, latencies[-self.window:]]
+
+    def save(self):
+        with self.lock:
+            doc = {"entries": [list(key) + value for (key, value) in sorted(self.entries.iteritems())]}
+
+        if os.path.dirname(self.filename) and not os.path.isdir(os.path.dirname(self.filename)):
+            os.makedirs(os.path.dirname(self.filename))
+
+        # Written atomically like the trajectory cache index
+        filename = self.filename + ".tmp"
+        with open(filename, 'w') as stream:
+            yaml.safe_dump(doc, stream)
+        os.rename(filename, self.filename)
+
+    def set_scene(self, scene_id):
+        with self.lock:
+            self.scene_id = scene_id
+
+    def record(self, segment, arm, planner_id, success, latency):
+        with self.lock:
+            entry = self.entries.setdefault((self.scene_id, segment, arm, planner_id), [0, 0, []])
+            entry[0] += 1
+            entry[1] += int(success)
+            entry[2].append(round(latency, 6))
+            del entry[2][:-self.window]
+
+    def entry(self, segment, arm, planner_id):
+        # (calls, successes, latencies) in the current scene
+        with self.lock:
+            (calls, successes, latencies) = self.entries.get((self.scene_id, segment, arm, planner_id), [0, 0, []])
+            return calls, successes, np.array(latencies, dtype=np.float64)
+
+    def summary(self):
+        # (scene, segment, arm, planner, calls, success rate, p50, p90) of all entries
+        with self.lock:
+            items = sorted(self.entries.iteritems())
+
+        rows = []
+        for ((scene_id, segment, arm, planner_id), (calls, successes, latencies)) in items:
+            rows.append((scene_id, segment, arm, planner_id, calls, successes / float(max(calls, 1)),
+                         np.percentile(latencies, 50) if latencies else 0.0,
+                         np.percentile(latencies, 90) if latencies else 0.0))
+        return rows
+
+    def log_summary(self):
+        for row in self.summary():
+            rospy.loginfo("%-10s %-10s %-6s %-26s %5d calls  success %5.1f%%  p50 %7.3fs  p90 %7.3fs" %
+                          (row[:5] + (row[5] * 100.0,) + row[6:]))
+
+
+class PlannerSelector(object):
+    # Thompson sampling over the candidate planners of every segment and arm. The expected time until a valid plan
+    # is the mean latency divided by a success rate drawn from Beta(successes + 1, failures + 1), the planner with
+    # the lowest sample is used. Every candidate is tried min_calls times first.
+    def __init__(self, statistics, planner_ids, min_calls=1, seed=0):
+        self.statistics = statistics
+        self.planner_ids = list(planner_ids)
+        self.min_calls = min_calls
+        self.random = np.random.RandomState(seed)
+        self.lock = threading.Lock()
+
+    def select(self, segment, arm):
+        costs = []
+        for planner_id in self.planner_ids:
+            (calls, successes, latencies) = self.statistics.entry(segment, arm, planner_id)
+            if calls < self.min_calls:
+                return planner_id
+
+            with self.lock:
+                success_rate = self.random.beta(successes + 1, calls - successes + 1)
+            costs.append(np.mean(latencies) / success_rate if len(latencies) else 0.0)
+
+        return self.planner_ids[int(np.argmin(costs))]
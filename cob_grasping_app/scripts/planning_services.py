@@ -0,0 +1,180 @@
+#!/usr/bin/python
+from multiprocessing.pool import ThreadPool
+from Queue import Queue
+
+import rospy
+from geometry_msgs.msg import PoseStamped
+from moveit_msgs.msg import Constraints, JointConstraint, MotionPlanRequest, MoveItErrorCodes, PositionIKRequest
+from moveit_msgs.srv import GetCartesianPath, GetCartesianPathRequest, GetMotionPlan, GetPositionFK, \
+    GetPositionFKRequest, GetPositionIK, GetStateValidity
+
+
+class PlanningClient(object):
+    # Service proxies of one move_group instance. Unlike MoveGroupCommander every request carries its own start
+    # state, so several clients can plan for the same group at the same time.
+    def __init__(self, namespace="", frame_id="base_link"):
+        self.namespace = namespace.rstrip("/")
+        self.frame_id = frame_id
+
+        self.plan_service = rospy.ServiceProxy(self.namespace + "/plan_kinematic_path", GetMotionPlan)
+        self.cartesian_service = rospy.ServiceProxy(self.namespace + "/compute_cartesian_path", GetCartesianPath)
+        self.ik_service = rospy.ServiceProxy(self.namespace + "/compute_ik", GetPositionIK)
+        self.validity_service = rospy.ServiceProxy(self.namespace + "/check_state_validity", GetStateValidity)
+        self.fk_service = rospy.ServiceProxy(self.namespace + "/compute_fk", GetPositionFK)
+
+    def wait_for_services(self, timeout=None):
+        for service in [self.plan_service, self.cartesian_service, self.ik_service, self.validity_service,
+                        self.fk_service]:
+            service.wait_for_service(timeout)
+
+    def plan(self, group_name, start_state, joint_names, goal_positions, planner_id, planning_time=5.0,
+             tolerance=1e-4):
+        request = MotionPlanRequest()
+        request.group_name = group_name
+        request.start_state = start_state
+        request.planner_id = planner_id
+        request.num_planning_attempts = 1
+        request.allowed_planning_time = planning_time
+
+        goal = Constraints()
+        for name, position in zip(joint_names, goal_positions):
+            goal.joint_constraints.append(JointConstraint(joint_name=name, position=position,
+                                                          tolerance_above=tolerance, tolerance_below=tolerance,
+                                                          weight=1.0))
+        request.goal_constraints.append(goal)
+
+        try:
+            response = self.plan_service(request).motion_plan_response
+        except rospy.ServiceException, e:
+            rospy.logwarn("Planning service call failed: " + str(e))
+            return None
+
+        if response.error_code.val != MoveItErrorCodes.SUCCESS or not response.trajectory.joint_trajectory.points:
+            return None
+
+        return response.trajectory
+
+    def cartesian_path(self, group_name, link_name, start_state, waypoints, eef_step, jump_threshold,
+                       avoid_collisions=True):
+        request = GetCartesianPathRequest()
+        request.header.frame_id = self.frame_id
+        request.header.stamp = rospy.Time.now()
+        request.start_state = start_state
+        request.group_name = group_name
+        request.link_name = link_name
+        request.waypoints = waypoints
+        request.max_step = eef_step
+        request.jump_threshold = jump_threshold
+        request.avoid_collisions = avoid_collisions
+
+        try:
+            response = self.cartesian_service(request)
+        except rospy.ServiceException, e:
+            rospy.logwarn("Cartesian path service call failed: " + str(e))
+            return None, 0.0
+
+        if response.error_code.val != MoveItErrorCodes.SUCCESS:
+            return None, 0.0
+
+        return response.solution, response.fraction
+
+    def compute_ik(self, group_name, link_name, seed_state, pose, joint_names, avoid_collisions=True,
+                   timeout=0.1, attempts=3):
+        request = PositionIKRequest()
+        request.group_name = group_name
+        request.robot_state = seed_state
+        request.avoid_collisions = avoid_collisions
+        request.ik_link_name = link_name
+        request.pose_stamped = PoseStamped()
+        request.pose_stamped.header.frame_id = self.frame_id
+        request.pose_stamped.pose = pose
+        request.timeout = rospy.Duration.from_sec(timeout)
+        request.attempts = attempts
+
+        try:
+            response = self.ik_service(request)
+        except rospy.ServiceException, e:
+            rospy.logwarn("IK service call failed: " + str(e))
+            return None
+
+        if response.error_code.val != MoveItErrorCodes.SUCCESS:
+            return None
+
+        # The solution contains the whole robot, only return the joints of the group
+        solution = dict(zip(response.solution.joint_state.name, response.solution.joint_state.position))
+        try:
+            return [solution[name] for name in joint_names]
+        except KeyError:
+            return None
+
+    def compute_fk(self, link_name, robot_state):
+        # Pose of the link in frame_id, robot_state is applied to the current state of move_group
+        request = GetPositionFKRequest()
+        request.header.frame_id = self.frame_id
+        request.header.stamp = rospy.Time.now()
+        request.fk_link_names = [link_name]
+        request.robot_state = robot_state
+
+        try:
+            response = self.fk_service(request)
+        except rospy.ServiceException, e:
+            rospy.logwarn("FK service call failed: " + str(e))
+            return None
+
+        if response.error_code.val != MoveItErrorCodes.SUCCESS or len(response.pose_stamped) == 0:
+            return None
+
+        return response.pose_stamped[0].pose
+
+    def is_state_valid(self, group_name, robot_state):
+        try:
+            response = self.validity_service(robot_state, group_name, Constraints())
+        except rospy.ServiceException, e:
+            rospy.logwarn("State validity service call failed: " + str(e))
+            return False
+
+        return response.valid
+
+
+class PlanningClientPool(object):
+    # Worker threads sharing a set of planning clients. Every job borrows one client for its whole runtime, so
+    # the number of concurrent requests per move_group instance is bounded by the number of clients.
+    def __init__(self, namespaces, clients_per_namespace=1):
+        self.clients = Queue()
+        for namespace in namespaces:
+            for _ in xrange(clients_per_namespace):
+                self.clients.put(PlanningClient(namespace))
+
+        self.size = len(namespaces) * clients_per_namespace
+        self.pool = ThreadPool(self.size)
+
+    def _run(self, func, args):
+        client = self.clients.get()
+        try:
+            return func(client, *args)
+        finally:
+            self.clients.put(client)
+
+    def apply_async(self, func, *args):
+        # func is called as func(client, *args) in a worker thread
+        return self.pool.apply_async(self._run, (func, args))
+
+    def apply(self, func, *args):
+        return self._run(func, args)
+
+    def map(self, func, args_list):
+        results = [self.apply_async(func, *args) for args in args_list]
+        return [result.get() for result in results]
+
+    def wait_for_services(self, timeout=None):
+        clients = [self.clients.get() for _ in xrange(self.size)]
+        try:
+            for client in clients:
+                client.wait_for_services(timeout)
+        finally:
+            for client in clients:
+                self.clients.put(client)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
@@ -0,0 +1,106 @@
+#!/usr/bin/python
+import threading
+import time
+from Queue import Empty, Queue
+
+import numpy as np
+
+import rospy
+
+from parallel_planning import make_robot_state
+
+
+def path_length(traj):
+    # Joint space length of a plan, the quality measure of the "best" mode
+    positions = np.array([point.positions for point in traj.joint_trajectory.points], dtype=np.float64)
+    if len(positions) < 2:
+        return 0.0
+    return float(np.sum(np.sqrt(np.sum(np.diff(positions, axis=0) ** 2, axis=1))))
+
+
+class PortfolioPlanner(object):
+    # Sends the same joint space request to several planners at once. Mode "first" returns the first valid plan,
+    # mode "best" the shortest one (joint space path length) that is done within the deadline, or the first one
+    # after the deadline. Requests that did not start yet are cancelled, running service calls can not be
+    # interrupted, their results are dropped. The deadline is also the planning time of every request, so
+    # abandoned calls end with it.
+    def __init__(self, pool, planner_ids, mode="first", deadline=5.0):
+        if mode not in ["first", "best"]:
+            raise ValueError("Invalid portfolio mode '" + str(mode) + "'")
+
+        self.pool = pool
+        self.planner_ids = list(planner_ids)
+        self.mode = mode
+        self.deadline = deadline
+
+    def key(self):
+        # Used instead of the planner id in the trajectory cache key
+        return (self.mode, tuple(self.planner_ids))
+
+    def _plan(self, client, results, cancelled, planner_id, group_name, start_state, joint_names, goal_positions,
+              segment, record):
+        if cancelled.is_set():
+            return
+        start = time.time()
+        traj = None
+        try:
+            traj = client.plan(group_name, start_state, joint_names, goal_positions, planner_id, self.deadline)
+        finally:
+            results.put((planner_id, traj, time.time() - start))
+
+        # Every call that ran counts, also the ones whose plan is dropped
+        if record is not None and segment is not None:
+            record(segment, planner_id, traj is not None, time.time() - start)
+
+    def collect(self, results, cancelled):
+        # (planner_id, traj) of the winner, (None, None) if every planner failed
+        candidates = []
+        end = time.time() + self.deadline
+        for _ in xrange(len(self.planner_ids)):
+            # Every request ends within its planning time, without a candidate there is nothing to wait for
+            timeout = max(0.0, end - time.time()) if self.mode == "best" and candidates else None
+            try:
+                (planner_id, traj, duration) = results.get(timeout=timeout)
+            except Empty:
+                break
+
+            if traj is None:
+                rospy.logdebug("Portfolio: " + planner_id + " failed after " + str(round(duration, 3)) + "s")
+                continue
+
+            rospy.logdebug("Portfolio: " + planner_id + " succeeded after " + str(round(duration, 3)) + "s")
+            candidates.append((planner_id, traj))
+            if self.mode == "first":
+                break
+
+        cancelled.set()
+        if not candidates:
+            return None, None
+        return min(candidates, key=lambda candidate: path_length(candidate[1]))
+
+    def plan(self, group_name, start_state, joint_names, goal_positions, segment=None, record=None):
+        # record(segment, planner_id, success, latency) is called for every planner that was asked
+        results = Queue()
+        cancelled = threading.Event()
+        for planner_id in self.planner_ids:
+            self.pool.apply_async(self._plan, results, cancelled, planner_id, group_name, start_state, joint_names,
+                                  goal_positions, segment, record)
+
+        (planner_id, traj) = self.collect(results, cancelled)
+        if traj is None:
+            rospy.logwarn("Portfolio: all planners failed")
+        else:
+            rospy.loginfo("Portfolio: plan of " + planner_id)
+        return traj
+
+    def plan_pose(self, group_name, eef_link, start_state, pose, joint_names, segment=None, record=None):
+        # Pose targets are planned to their IK solution, seeded with the start state
+        goal_positions = self.pool.apply(
+            lambda client: client.compute_ik(group_name, eef_link,
+                                             make_robot_state(joint_names, start_state.joint_state.position,
+                                                              start_state.attached_collision_objects),
+                                             pose, joint_names))
+        if goal_positions is None:
+            rospy.logwarn("Portfolio: no IK solution for the target")
+            return None
+        return self.plan(group_name, start_state, joint_names, goal_positions, segment, record)
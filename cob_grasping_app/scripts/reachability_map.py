@@ -0,0 +1,112 @@
+#!/usr/bin/python
+import os
+
+import numpy as np
+
+from tf.transformations import quaternion_from_euler
+
+
+# File layout: header, orientation table (n x rpy), bit packed reachability (x, y, z, orientation bytes)
+MAP_MAGIC = "CGRM"
+MAP_VERSION = 1
+MAP_HEADER = np.dtype([("magic", "S4"),
+                       ("version", "<u4"),
+                       ("shape", "<u4", (3,)),
+                       ("n_orientations", "<u4"),
+                       ("origin", "<f8", (3,)),
+                       ("resolution", "<f8")])
+
+
+def orientation_quaternions(orientations):
+    return np.array([quaternion_from_euler(r, p, y) for (r, p, y) in np.asarray(orientations).reshape(-1, 3)])
+
+
+class ReachabilityMap(object):
+    # Voxel grid in base_link with one bit per (voxel, orientation): the end effector reaches the voxel center in
+    # that orientation. Built offline by build_reachability_map.py, loaded memory-mapped.
+    def __init__(self, origin, resolution, shape, orientations, data=None):
+        self.origin = np.asarray(origin, dtype=np.float64)
+        self.resolution = float(resolution)
+        self.shape = tuple(int(n) for n in shape)
+        self.orientations = np.asarray(orientations, dtype=np.float64).reshape(-1, 3)
+        self.quaternions = orientation_quaternions(self.orientations)
+
+        if data is None:
+            data = np.zeros(self.shape + ((len(self.orientations) + 7) // 8,), dtype=np.uint8)
+        self.data = data
+
+    # ---- FILE ----
+    @classmethod
+    def load(cls, filename):
+        header = np.fromfile(filename, dtype=MAP_HEADER, count=1)[0]
+        if header["magic"] != MAP_MAGIC or header["version"] != MAP_VERSION:
+            raise ValueError("'" + filename + "' is not a reachability map")
+
+        n = int(header["n_orientations"])
+        shape = tuple(int(value) for value in header["shape"])
+        with open(filename, 'rb') as stream:
+            stream.seek(MAP_HEADER.itemsize)
+            orientations = np.fromfile(stream, dtype="<f8", count=n * 3)
+
+        data = np.memmap(filename, dtype=np.uint8, mode='r', offset=MAP_HEADER.itemsize + n * 3 * 8,
+                         shape=shape + ((n + 7) // 8,))
+
+        return cls(header["origin"], header["resolution"], shape, orientations, data)
+
+    def save(self, filename):
+        header = np.zeros(1, dtype=MAP_HEADER)
+        header["magic"] = MAP_MAGIC
+        header["version"] = MAP_VERSION
+        header["shape"] = self.shape
+        header["n_orientations"] = len(self.orientations)
+        header["origin"] = self.origin
+        header["resolution"] = self.resolution
+
+        directory = os.path.dirname(filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        temp_file = filename + ".tmp"
+        with open(temp_file, 'wb') as stream:
+            header.tofile(stream)
+            self.orientations.astype("<f8").tofile(stream)
+            np.ascontiguousarray(self.data, dtype=np.uint8).tofile(stream)
+        os.rename(temp_file, filename)
+
+    # ---- GRID ----
+    def voxel_centers(self):
+        grid = np.indices(self.shape).reshape(3, -1).T
+        return self.origin + (grid + 0.5) * self.resolution
+
+    def voxels(self, points):
+        # Voxel indices of (n x 3) points and a mask for the points inside the map
+        indices = np.floor((np.asarray(points, dtype=np.float64).reshape(-1, 3) - self.origin) /
+                           self.resolution).astype(np.int64)
+        inside = np.all((indices >= 0) & (indices < np.array(self.shape)), axis=1)
+        return indices, inside
+
+    def set_voxel(self, index, reachable):
+        # reachable holds one bool per orientation
+        self.data[tuple(index)] = np.packbits(np.asarray(reachable, dtype=np.uint8))
+
+    def orientation_bits(self, points):
+        # (n x orientations) bools, points outside of the map are unreachable
+        (indices, inside) = self.voxels(points)
+        bits = np.zeros((len(indices), len(self.orientations)), dtype=bool)
+        if inside.any():
+            packed = self.data[indices[inside, 0], indices[inside, 1], indices[inside, 2]]
+            bits[inside] = np.unpackbits(packed, axis=1)[:, :len(self.orientations)].astype(bool)
+        return bits
+
+    # ---- QUERIES ----
+    def reachable(self, points):
+        # True for every point that is reachable in at least one orientation
+        return self.orientation_bits(points).any(axis=1)
+
+    def reachable_orientations(self, point):
+        return self.orientations[self.orientation_bits(point)[0]]
+
+    def orientation_mask(self, point, orientations):
+        # Maps every (roll, pitch, yaw) to the closest orientation of the map
+        closest = np.argmax(np.abs(orientation_quaternions(orientations).dot(self.quaternions.T)), axis=1)
+        return self.orientation_bits(point)[0][closest]
@@ -0,0 +1,273 @@
+#!/usr/bin/python
+import argparse
+import glob
+import os
+import re
+import signal
+import subprocess
+import sys
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+from Queue import Queue, Empty
+
+import rosgraph
+import yaml
+
+
+# Every worker has its own ROS master, gazebo master and ROS_HOME, so several tests can run on one machine
+ROS_BASE_PORT = 11411
+GAZEBO_BASE_PORT = 11445
+
+
+def start_process(command, env, log):
+    # Own process group, so gzserver and all other children can be killed at once
+    return subprocess.Popen(command, env=env, stdout=log, stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+
+
+def wait_for_process(process, timeout):
+    # Returns the exit code or None if the process was killed after the timeout
+    deadline = time.time() + timeout
+    while process.poll() is None:
+        if time.time() > deadline:
+            stop_process(process)
+            return None
+        time.sleep(0.5)
+    stop_process(process)
+    return process.returncode
+
+
+def stop_process(process):
+    for sig in [signal.SIGINT, signal.SIGTERM, signal.SIGKILL]:
+        try:
+            os.killpg(process.pid, sig)
+        except OSError:
+            return
+
+        for _ in xrange(20):
+            if process.poll() is not None:
+                break
+            time.sleep(0.25)
+
+
+def read_results(ros_home, start):
+    # rostest writes JUnit files to $ROS_HOME/test_results
+    tests = failures = errors = 0
+    for filename in glob.glob(os.path.join(ros_home, "test_results", "*", "*.xml")):
+        if os.path.getmtime(filename) < start:
+            continue
+        try:
+            root = ElementTree.parse(filename).getroot()
+        except ElementTree.ParseError:
+            errors += 1
+            continue
+        tests += int(root.get("tests", 0))
+        failures += int(root.get("failures", 0))
+        errors += int(root.get("errors", 0))
+
+    if tests == 0:
+        status = "error"
+    elif failures or errors:
+        status = "failed"
+    else:
+        status = "passed"
+    return {"status": status, "tests": tests, "failures": failures, "errors": errors}
+
+
+def summarize(results, duration, jobs):
+    summary = {"duration": round(duration, 1), "jobs": jobs, "results": results}
+    for status in ["passed", "failed", "timeout", "error"]:
+        summary[status] = sum(1 for result in results if result["status"] == status)
+    return summary
+
+
+def write_summary(summary, output):
+    with open(os.path.join(output, "results.yaml"), 'w') as stream:
+        yaml.safe_dump(summary, stream, default_flow_style=False)
+
+
+class TestJob(object):
+    __slots__ = ["name", "kind", "filename", "time_limit", "result"]
+
+    def __init__(self, name, kind, filename, time_limit):
+        self.name = name
+        self.kind = kind
+        self.filename = filename
+        self.time_limit = time_limit
+        self.result = None
+
+
+class Worker(threading.Thread):
+    def __init__(self, index, suite, args):
+        threading.Thread.__init__(self, name="worker_" + str(index))
+        self.daemon = True
+        self.index = index
+        self.suite = suite
+        self.args = args
+
+        self.ros_port = args.base_port + index
+        self.home = os.path.join(args.output, "worker_" + str(index))
+        if not os.path.isdir(self.home):
+            os.makedirs(self.home)
+
+        self.env = dict(os.environ)
+        self.env["ROS_MASTER_URI"] = "http://localhost:" + str(self.ros_port)
+        self.env["GAZEBO_MASTER_URI"] = "http://localhost:" + str(args.gazebo_base_port + index)
+        self.env["ROS_HOME"] = self.home
+        self.env["GRASPING_APP_TEST_WORKER"] = str(index)
+        self.env.pop("DISPLAY", None)
+
+    def run(self):
+        while True:
+            job = self.suite.next_job()
+            if job is None:
+                return
+
+            job.result = self.run_job(job)
+            self.suite.finished(job)
+
+    def run_job(self, job):
+        log_file = os.path.join(self.home, job.kind + "_" + job.name + ".log")
+        result = {"test": job.name, "kind": job.kind, "worker": self.index, "log": log_file}
+
+        with open(log_file, 'w') as log:
+            # A fresh master per test, parameters of the previous test must not leak into the next one
+            master = self.start_process(["roscore", "-p", str(self.ros_port)], log)
+            try:
+                if not self.wait_for_master():
+                    result.update(status="error", duration=0.0, message="ROS master did not start")
+                    return result
+
+                start = time.time()
+                test = self.start_process(["rostest", "--reuse-master", job.filename,
+                                           "time_limit:=" + str(job.time_limit)], log)
+                status = wait_for_process(test, job.time_limit + self.args.grace)
+                result["duration"] = round(time.time() - start, 1)
+            finally:
+                stop_process(master)
+
+        if status is None:
+            result["status"] = "timeout"
+        else:
+            result.update(read_results(self.home, start))
+            if status != 0 and result["status"] == "passed":
+                result["status"] = "failed"
+        return result
+
+    def start_process(self, command, log):
+        return start_process(command, self.env, log)
+
+    def wait_for_master(self, timeout=30.0):
+        master = rosgraph.Master("/run_test_suite", master_uri=self.env["ROS_MASTER_URI"])
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if master.is_online():
+                return True
+            time.sleep(0.2)
+        return False
+
+
+class TestSuite(object):
+    # Shared queue for all workers: idle workers take the next test, analysing tests are queued as soon as the
+    # recording of the same test has passed
+    def __init__(self, recording, analysing):
+        self.queue = Queue()
+        self.lock = threading.Lock()
+        self.analysing = dict((job.name, job) for job in analysing)
+        self.pending = len(recording)
+        self.results = []
+
+        for job in recording:
+            self.queue.put(job)
+
+    def next_job(self):
+        while True:
+            with self.lock:
+                if self.pending == 0:
+                    return None
+            try:
+                return self.queue.get(timeout=1.0)
+            except Empty:
+                continue
+
+    def finished(self, job):
+        with self.lock:
+            self.results.append(job.result)
+            print("[%3d done] %-10s %-9s %-40s %7.1fs  (worker %d)" % (len(self.results), job.result["status"],
+                                                                       job.kind, job.name,
+                                                                       job.result.get("duration", 0.0),
+                                                                       job.result["worker"]))
+
+            if job.kind == "recording" and job.result["status"] == "passed" and job.name in self.analysing:
+                self.pending += 1
+                self.queue.put(self.analysing.pop(job.name))
+            self.pending -= 1
+
+
+def load_jobs(tests_dir, kind, time_limit, pattern):
+    jobs = []
+    for filename in sorted(glob.glob(os.path.join(tests_dir, kind, "*.test"))):
+        name = os.path.splitext(os.path.basename(filename))[0]
+        if pattern is None or re.search(pattern, name):
+            jobs.append(TestJob(name, kind, filename, time_limit))
+    return jobs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the generated recording and analysing tests in parallel")
+    parser.add_argument("tests_dir", help="directory of the generated tests, e.g. build/.../Testing/tests_generated")
+    parser.add_argument("--generation-config", default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                    "..", "config", "test_generation_config.yaml"))
+    parser.add_argument("--jobs", type=int, default=2, help="number of tests running at the same time")
+    parser.add_argument("--output", default="test_suite_results")
+    parser.add_argument("--filter", default=None, help="only run tests whose name matches this regex")
+    parser.add_argument("--grace", type=float, default=120.0, help="startup time added to the time limits in s")
+    parser.add_argument("--base-port", type=int, default=ROS_BASE_PORT)
+    parser.add_argument("--gazebo-base-port", type=int, default=GAZEBO_BASE_PORT)
+    parser.add_argument("--no-analysing", action="store_true")
+    args = parser.parse_args()
+
+    args.output = os.path.abspath(args.output)
+
+    with open(args.generation_config, 'r') as stream:
+        generation_config = yaml.safe_load(stream)
+
+    recording = load_jobs(args.tests_dir, "recording", generation_config["time_limit_recording"], args.filter)
+    analysing = [] if args.no_analysing else \
+        load_jobs(args.tests_dir, "analysing", generation_config["time_limit_analysing"], args.filter)
+
+    if len(recording) == 0:
+        parser.error("no recording tests found in '" + args.tests_dir + "'")
+
+    print("Running " + str(len(recording)) + " recording and " + str(len(analysing)) + " analysing tests with " +
+          str(args.jobs) + " workers")
+
+    start = time.time()
+    suite = TestSuite(recording, analysing)
+    workers = [Worker(i, suite, args) for i in xrange(args.jobs)]
+    for worker in workers:
+        worker.start()
+
+    try:
+        while any(worker.is_alive() for worker in workers):
+            time.sleep(1.0)
+    except KeyboardInterrupt:
+        print("Interrupted, waiting for the running tests to finish")
+        with suite.lock:
+            suite.pending = 0
+        for worker in workers:
+            worker.join()
+
+    # ---- SUMMARY ----
+    summary = summarize(suite.results, time.time() - start, args.jobs)
+    write_summary(summary, args.output)
+
+    print("%d passed, %d failed, %d timeout, %d error in %.0fs, results in '%s'" %
+          (summary["passed"], summary["failed"], summary["timeout"], summary["error"], summary["duration"],
+           os.path.join(args.output, "results.yaml")))
+
+    return 0 if summary["passed"] == len(suite.results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,242 @@
+#!/usr/bin/python
+import hashlib
+import math
+import os
+
+import yaml
+
+from geometry_msgs.msg import Point
+from moveit_msgs.msg import CollisionObject
+from shape_msgs.msg import SolidPrimitive
+from tf.transformations import quaternion_from_euler
+from visualization_msgs.msg import Marker
+
+from scene_updates import make_pose
+
+
+# Named joint configurations of a manipulation in the order they are moved to
+POSE_NAMES = ["start", "approach", "grasp", "lift", "move", "drop", "retreat", "end"]
+TARGET_NAMES = ["start_r", "goal_r", "goal_l"]
+WAYPOINT_NAMES = ["waypoint_r", "waypoint_l"]
+
+
+def make_point(values):
+    return Point(values[0], values[1], values[2])
+
+
+def degrees_to_quaternion(orientation):
+    return list(quaternion_from_euler((orientation[0] / 180.0) * math.pi,
+                                      (orientation[1] / 180.0) * math.pi,
+                                      (orientation[2] / 180.0) * math.pi))
+
+
+def scene_fingerprint(environment, obstacles, mesh_file):
+    # Everything that changes the collision world of a scene
+    mtime = os.path.getmtime(mesh_file) if os.path.isfile(mesh_file) else 0.0
+    return hashlib.sha1(yaml.safe_dump([environment, obstacles, mesh_file, mtime])).hexdigest()
+
+
+def require(condition, scene_name, message):
+    if not condition:
+        raise ValueError("Scene '" + scene_name + "': " + message)
+
+
+def vector(scene_name, name, values, length=3):
+    require(isinstance(values, (list, tuple)) and len(values) == length, scene_name,
+            name + " needs " + str(length) + " values")
+    return [float(value) for value in values]
+
+
+class SceneModel(object):
+    # One scene of scene_config.yaml, validated once. Quaternions, points, collision objects and marker templates are
+    # built on load, only the environment mesh is loaded on the first spawn.
+    __slots__ = ["name", "arm", "environment", "mesh_file", "scaling", "environment_pose", "environment_object",
+                 "obstacles", "object", "poses", "positions", "points", "waypoints", "waypoint_points",
+                 "marker_templates", "fingerprints"]
+
+    def __init__(self, name, data, package_path):
+        self.name = name
+
+        for key in ["environment", "object", "poses", "positions"]:
+            require(isinstance(data.get(key), dict), name, "'" + key + "' is missing")
+
+        # ---- ENVIRONMENT ----
+        self.environment = data["environment"]
+        require("mesh" in self.environment, name, "environment mesh is missing")
+        self.mesh_file = package_path + self.environment["mesh"]
+        self.scaling = float(self.environment.get("scaling", 1.0))
+        self.environment_pose = vector(name, "environment position", self.environment["position"]) + \
+            degrees_to_quaternion(vector(name, "environment orientation", self.environment["orientation"]))
+        self.environment_object = None
+
+        self.obstacles = []
+        for item in self.environment.get("additional_obstacles") or []:
+            self.obstacles.append(self.make_obstacle(item))
+
+        # ---- OBJECT ----
+        self.object = data["object"]
+        require("shape" in self.object, name, "object shape is missing")
+        vector(name, "object dimension", self.object.get("dimension"))
+
+        # ---- POSES ----
+        self.poses = data["poses"]
+        for pose_name in POSE_NAMES:
+            require(pose_name in self.poses, name, "pose '" + pose_name + "' is missing")
+
+        # ---- POSITIONS ----
+        positions = data["positions"]
+        self.arm = positions.get("arm")
+        require(self.arm in ["left", "right"], name, "arm has to be 'left' or 'right'")
+
+        self.positions = {}
+        self.points = {}
+        for target_name in TARGET_NAMES:
+            self.set_position(target_name, vector(name, target_name, positions.get(target_name)))
+
+        self.waypoints = {}
+        self.waypoint_points = {}
+        for waypoint_name in WAYPOINT_NAMES:
+            self.waypoints[waypoint_name] = [vector(name, waypoint_name, item)
+                                             for item in positions.get(waypoint_name) or []]
+            self.waypoint_points[waypoint_name] = [make_point(item) for item in self.waypoints[waypoint_name]]
+
+        self.marker_templates = {}
+        self.fingerprints = {}
+
+    def make_obstacle(self, item):
+        for key in ["id", "shape", "size", "position", "orientation"]:
+            require(key in item, self.name, "obstacle " + str(item.get("id")) + " has no " + key)
+
+        collision_object = CollisionObject()
+        collision_object.header.frame_id = "base_link"
+        collision_object.id = item["id"]
+        collision_object.operation = CollisionObject.ADD
+
+        object_shape = SolidPrimitive()
+        object_shape.type = item["shape"]
+        object_shape.dimensions.extend(vector(self.name, "obstacle size", item["size"]))  # X, Y, Z
+        collision_object.primitives.append(object_shape)
+        collision_object.primitive_poses.append(make_pose(vector(self.name, "obstacle position", item["position"]) +
+                                                          degrees_to_quaternion(item["orientation"])))
+
+        return collision_object
+
+    # ---- COLLISION WORLD ----
+    def get_environment_object(self, load_mesh):
+        # load_mesh(filename, scale) returns a shape_msgs/Mesh or None
+        if self.environment_object is None:
+            environment = CollisionObject()
+            environment.header.frame_id = "base_link"
+            environment.id = self.name
+            environment.operation = CollisionObject.ADD
+
+            mesh = load_mesh(self.mesh_file, self.scaling)
+            environment.meshes.append(mesh)
+            environment.mesh_poses.append(make_pose(self.environment_pose))
+            if mesh is None:
+                return environment
+
+            self.environment_object = environment
+
+        return self.environment_object
+
+    def obstacle_objects(self, spawn_obstacles):
+        # "all", "none" or the id of a single obstacle
+        if spawn_obstacles == "all":
+            return list(self.obstacles)
+        return [co_object for co_object in self.obstacles if co_object.id == spawn_obstacles][:1]
+
+    def fingerprint(self, spawn_obstacles):
+        if spawn_obstacles not in self.fingerprints:
+            obstacles = [co_object.id for co_object in self.obstacle_objects(spawn_obstacles)]
+            self.fingerprints[spawn_obstacles] = scene_fingerprint(self.environment, obstacles, self.mesh_file)
+        return self.fingerprints[spawn_obstacles]
+
+    def object_ids(self):
+        return [self.name] + [co_object.id for co_object in self.obstacles]
+
+    # ---- TARGETS ----
+    def set_position(self, target_name, values):
+        self.positions[target_name] = [float(value) for value in values]
+        self.points[target_name] = make_point(self.positions[target_name])
+
+    def set_waypoint(self, waypoint_name, index, values):
+        self.waypoints[waypoint_name][index] = [float(value) for value in values]
+        self.waypoint_points[waypoint_name][index] = make_point(self.waypoints[waypoint_name][index])
+
+    def add_waypoint(self, waypoint_name, values):
+        self.waypoints[waypoint_name].append([float(value) for value in values])
+        self.waypoint_points[waypoint_name].append(make_point(self.waypoints[waypoint_name][-1]))
+
+    def delete_waypoint(self, waypoint_name, index):
+        del self.waypoints[waypoint_name][index]
+        del self.waypoint_points[waypoint_name][index]
+
+    def arm_positions(self):
+        # Targets of both arms, the left arm starts at the goal of the right arm
+        return {"right": {"start": self.points["start_r"],
+                          "waypoints": list(self.waypoint_points["waypoint_r"]),
+                          "goal": self.points["goal_r"]},
+                "left": {"start": self.points["goal_r"],
+                         "waypoints": list(self.waypoint_points["waypoint_l"]),
+                         "goal": self.points["goal_l"]}}
+
+    def pose_names(self, planning_method):
+        if planning_method != "joint":
+            return [self.poses["start"], self.poses["end"]]
+        return [self.poses[pose_name] for pose_name in POSE_NAMES]
+
+    # ---- MARKERS ----
+    def marker_template(self, color):
+        # Box of the object size, shared by all interactive markers with this color
+        key = (color.r, color.g, color.b, color.a)
+        if key not in self.marker_templates:
+            marker = Marker()
+            marker.type = self.object["shape"]
+            marker.scale.x = self.object["dimension"][0]  # Diameter in x
+            marker.scale.y = self.object["dimension"][1]  # Diameter in y
+            marker.scale.z = self.object["dimension"][2]  # Height
+            marker.color = color
+            self.marker_templates[key] = marker
+        return self.marker_templates[key]
+
+    def to_dict(self):
+        positions = {"arm": self.arm}
+        positions.update(self.positions)
+        positions.update(self.waypoints)
+        return {"environment": self.environment, "object": self.object, "poses": self.poses, "positions": positions}
+
+
+class SceneCatalogue(object):
+    # All scenes of scene_config.yaml by name
+    def __init__(self, doc, package_path):
+        require(isinstance(doc, dict) and len(doc) != 0, "*", "no scenes defined")
+        self.scenes = dict((name, SceneModel(name, data, package_path)) for (name, data) in doc.iteritems())
+        self.ids = sorted(set(object_id for scene in self.scenes.itervalues() for object_id in scene.object_ids()))
+
+    @classmethod
+    def load(cls, filename, package_path):
+        with open(filename, 'r') as stream:
+            return cls(yaml.load(stream), package_path)
+
+    def save(self, filename):
+        temp_file = filename + ".tmp"
+        with open(temp_file, 'w') as stream:
+            yaml.dump(dict((name, scene.to_dict()) for (name, scene) in self.scenes.iteritems()), stream)
+        os.rename(temp_file, filename)
+
+    def object_ids(self):
+        # Ids of every environment and obstacle of all scenes
+        return self.ids
+
+    def __getitem__(self, name):
+        return self.scenes[name]
+
+    def __contains__(self, name):
+        return name in self.scenes
+
+    def __iter__(self):
+        return iter(sorted(self.scenes))
+
+    def __len__(self):
+        return len(self.scenes)
@@ -0,0 +1,402 @@
+#!/usr/bin/python
+import threading
+from collections import OrderedDict
+
+import rospy
+from geometry_msgs.msg import Pose
+from moveit_msgs.msg import AttachedCollisionObject, CollisionObject, PlanningScene, PlanningSceneComponents
+from moveit_msgs.srv import GetPlanningScene
+
+
+def pose_list(poses):
+    return [(pose.position.x, pose.position.y, pose.position.z,
+             pose.orientation.x, pose.orientation.y, pose.orientation.z, pose.orientation.w) for pose in poses]
+
+
+def shape_signature(co_object):
+    # Shapes of an object independent of the frame, e.g. as reported by move_group in its planning frame
+    return ([(primitive.type, tuple(round(value, 6) for value in primitive.dimensions))
+             for primitive in co_object.primitives],
+            [(len(mesh.vertices), len(mesh.triangles), round(sum(p.x + p.y + p.z for p in mesh.vertices), 6))
+             for mesh in co_object.meshes if mesh is not None])
+
+
+def same_geometry(a, b):
+    # Meshes are compared by identity, MeshCache returns the same message for the same file and scale
+    return a is b or (a.header.frame_id == b.header.frame_id and
+                      [(p.type, tuple(p.dimensions)) for p in a.primitives] ==
+                      [(p.type, tuple(p.dimensions)) for p in b.primitives] and
+                      len(a.meshes) == len(b.meshes) and all(m is n for (m, n) in zip(a.meshes, b.meshes)))
+
+
+def object_poses(co_object):
+    return pose_list(co_object.primitive_poses), pose_list(co_object.mesh_poses)
+
+
+def same_poses(a, b):
+    return a is b or object_poses(a) == object_poses(b)
+
+
+def scene_diff(current, target, managed_ids):
+    # current: id -> CollisionObject (None if unknown), target: CollisionObjects. Returns the ids to keep, the
+    # objects to move and to add and the managed ids to remove.
+    (kept, moved, added) = ([], [], [])
+    for co_object in target:
+        previous = current.get(co_object.id)
+        if previous is None or not same_geometry(previous, co_object):
+            added.append(co_object)
+        elif not same_poses(previous, co_object):
+            moved.append(co_object)
+        else:
+            kept.append(co_object.id)
+
+    target_ids = set(co_object.id for co_object in target)
+    removed = [object_id for object_id in managed_ids if object_id in current and object_id not in target_ids]
+    return kept, moved, added, removed
+
+
+def make_pose(co_position):
+    # co_position: [x, y, z, qx, qy, qz, qw]
+    pose = Pose()
+    pose.position.x = co_position[0]
+    pose.position.y = co_position[1]
+    pose.position.z = co_position[2]
+    pose.orientation.x = co_position[3]
+    pose.orientation.y = co_position[4]
+    pose.orientation.z = co_position[5]
+    pose.orientation.w = co_position[6]
+    return pose
+
+
+class PlanningSceneClient(object):
+    # Sends collision object changes as planning scene diffs and keeps a local index of the world objects.
+    # Updates are confirmed with the get_planning_scene service instead of sleeping a fixed time. Object names are
+    # polled every poll_interval, the geometry (with the environment mesh) from geometry_poll_interval on with
+    # doubling intervals.
+    def __init__(self, publisher, service_name="/get_planning_scene", timeout=2.0, poll_interval=0.01,
+                 geometry_poll_interval=0.05):
+        self.publisher = publisher
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.geometry_poll_interval = geometry_poll_interval
+
+        self.lock = threading.RLock()
+        self.objects = {}  # id -> CollisionObject that was added
+        self.attached = {}  # id -> AttachedCollisionObject
+        self.mirror = None  # SharedSceneWriter, updated with every change
+
+        self.get_scene = rospy.ServiceProxy(service_name, GetPlanningScene)
+        try:
+            self.get_scene.wait_for_service(timeout)
+            self.confirm = True
+        except rospy.ROSException:
+            rospy.logwarn("Service '" + service_name + "' not available, planning scene updates are not confirmed")
+            self.confirm = False
+
+        # Objects that are already in the scene, e.g. from a previous run
+        for object_id in self.world_object_ids() or []:
+            self.objects[object_id] = None
+
+    def transaction(self):
+        return SceneTransaction(self)
+
+    def contains(self, object_id):
+        return object_id in self.objects
+
+    def world_objects(self):
+        with self.lock:
+            return dict(self.objects)
+
+    def world_object_ids(self):
+        if not self.confirm:
+            return None
+
+        try:
+            response = self.get_scene(PlanningSceneComponents(components=PlanningSceneComponents.WORLD_OBJECT_NAMES))
+        except rospy.ServiceException, e:
+            rospy.logwarn("Unable to get planning scene: " + str(e))
+            return None
+
+        return set(co.id for co in response.scene.world.collision_objects)
+
+    def world_geometry(self):
+        # id -> CollisionObject as move_group has it, poses are in its planning frame
+        if not self.confirm:
+            return None
+
+        try:
+            response = self.get_scene(PlanningSceneComponents(
+                components=PlanningSceneComponents.WORLD_OBJECT_GEOMETRY))
+        except rospy.ServiceException, e:
+            rospy.logwarn("Unable to get planning scene: " + str(e))
+            return None
+
+        return dict((co.id, co) for co in response.scene.world.collision_objects)
+
+    def attached_object_ids(self):
+        if not self.confirm:
+            return None
+
+        try:
+            response = self.get_scene(PlanningSceneComponents(
+                components=PlanningSceneComponents.ROBOT_STATE_ATTACHED_OBJECTS))
+        except rospy.ServiceException, e:
+            rospy.logwarn("Unable to get planning scene: " + str(e))
+            return None
+
+        return set(attached.object.id for attached in response.scene.robot_state.attached_collision_objects)
+
+    def attach(self, attached_object):
+        # MoveIt takes an object with the same id out of the world
+        with self.lock:
+            scene = PlanningScene()
+            scene.is_diff = True
+            scene.robot_state.is_diff = True
+            scene.robot_state.attached_collision_objects.append(attached_object)
+
+            self.objects.pop(attached_object.object.id, None)
+            self.attached[attached_object.object.id] = attached_object
+            self.update_mirror()
+            self.publisher.publish(scene)
+
+            return self.wait_for(set([attached_object.object.id]), set(), self.attached_object_ids)
+
+    def detach(self, link_name, object_id, keep_in_world=True):
+        # A detached object is put back into the world where it is, or removed as well
+        with self.lock:
+            scene = PlanningScene()
+            scene.is_diff = True
+            scene.robot_state.is_diff = True
+
+            detach = AttachedCollisionObject()
+            detach.link_name = link_name
+            detach.object.id = object_id
+            detach.object.operation = CollisionObject.REMOVE
+            scene.robot_state.attached_collision_objects.append(detach)
+
+            self.attached.pop(object_id, None)
+            if not keep_in_world:
+                co_object = CollisionObject()
+                co_object.id = object_id
+                co_object.operation = CollisionObject.REMOVE
+                scene.world.collision_objects.append(co_object)
+                self.objects.pop(object_id, None)
+
+            self.publisher.publish(scene)
+
+            confirmed = self.wait_for(set(), set([object_id]), self.attached_object_ids)
+            if keep_in_world:
+                # The pose of the object in the world is only known to move_group. Without its answer the object is
+                # kept without geometry, like objects of a previous run.
+                confirmed = confirmed and self.wait_for(set([object_id]), set())
+                self.objects[object_id] = (self.world_geometry() or {}).get(object_id) if confirmed else None
+            else:
+                confirmed = confirmed and self.wait_for(set(), set([object_id]))
+
+            # Until here the mirror has the object where it was attached
+            self.update_mirror()
+            return confirmed
+
+    def commit(self, added, removed, moved=()):
+        # moved: complete objects, only their poses are sent
+        with self.lock:
+            # Only remove what is actually in the scene
+            removed = [object_id for object_id in removed if object_id in self.objects]
+            if not added and not removed and not moved:
+                return True
+
+            # move_group applies a diff at once, if an object appears or disappears with it the names confirm it.
+            # Moved and replaced objects keep their id, only their geometry confirms a diff without such a change.
+            appearing = [co_object for co_object in added if co_object.id not in self.objects]
+            updated = {} if appearing or removed else self.expected_updates(list(added) + list(moved))
+
+            scene = PlanningScene()
+            scene.is_diff = True
+
+            for object_id in removed:
+                co_object = CollisionObject()
+                co_object.id = object_id
+                co_object.operation = CollisionObject.REMOVE
+                scene.world.collision_objects.append(co_object)
+                del self.objects[object_id]
+
+            for co_object in added:
+                scene.world.collision_objects.append(co_object)
+                self.objects[co_object.id] = co_object
+
+            for co_object in moved:
+                move = CollisionObject()
+                move.header = co_object.header
+                move.id = co_object.id
+                move.operation = CollisionObject.MOVE
+                move.primitive_poses = co_object.primitive_poses
+                move.mesh_poses = co_object.mesh_poses
+                scene.world.collision_objects.append(move)
+                self.objects[co_object.id] = co_object
+
+            self.update_mirror()
+            self.publisher.publish(scene)
+
+            if not self.wait_for(set(co_object.id for co_object in list(added) + list(moved)), set(removed)):
+                return False
+            return not updated or self.wait_until(lambda: self.updates_applied(updated), self.geometry_poll_interval,
+                                                  8 * self.geometry_poll_interval)
+
+    def expected_updates(self, co_objects):
+        # Caller holds the lock, before the update is published. id -> (shape signature, poses before the update or
+        # None if the poses do not change). The poses of move_group are in its planning frame, so they are only
+        # compared with the ones it reported before.
+        co_objects = [co_object for co_object in co_objects if co_object.id in self.objects]
+        if not co_objects or not self.confirm:
+            return {}
+
+        # The geometry is only requested if poses change, it includes the environment mesh
+        moved = set(co_object.id for co_object in co_objects
+                    if self.objects[co_object.id] is not None and not same_poses(self.objects[co_object.id], co_object))
+        before = (self.world_geometry() or {}) if moved else {}
+
+        updated = {}
+        for co_object in co_objects:
+            updated[co_object.id] = (shape_signature(co_object),
+                                     object_poses(before[co_object.id])
+                                     if co_object.id in moved and co_object.id in before else None)
+        return updated
+
+    def updates_applied(self, updated):
+        world = self.world_geometry()
+        if world is None:
+            return False
+
+        for (object_id, (signature, poses)) in updated.iteritems():
+            if object_id not in world or shape_signature(world[object_id]) != signature:
+                return False
+            if poses is not None and object_poses(world[object_id]) == poses:
+                return False
+        return True
+
+    def reset(self):
+        # Detaches all objects and clears the world, e.g. between two runs on the same move_group
+        with self.lock:
+            previous = set(self.objects) | (self.world_object_ids() or set())
+
+            scene = PlanningScene()
+            scene.is_diff = True
+            scene.robot_state.is_diff = True
+
+            # Empty ids address all objects, detached objects are put back into the world first and removed then
+            detach = AttachedCollisionObject()
+            detach.object.operation = CollisionObject.REMOVE
+            scene.robot_state.attached_collision_objects.append(detach)
+
+            co_object = CollisionObject()
+            co_object.operation = CollisionObject.REMOVE
+            scene.world.collision_objects.append(co_object)
+
+            self.objects.clear()
+            self.attached.clear()
+            self.update_mirror()
+            self.publisher.publish(scene)
+
+            return self.wait_for(set(), previous)
+
+    def update_mirror(self):
+        # Caller holds the lock. Objects without geometry (from a previous run) are not mirrored.
+        if self.mirror is None:
+            return
+
+        try:
+            self.mirror.update([co_object for co_object in self.objects.itervalues() if co_object is not None],
+                               self.attached.values())
+        except ValueError, e:
+            rospy.logerr(str(e))
+
+    def wait_for(self, present, absent, object_ids=None):
+        # object_ids returns the ids to check, the world objects by default
+        if not self.confirm:
+            rospy.sleep(0.1)
+            return True
+
+        object_ids = object_ids or self.world_object_ids
+
+        def confirmed():
+            ids = object_ids()
+            return ids is not None and present <= ids and not (absent & ids)
+
+        return self.wait_until(confirmed)
+
+    def wait_until(self, condition, interval=None, max_interval=None):
+        # Polled every interval (poll_interval by default), doubled after every poll up to max_interval
+        interval = interval or self.poll_interval
+        max_interval = max_interval or interval
+        deadline = rospy.Time.now() + rospy.Duration.from_sec(self.timeout)
+        while not rospy.is_shutdown():
+            if condition():
+                return True
+
+            if rospy.Time.now() > deadline:
+                rospy.logwarn("Planning scene update not confirmed within " + str(self.timeout) + "s")
+                return False
+
+            rospy.sleep(interval)
+            interval = min(2.0 * interval, max_interval)
+
+        return False
+
+
+class SceneTransaction(object):
+    # Collects adds and removes and sends them as one planning scene diff on commit(), e.g.
+    #   with scene_client.transaction() as transaction:
+    #       transaction.remove("object")
+    #       transaction.add(co_object, position, "primitive")
+    def __init__(self, client):
+        self.client = client
+        self.added = OrderedDict()
+        self.moved = OrderedDict()
+        self.removed = OrderedDict()
+
+    def add(self, co_object, co_position, co_type):
+        co_object.operation = CollisionObject.ADD
+        pose = make_pose(co_position)
+
+        if co_type == "mesh":
+            co_object.mesh_poses.append(pose)
+        elif co_type == "primitive":
+            co_object.primitive_poses.append(pose)
+        else:
+            rospy.logerr("Invalid type")
+            return
+
+        self.add_object(co_object)
+
+    def add_object(self, co_object):
+        # co_object already carries its pose and the ADD operation. Adding an existing id replaces the object, no
+        # separate remove needed.
+        self.removed.pop(co_object.id, None)
+        self.moved.pop(co_object.id, None)
+        self.added[co_object.id] = co_object
+
+    def move(self, co_object):
+        # co_object has the same geometry as the one in the scene, only its poses are sent
+        self.removed.pop(co_object.id, None)
+        self.added.pop(co_object.id, None)
+        self.moved[co_object.id] = co_object
+
+    def remove(self, object_id):
+        self.added.pop(object_id, None)
+        self.moved.pop(object_id, None)
+        self.removed[object_id] = True
+
+    def commit(self):
+        result = self.client.commit(self.added.values(), self.removed.keys(), self.moved.values())
+        self.added.clear()
+        self.moved.clear()
+        self.removed.clear()
+        return result
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        return False
@@ -0,0 +1,208 @@
+#!/usr/bin/python
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from shape_msgs.msg import SolidPrimitive
+
+
+# File layout: header, shape table, vertex buffer, triangle buffer, every part aligned to 64 bytes
+SCENE_MAGIC = "CGSS"
+SCENE_LAYOUT = 1
+SCENE_HEADER = np.dtype([("magic", "S4"),
+                         ("layout", "<u4"),
+                         ("version", "<u8"),  # odd while the writer changes the scene
+                         ("n_shapes", "<u4"),
+                         ("n_vertices", "<u4"),
+                         ("n_triangles", "<u4"),
+                         ("max_shapes", "<u4"),
+                         ("max_vertices", "<u4"),
+                         ("max_triangles", "<u4")])
+SCENE_SHAPE = np.dtype([("id", "S64"),
+                        ("link", "S64"),  # empty for world objects, the link of attached objects
+                        ("type", "<u1"),  # SolidPrimitive type or MESH
+                        ("pose", "<f8", (7,)),  # x, y, z, qx, qy, qz, qw
+                        ("dimensions", "<f8", (3,)),
+                        ("vertex_offset", "<u4"),
+                        ("vertex_count", "<u4"),
+                        ("triangle_offset", "<u4"),
+                        ("triangle_count", "<u4")])
+MESH = 255
+
+SHM_DIRECTORY = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+
+def aligned(size, alignment=64):
+    return (size + alignment - 1) // alignment * alignment
+
+
+def scene_file(name):
+    return os.path.join(SHM_DIRECTORY, name)
+
+
+def layout(max_shapes, max_vertices, max_triangles):
+    # Byte offsets of the shape table, the vertex and the triangle buffer and the file size
+    shapes = aligned(SCENE_HEADER.itemsize)
+    vertices = shapes + aligned(max_shapes * SCENE_SHAPE.itemsize)
+    triangles = vertices + aligned(max_vertices * 3 * 8)
+    return shapes, vertices, triangles, triangles + aligned(max_triangles * 3 * 4)
+
+
+def pose_values(pose):
+    return [pose.position.x, pose.position.y, pose.position.z,
+            pose.orientation.x, pose.orientation.y, pose.orientation.z, pose.orientation.w]
+
+
+class SharedScene(object):
+    # Views of the arrays of a scene file, shared by writer and readers
+    def __init__(self, data):
+        self.data = data
+        self.header = data[:SCENE_HEADER.itemsize].view(SCENE_HEADER)[0:1]
+        header = self.header[0]
+
+        (shapes, vertices, triangles, size) = layout(int(header["max_shapes"]), int(header["max_vertices"]),
+                                                     int(header["max_triangles"]))
+        self.shapes = data[shapes:shapes + int(header["max_shapes"]) * SCENE_SHAPE.itemsize].view(SCENE_SHAPE)
+        self.vertices = data[vertices:vertices + int(header["max_vertices"]) * 3 * 8].view("<f8").reshape(-1, 3)
+        self.triangles = data[triangles:triangles + int(header["max_triangles"]) * 3 * 4].view("<u4").reshape(-1, 3)
+
+    @property
+    def version(self):
+        return int(self.header["version"][0])
+
+
+class SharedSceneWriter(SharedScene):
+    # Mirrors the collision objects of the planning scene into a memory-mapped file (in /dev/shm if available).
+    # Every update rewrites the shape table and increments the version twice: odd while writing, even when done.
+    # Mesh vertices are only rewritten if the set of meshes changed.
+    def __init__(self, name, max_shapes=256, max_vertices=200000, max_triangles=400000):
+        self.filename = scene_file(name)
+        size = layout(max_shapes, max_vertices, max_triangles)[3]
+        capacities = (max_shapes, max_vertices, max_triangles)
+
+        # A file of a previous run with the same layout is reused, so the version keeps increasing for readers that
+        # still have it mapped
+        data = None
+        if os.path.isfile(self.filename) and os.path.getsize(self.filename) == size:
+            data = np.memmap(self.filename, dtype=np.uint8, mode='r+')
+            header = data[:SCENE_HEADER.itemsize].view(SCENE_HEADER)[0]
+            if header["magic"] != SCENE_MAGIC or header["layout"] != SCENE_LAYOUT or \
+                    (header["max_shapes"], header["max_vertices"], header["max_triangles"]) != capacities:
+                data = None
+
+        if data is None:
+            temp_file = self.filename + ".tmp"
+            data = np.memmap(temp_file, dtype=np.uint8, mode='w+', shape=(size,))
+            header = data[:SCENE_HEADER.itemsize].view(SCENE_HEADER)
+            header["magic"] = SCENE_MAGIC
+            header["layout"] = SCENE_LAYOUT
+            (header["max_shapes"], header["max_vertices"], header["max_triangles"]) = capacities
+            os.rename(temp_file, self.filename)
+
+        SharedScene.__init__(self, data)
+        if self.version % 2 == 1:
+            # A previous writer stopped in the middle of an update
+            self.header["version"] += 1
+        self.meshes = []  # mesh messages in buffer order
+        self.mesh_slots = {}  # id(mesh) -> (vertex offset, vertex count, triangle offset, triangle count)
+
+    def close(self):
+        # The file is kept for the next writer, readers see an empty scene until then
+        self.update([])
+        self.data.flush()
+
+    def write_meshes(self, meshes):
+        # Caller holds the odd version
+        if len(meshes) == len(self.meshes) and all(a is b for (a, b) in zip(meshes, self.meshes)):
+            return
+
+        (n_vertices, n_triangles) = (0, 0)
+        self.mesh_slots = {}
+        for mesh in meshes:
+            vertices = np.array([(p.x, p.y, p.z) for p in mesh.vertices], dtype=np.float64).reshape(-1, 3)
+            triangles = np.array([triangle.vertex_indices for triangle in mesh.triangles],
+                                 dtype=np.uint32).reshape(-1, 3)
+            if n_vertices + len(vertices) > len(self.vertices) or \
+                    n_triangles + len(triangles) > len(self.triangles):
+                raise ValueError("Shared scene: meshes exceed the buffer size")
+
+            self.vertices[n_vertices:n_vertices + len(vertices)] = vertices
+            self.triangles[n_triangles:n_triangles + len(triangles)] = triangles
+            self.mesh_slots[id(mesh)] = (n_vertices, len(vertices), n_triangles, len(triangles))
+            n_vertices += len(vertices)
+            n_triangles += len(triangles)
+
+        self.meshes = list(meshes)
+        self.header["n_vertices"] = n_vertices
+        self.header["n_triangles"] = n_triangles
+
+    def update(self, world_objects, attached_objects=()):
+        # world_objects: CollisionObjects, attached_objects: AttachedCollisionObjects
+        rows = []
+        meshes = []
+        for (link, co_object) in [("", co_object) for co_object in world_objects] + \
+                [(attached.link_name, attached.object) for attached in attached_objects]:
+            for (primitive, pose) in zip(co_object.primitives, co_object.primitive_poses):
+                rows.append((co_object.id, link, primitive.type, pose_values(pose),
+                             (list(primitive.dimensions) + [0.0] * 3)[:3], None))
+            for (mesh, pose) in zip(co_object.meshes, co_object.mesh_poses):
+                if mesh is None:
+                    continue
+                rows.append((co_object.id, link, MESH, pose_values(pose), [0.0] * 3, mesh))
+                meshes.append(mesh)
+
+        if len(rows) > len(self.shapes):
+            raise ValueError("Shared scene: " + str(len(rows)) + " shapes exceed the table size")
+
+        self.header["version"] += 1
+        try:
+            self.write_meshes(meshes)
+            for (i, (object_id, link, shape_type, pose, dimensions, mesh)) in enumerate(rows):
+                self.shapes[i] = (object_id, link, shape_type, pose, dimensions) + \
+                    (self.mesh_slots[id(mesh)] if mesh is not None else (0, 0, 0, 0))
+            self.header["n_shapes"] = len(rows)
+        finally:
+            self.header["version"] += 1
+
+
+class SharedSceneReader(SharedScene):
+    # Read only mapping of a scene file, e.g. in a worker process. version is a single load, snapshot() copies the
+    # shape table consistently. Mesh buffers are returned as views, they stay valid as long as the version does.
+    def __init__(self, name):
+        data = np.memmap(scene_file(name), dtype=np.uint8, mode='r')
+        SharedScene.__init__(self, data)
+
+        header = self.header[0]
+        if header["magic"] != SCENE_MAGIC or header["layout"] != SCENE_LAYOUT:
+            raise ValueError("'" + scene_file(name) + "' is not a shared scene")
+
+    def changed(self, version):
+        return self.version != version
+
+    def snapshot(self, timeout=1.0, poll_interval=0.0001):
+        # (version, shapes) of one complete update, retried while the writer is active
+        deadline = time.time() + timeout
+        while True:
+            version = self.version
+            if version % 2 == 0:
+                shapes = self.shapes[:int(self.header["n_shapes"][0])].copy()
+                if self.version == version:
+                    return version, shapes
+
+            if time.time() > deadline:
+                raise RuntimeError("Shared scene: no consistent snapshot within " + str(timeout) + "s")
+            time.sleep(poll_interval)
+
+    def mesh(self, shape):
+        # (vertices, triangles) of a MESH shape
+        vertex_offset = int(shape["vertex_offset"])
+        triangle_offset = int(shape["triangle_offset"])
+        return (self.vertices[vertex_offset:vertex_offset + int(shape["vertex_count"])],
+                self.triangles[triangle_offset:triangle_offset + int(shape["triangle_count"])])
+
+    def boxes(self, shapes):
+        # World boxes of a snapshot as (pose, dimensions) arrays
+        mask = (shapes["type"] == SolidPrimitive.BOX) & (shapes["link"] == "")
+        return shapes["pose"][mask], shapes["dimensions"][mask]
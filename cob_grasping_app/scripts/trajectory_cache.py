@@ -0,0 +1,207 @@
+#!/usr/bin/python
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from StringIO import StringIO
+
+import numpy as np
+import yaml
+
+import rospy
+from moveit_msgs.msg import RobotState, RobotTrajectory
+
+
+class TrajectoryCache(object):
+    # Disk backed LRU cache for planned trajectories. Every entry belongs to the scene that was spawned when it was
+    # planned, entries of a scene are dropped as soon as the scene is spawned with a different fingerprint. The
+    # fingerprint is part of every key, so this is the only invalidation needed.
+    # The index is written every index_interval changes and on flush().
+    def __init__(self, directory, max_entries=1000, joint_resolution=0.01, position_resolution=0.001,
+                 orientation_resolution=0.001, index_interval=20):
+        self.directory = os.path.expanduser(directory)
+        self.max_entries = max_entries
+        self.index_interval = index_interval
+        self.joint_resolution = joint_resolution
+        self.position_resolution = position_resolution
+        self.orientation_resolution = orientation_resolution
+
+        self.scene_id = ""
+        self.scene_fingerprint = ""
+        self.hits = 0
+        self.misses = 0
+        self.changes = 0  # since the index was written
+
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> [scene_id, scene_fingerprint], least recently used first
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.load_index()
+
+    # ---- INDEX ----
+    def index_file(self):
+        return os.path.join(self.directory, "index.yaml")
+
+    def entry_file(self, key):
+        return os.path.join(self.directory, key + ".traj")
+
+    def load_index(self):
+        doc = {}
+        if os.path.isfile(self.index_file()):
+            with open(self.index_file(), 'r') as stream:
+                doc = yaml.safe_load(stream) or {}
+
+        # Entries stored after the last index write of a previous run have no scene, they are the least recently
+        # used ones. Their keys still contain the scene fingerprint.
+        for filename in os.listdir(self.directory):
+            if filename.endswith(".traj"):
+                self.entries[filename[:-len(".traj")]] = ["", ""]
+
+        for key, scene_id, fingerprint in doc.get("entries", []):
+            if key in self.entries:
+                del self.entries[key]
+                self.entries[key] = [scene_id, fingerprint]
+
+    def save_index(self):
+        # Caller holds the lock
+        self.changes = 0
+        doc = {"entries": [[key, value[0], value[1]] for key, value in self.entries.iteritems()]}
+
+        # Write the index atomically, a crash must not leave a half written file behind
+        filename = self.index_file() + ".tmp"
+        with open(filename, 'w') as stream:
+            yaml.safe_dump(doc, stream)
+        os.rename(filename, self.index_file())
+
+    # ---- SCENE ----
+    def set_scene(self, scene_id, fingerprint):
+        with self.lock:
+            self.scene_id = scene_id
+            self.scene_fingerprint = fingerprint
+
+            outdated = [key for key, value in self.entries.iteritems()
+                        if value[0] == scene_id and value[1] != fingerprint]
+            for key in outdated:
+                self.remove(key)
+
+            if outdated:
+                rospy.loginfo("Trajectory cache: scene '" + scene_id + "' changed, dropped " + str(len(outdated)) +
+                              " entries")
+                self.save_index()
+
+    # ---- ENTRIES ----
+    def quantize(self, values, resolution):
+        return tuple(np.round(np.asarray(values, dtype=np.float64) / resolution).astype(np.int64).tolist())
+
+    def key(self, arm, start_positions, target_poses, planner_id, planning_method, eef_step, jump_threshold,
+            attached_ids=(), options=()):
+        # target_poses are either geometry_msgs/Pose or joint positions
+        targets = []
+        for target in target_poses:
+            if hasattr(target, "position"):
+                targets.append((self.quantize([target.position.x, target.position.y, target.position.z],
+                                              self.position_resolution),
+                                self.quantize([target.orientation.x, target.orientation.y, target.orientation.z,
+                                               target.orientation.w], self.orientation_resolution)))
+            else:
+                targets.append(self.quantize(target, self.joint_resolution))
+
+        key = (self.scene_id, self.scene_fingerprint, arm, self.quantize(start_positions, self.joint_resolution),
+               tuple(targets), planner_id, planning_method, eef_step, jump_threshold, tuple(attached_ids),
+               tuple(options))
+        return hashlib.sha1(repr(key)).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+
+            try:
+                with open(self.entry_file(key), 'rb') as stream:
+                    traj = RobotTrajectory()
+                    traj.deserialize(stream.read())
+            except Exception, e:
+                rospy.logwarn("Trajectory cache: unable to read entry " + key + ": " + str(e))
+                self.remove(key)
+                self.misses += 1
+                return None
+
+            # Mark as most recently used
+            self.entries[key] = self.entries.pop(key)
+            self.hits += 1
+
+            return traj
+
+    def put(self, key, traj):
+        buff = StringIO()
+        traj.serialize(buff)
+
+        with self.lock:
+            with open(self.entry_file(key), 'wb') as stream:
+                stream.write(buff.getvalue())
+
+            self.entries.pop(key, None)
+            self.entries[key] = [self.scene_id, self.scene_fingerprint]
+
+            while len(self.entries) > self.max_entries:
+                self.remove(next(iter(self.entries)))
+
+            self.changes += 1
+            if self.changes >= self.index_interval:
+                self.save_index()
+
+    def discard(self, key):
+        # Entries without a file are skipped on load, the index is not written right away
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+                self.changes += 1
+
+    def flush(self):
+        with self.lock:
+            if self.changes:
+                self.save_index()
+            rospy.loginfo("Trajectory cache: " + str(self.hits) + " hits, " + str(self.misses) + " misses, " +
+                          str(len(self.entries)) + " entries")
+
+    def remove(self, key):
+        # Caller holds the lock
+        del self.entries[key]
+        try:
+            os.remove(self.entry_file(key))
+        except OSError:
+            pass
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class TrajectoryValidator(object):
+    # Re-checks a stored trajectory against the current planning scene before it is reused
+    def __init__(self, client, stride=10):
+        self.client = client
+        self.stride = max(1, stride)
+
+    def is_valid(self, group_name, traj, attached_objects=()):
+        points = traj.joint_trajectory.points
+        if len(points) == 0:
+            return False
+
+        # Every stride-th point and always the last one
+        indices = range(0, len(points), self.stride)
+        if indices[-1] != len(points) - 1:
+            indices.append(len(points) - 1)
+
+        state = RobotState()
+        state.joint_state.name = traj.joint_trajectory.joint_names
+        state.attached_collision_objects = list(attached_objects)
+        state.is_diff = True
+
+        for i in indices:
+            state.joint_state.position = points[i].positions
+            if not self.client.is_state_valid(group_name, state):
+                return False
+
+        return True
@@ -0,0 +1,322 @@
+#!/usr/bin/python
+import xml.etree.ElementTree as ElementTree
+
+import numpy as np
+
+import rospy
+from moveit_msgs.msg import RobotTrajectory
+from trajectory_msgs.msg import JointTrajectoryPoint
+
+
+SMOOTHING_OFFSET = 0.2  # s
+MIN_SEGMENT_DURATION = 0.001  # s, keeps time_from_start strictly increasing
+
+
+class TrajectoryArrays(object):
+    # Contiguous (points x joints) representation of a RobotTrajectory. All operations work in place on the
+    # arrays and return self, so several of them can be chained between one from_msg() and one to_msg() call.
+    __slots__ = ["joint_names", "header", "multi_dof_joint_trajectory", "time_from_start", "positions",
+                 "velocities", "accelerations"]
+
+    def __init__(self, joint_names, time_from_start, positions, velocities=None, accelerations=None):
+        self.joint_names = list(joint_names)
+        self.header = None
+        self.multi_dof_joint_trajectory = None
+        self.time_from_start = np.ascontiguousarray(time_from_start, dtype=np.float64)
+        self.positions = np.ascontiguousarray(positions, dtype=np.float64)
+        self.velocities = None if velocities is None else np.ascontiguousarray(velocities, dtype=np.float64)
+        self.accelerations = None if accelerations is None else np.ascontiguousarray(accelerations,
+                                                                                       dtype=np.float64)
+
+    def __len__(self):
+        return self.positions.shape[0]
+
+    @classmethod
+    def from_msg(cls, traj):
+        points = traj.joint_trajectory.points
+
+        # An empty plan is how MoveIt reports a planning failure, callers rely on the IndexError
+        if len(points) == 0:
+            raise IndexError("trajectory has no points")
+
+        n_joints = len(traj.joint_trajectory.joint_names)
+
+        time_from_start = np.fromiter((p.time_from_start.to_sec() for p in points), dtype=np.float64,
+                                      count=len(points))
+        positions = np.array([p.positions for p in points], dtype=np.float64).reshape(len(points), n_joints)
+
+        arrays = cls(traj.joint_trajectory.joint_names, time_from_start, positions,
+                     cls._optional_field(points, "velocities", n_joints),
+                     cls._optional_field(points, "accelerations", n_joints))
+        arrays.header = traj.joint_trajectory.header
+        arrays.multi_dof_joint_trajectory = traj.multi_dof_joint_trajectory
+
+        return arrays
+
+    @staticmethod
+    def _optional_field(points, field, n_joints):
+        # Only use the field if every point carries a full set of values
+        for point in points:
+            if len(getattr(point, field)) != n_joints:
+                return None
+
+        return np.array([getattr(p, field) for p in points], dtype=np.float64).reshape(len(points), n_joints)
+
+    def to_msg(self):
+        traj = RobotTrajectory()
+        traj.joint_trajectory.joint_names = list(self.joint_names)
+        if self.header is not None:
+            traj.joint_trajectory.header = self.header
+        if self.multi_dof_joint_trajectory is not None:
+            traj.multi_dof_joint_trajectory = self.multi_dof_joint_trajectory
+
+        times = self.time_from_start.tolist()
+        positions = self.positions.tolist()
+        velocities = [[]] * len(times) if self.velocities is None else self.velocities.tolist()
+        accelerations = [[]] * len(times) if self.accelerations is None else self.accelerations.tolist()
+
+        traj.joint_trajectory.points = [JointTrajectoryPoint(positions=positions[i],
+                                                             velocities=velocities[i],
+                                                             accelerations=accelerations[i],
+                                                             time_from_start=rospy.Duration.from_sec(times[i]))
+                                        for i in xrange(len(times))]
+
+        return traj
+
+    def copy(self):
+        arrays = TrajectoryArrays(self.joint_names, self.time_from_start.copy(), self.positions.copy(),
+                                  None if self.velocities is None else self.velocities.copy(),
+                                  None if self.accelerations is None else self.accelerations.copy())
+        arrays.header = self.header
+        arrays.multi_dof_joint_trajectory = self.multi_dof_joint_trajectory
+        return arrays
+
+    def select(self, indices):
+        # Keep only the points at indices
+        self.time_from_start = self.time_from_start[indices]
+        self.positions = self.positions[indices]
+        if self.velocities is not None:
+            self.velocities = self.velocities[indices]
+        if self.accelerations is not None:
+            self.accelerations = self.accelerations[indices]
+        return self
+
+    def offset_time(self, start_offset, end_offset=0.0):
+        # Shift all points by start_offset and hold the last point for an additional end_offset
+        self.time_from_start += start_offset
+        self.time_from_start[-1] += end_offset
+        return self
+
+    def scale_speed(self, scale):
+        self.time_from_start /= scale
+        if self.velocities is not None:
+            self.velocities *= scale
+        if self.accelerations is not None:
+            self.accelerations *= scale * scale
+        return self
+
+    def fix_end_stop(self):
+        # Make sure the trajectory comes to a stop at its last point
+        if self.velocities is not None:
+            self.velocities[-1] = 0.0
+        return self
+
+    def retime(self, velocity_limits, acceleration_limits, start_speed=0.0, end_speed=0.0):
+        # Time-optimal parameterization of the joint space polyline through the points, starting and ending with the
+        # given path speeds (at rest by default).
+        # The path velocity is limited by the joint velocity limits on every segment and by the direction change at
+        # every point, its change by the joint acceleration limits. Forward and backward pass are closed forms of the
+        # usual recurrences, every segment is then passed with the fastest trapezoidal profile.
+        n_joints = self.positions.shape[1]
+        v_max = np.abs(np.asarray(velocity_limits, dtype=np.float64)) * np.ones(n_joints)
+        a_max = np.abs(np.asarray(acceleration_limits, dtype=np.float64)) * np.ones(n_joints)
+        if len(self) < 2:
+            return self
+
+        delta = np.diff(self.positions, axis=0)
+        length = np.sqrt(np.sum(delta * delta, axis=1))
+        moving = length > 1e-9
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # Segments without motion take the direction of the last moving one
+            last_moving = np.maximum.accumulate(np.where(moving, np.arange(len(length)), 0))
+            direction = np.where(moving[:, np.newaxis], delta / length[:, np.newaxis], 0.0)[last_moving]
+
+            # Squared path velocity and path acceleration allowed on every segment
+            segment_v2 = np.min(v_max / np.abs(direction), axis=1) ** 2
+            segment_a = np.min(a_max / np.abs(direction), axis=1)
+
+            # Squared path velocity allowed at every point, at rest at both ends. Points without a direction change
+            # (also between repeated points) do not limit it.
+            turn = np.abs(direction[1:] - direction[:-1])
+            corner_v2 = np.min(np.where(turn > 1e-12,
+                                        a_max * (0.5 * (length[1:] + length[:-1]))[:, np.newaxis] / turn, np.inf),
+                               axis=1)
+            cap = np.concatenate([[min(start_speed ** 2, segment_v2[0])],
+                                  np.minimum(np.minimum(segment_v2[1:], segment_v2[:-1]), corner_v2),
+                                  [min(end_speed ** 2, segment_v2[-1])]])
+
+            gain = np.where(moving, 2.0 * segment_a * length, 0.0)
+
+        # Forward: x[i+1] <= x[i] + gain[i], backward: x[i] <= x[i+1] + gain[i]
+        forward = np.concatenate([[0.0], np.cumsum(gain)])
+        backward = np.concatenate([np.cumsum(gain[::-1])[::-1], [0.0]])
+        v2 = np.minimum(forward + np.minimum.accumulate(cap - forward),
+                        backward + np.minimum.accumulate((cap - backward)[::-1])[::-1])
+
+        # Accelerate to the peak, cruise, decelerate
+        (v2_start, v2_end) = (v2[:-1], v2[1:])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            peak2 = np.minimum(segment_v2, 0.5 * (v2_start + v2_end) + segment_a * length)
+            peak = np.sqrt(peak2)
+            duration = (2.0 * peak - np.sqrt(v2_start) - np.sqrt(v2_end)) / segment_a + \
+                (length - (2.0 * peak2 - v2_start - v2_end) / (2.0 * segment_a)) / peak
+        duration = np.where(moving, np.maximum(duration, MIN_SEGMENT_DURATION), MIN_SEGMENT_DURATION)
+
+        self.time_from_start = self.time_from_start[0] + np.concatenate([[0.0], np.cumsum(duration)])
+
+        # Joint velocities and accelerations along the mean direction of the adjacent segments, the path
+        # acceleration is d(v^2) / 2ds over both of them
+        tangent = np.concatenate([direction[:1], 0.5 * (direction[1:] + direction[:-1]), direction[-1:]])
+        distance = np.concatenate([length[:1], length[1:] + length[:-1], length[-1:]])
+        change = np.concatenate([v2[1:2] - v2[:1], v2[2:] - v2[:-2], v2[-1:] - v2[-2:-1]])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            path_acceleration = np.where(distance > 1e-9, change / (2.0 * distance), 0.0)
+        self.velocities = np.sqrt(v2)[:, np.newaxis] * tangent
+        self.accelerations = path_acceleration[:, np.newaxis] * tangent
+
+        return self
+
+
+class JointLimits(object):
+    # Velocity and acceleration limits of the joints as MoveIt uses them: the URDF limits, overridden by
+    # robot_description_planning/joint_limits. Joints without an acceleration limit get default_acceleration.
+    def __init__(self, robot_description="/robot_description", default_velocity=1.0, default_acceleration=1.0):
+        self.velocity = {}
+        self.acceleration = {}
+
+        try:
+            root = ElementTree.fromstring(rospy.get_param(robot_description))
+        except (KeyError, ElementTree.ParseError), e:
+            rospy.logwarn("Unable to read joint limits from '" + robot_description + "': " + str(e))
+            root = None
+
+        if root is not None:
+            for joint in root.findall("joint"):
+                limit = joint.find("limit")
+                if limit is not None and "velocity" in limit.attrib:
+                    self.velocity[joint.get("name")] = float(limit.get("velocity"))
+
+        planning_limits = rospy.get_param(robot_description + "_planning/joint_limits", {})
+        for (name, values) in planning_limits.iteritems():
+            if values.get("has_velocity_limits", False):
+                self.velocity[name] = float(values["max_velocity"])
+            if values.get("has_acceleration_limits", False):
+                self.acceleration[name] = float(values["max_acceleration"])
+
+        self.default_velocity = default_velocity
+        self.default_acceleration = default_acceleration
+        self.arrays = {}
+
+    def limits(self, joint_names, scale=1.0):
+        # (velocity, acceleration) arrays in the order of joint_names. Scaling the velocity by scale and the
+        # acceleration by scale^2 stretches the time-optimal trajectory by 1 / scale.
+        joint_names = tuple(joint_names)
+        if joint_names not in self.arrays:
+            self.arrays[joint_names] = (
+                np.array([self.velocity.get(name, self.default_velocity) for name in joint_names], dtype=np.float64),
+                np.array([self.acceleration.get(name, self.default_acceleration) for name in joint_names],
+                         dtype=np.float64))
+
+        (velocity, acceleration) = self.arrays[joint_names]
+        return velocity * scale, acceleration * scale * scale
+
+
+def process_trajectory(traj, time_offset=0.0, end_offset=0.0, speed=None, stop_at_end=False, limits=None,
+                       simplify=None):
+    # Run all requested operations with a single message <-> array conversion. simplify(arrays) may drop points of
+    # the path first, limits is a (velocity, acceleration) tuple the trajectory is retimed with before the timing
+    # operations.
+    arrays = TrajectoryArrays.from_msg(traj)
+
+    if simplify is not None:
+        simplify(arrays)
+    if limits is not None:
+        arrays.retime(*limits)
+    if time_offset or end_offset:
+        arrays.offset_time(time_offset, end_offset)
+    if speed is not None:
+        arrays.scale_speed(speed)
+    if stop_at_end:
+        arrays.fix_end_stop()
+
+    return arrays.to_msg()
+
+
+def concatenate_trajectories(trajectories, blend=True, blend_window=0.5):
+    # Joins consecutive segments into one trajectory. Every segment starts at the last point of the previous one,
+    # so its first point is dropped. The joined trajectory stops at its end. Returns the trajectory and the end
+    # time of every segment.
+    segments = [TrajectoryArrays.from_msg(traj) for traj in trajectories]
+
+    times = [segments[0].time_from_start]
+    positions = [segments[0].positions]
+    velocities = [segments[0].velocities]
+    accelerations = [segments[0].accelerations]
+    boundaries = [len(segments[0]) - 1]
+    end_time = segments[0].time_from_start[-1]
+
+    for segment in segments[1:]:
+        times.append(segment.time_from_start[1:] - segment.time_from_start[0] + end_time)
+        positions.append(segment.positions[1:])
+        velocities.append(None if segment.velocities is None else segment.velocities[1:])
+        accelerations.append(None if segment.accelerations is None else segment.accelerations[1:])
+        boundaries.append(boundaries[-1] + len(segment) - 1)
+        end_time = times[-1][-1] if len(times[-1]) != 0 else end_time
+
+    arrays = TrajectoryArrays(segments[0].joint_names, np.concatenate(times), np.concatenate(positions),
+                              None if any(v is None for v in velocities) else np.concatenate(velocities),
+                              None if any(a is None for a in accelerations) else np.concatenate(accelerations))
+    arrays.header = segments[0].header
+    arrays.multi_dof_joint_trajectory = segments[0].multi_dof_joint_trajectory
+
+    if blend:
+        blend_boundaries(arrays, [b for b in boundaries[:-1] if 0 < b < len(arrays) - 1], blend_window)
+    arrays.fix_end_stop()
+
+    return arrays.to_msg(), arrays.time_from_start[boundaries].tolist()
+
+
+def blend_boundaries(arrays, indices, window=0.5):
+    # Every segment stops at its end. The points within window s around a boundary are retimed time-optimally
+    # through it, starting and ending with the path speed the segments have there, within the largest joint
+    # velocities and accelerations of both segments. The rest of the trajectory is shifted in time. Joints that
+    # change their direction at the boundary still slow down there, a reversal stops.
+    if arrays.velocities is None or arrays.accelerations is None or len(indices) == 0:
+        return arrays
+
+    edges = [0] + list(indices) + [len(arrays) - 1]
+    for k in xrange(1, len(edges) - 1):
+        (first, b, last) = (edges[k - 1], edges[k], edges[k + 1])
+        t = arrays.time_from_start
+
+        # Windows of neighbouring boundaries meet at most in the middle of a segment
+        lo = min(b - 1, max(int(np.searchsorted(t, t[b] - window)), (first + b) // 2))
+        hi = max(b + 1, min(int(np.searchsorted(t, t[b] + window, side='right')) - 1, (b + last + 1) // 2))
+
+        v_max = np.max(np.abs(arrays.velocities[first:last + 1]), axis=0)
+        a_max = np.max(np.abs(arrays.accelerations[first:last + 1]), axis=0)
+        if np.max(v_max) <= 0.0 or np.max(a_max) <= 0.0:
+            continue
+
+        part = TrajectoryArrays(arrays.joint_names, t[lo:hi + 1], arrays.positions[lo:hi + 1])
+        speeds = np.sqrt(np.sum(arrays.velocities[[lo, hi]] ** 2, axis=1))
+        part.retime(np.maximum(v_max, 1e-6), np.maximum(a_max, 1e-6), speeds[0], speeds[1])
+
+        # The window edges keep their velocities, the points after it are shifted
+        arrays.time_from_start[hi:] += part.time_from_start[-1] - t[hi]
+        arrays.time_from_start[lo + 1:hi] = part.time_from_start[1:-1]
+        arrays.velocities[lo + 1:hi] = part.velocities[1:-1]
+        arrays.accelerations[lo + 1:hi] = part.accelerations[1:-1]
+
+    return arrays